@@ -0,0 +1,152 @@
+# bodytext.py
+# HTML -> plain text engines for message bodies.
+#   bs4:    BeautifulSoup + html.parser (original behaviour, slowest)
+#   lxml:   libxml2 parse, strip script/style/img/a in C, itertext()
+#   stream: html.parser tokenizer that drops skipped elements without building a tree
+import os
+import re
+import sys
+import json
+import time
+import email
+from html.parser import HTMLParser
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:  # lxml is optional; stream is the fallback fast path
+    lxml = None
+
+MAX_HTML_CHARS = int(os.getenv("BODY_MAX_HTML_CHARS", "200000"))
+SKIP_TAGS = ('script', 'style', 'img', 'a')
+# an unclosed <a> ends at the next <a> or block-level tag, as in a browser, instead of hiding the rest
+LINK_BREAKING_TAGS = frozenset(('a', 'p', 'div', 'table', 'tbody', 'tr', 'td', 'th', 'ul', 'ol', 'li',
+                                'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article', 'header',
+                                'footer', 'blockquote', 'form', 'body', 'html'))
+DEFAULT_ENGINE = os.getenv("BODY_TEXT_ENGINE", "lxml" if lxml else "stream")
+
+_URL_RE = re.compile(r'https?://\S+')
+
+
+def normalize_text(text: str) -> str:
+    text = _URL_RE.sub('', text)
+    return ' '.join(text.split())
+
+
+# ---------------- engines ----------------
+def _bs4_text(raw_html: str) -> str:
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(raw_html, 'html.parser')
+    for tag in soup(list(SKIP_TAGS)):
+        tag.decompose()
+    return soup.get_text(separator=' ')
+
+
+def _lxml_text(raw_html: str) -> str:
+    try:
+        root = lxml.html.fromstring(raw_html)
+    except (ValueError, etree.ParserError):
+        # str input with an <?xml encoding=...?> declaration, or an empty / whitespace-only document
+        return _stream_text(raw_html)
+    etree.strip_elements(root, *SKIP_TAGS, etree.Comment, with_tail=False)
+    return ' '.join(root.itertext())
+
+
+class _StreamText(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0     # inside script/style
+        self.in_link = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skip_depth += 1
+        elif tag in LINK_BREAKING_TAGS:
+            self.in_link = tag == 'a'
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style'):
+            if self.skip_depth:
+                self.skip_depth -= 1
+        elif tag in LINK_BREAKING_TAGS:
+            self.in_link = False
+
+    def handle_data(self, data):
+        if not self.skip_depth and not self.in_link:
+            self.parts.append(data)
+
+
+def _stream_text(raw_html: str) -> str:
+    parser = _StreamText()
+    parser.feed(raw_html)
+    parser.close()
+    return ' '.join(parser.parts)
+
+
+ENGINES = {"bs4": _bs4_text, "stream": _stream_text}
+if lxml:
+    ENGINES["lxml"] = _lxml_text
+
+
+def html_to_text(raw_html: str, engine: str = None, max_chars: int = MAX_HTML_CHARS) -> str:
+    """Visible text of raw_html with links, images, scripts, styles and URLs removed; input capped at max_chars."""
+    if not raw_html:
+        return ""
+    if max_chars and len(raw_html) > max_chars:
+        raw_html = raw_html[:max_chars]
+    extract = ENGINES.get(engine or DEFAULT_ENGINE, _stream_text)
+    return normalize_text(extract(raw_html))
+
+
+# ---------------- benchmark ----------------
+def _corpus_html(path: str):
+    """Yield HTML bodies from .eml files and Gmail API message/payload .json dumps under path."""
+    from base64 import urlsafe_b64decode
+
+    def from_payload(part):
+        if part.get('mimeType') == 'text/html' and part.get('body', {}).get('data'):
+            yield urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
+        for sub in part.get('parts') or []:
+            yield from from_payload(sub)
+
+    for root, _, files in os.walk(path):
+        for name in files:
+            full = os.path.join(root, name)
+            if name.endswith('.eml'):
+                with open(full, 'rb') as f:
+                    msg = email.message_from_binary_file(f)
+                for part in msg.walk():
+                    if part.get_content_type() == 'text/html':
+                        payload = part.get_payload(decode=True) or b''
+                        yield payload.decode(part.get_content_charset() or 'utf-8', errors='ignore')
+            elif name.endswith('.json'):
+                with open(full) as f:
+                    data = json.load(f)
+                yield from from_payload(data.get('payload', data))
+
+
+def benchmark(path: str, repeat: int = 3) -> dict:
+    docs = list(_corpus_html(path))
+    total_bytes = sum(len(d) for d in docs)
+    results = {}
+    for name, fn in ENGINES.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for d in docs:
+                normalize_text(fn(d[:MAX_HTML_CHARS]))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = {"seconds": round(best, 4), "mb_per_s": round(total_bytes / 1e6 / best, 2) if best else None}
+    print(f"[INFO] {len(docs)} HTML bodies, {total_bytes / 1e6:.1f} MB")
+    for name, r in sorted(results.items(), key=lambda kv: kv[1]["seconds"]):
+        print(f"  {name:7s} {r['seconds']:8.4f}s  {r['mb_per_s']} MB/s")
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python -m MAILFETCHING.bodytext <corpus dir of .eml / Gmail .json payloads>")
+        sys.exit(1)
+    benchmark(sys.argv[1])
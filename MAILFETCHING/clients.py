@@ -0,0 +1,200 @@
+# clients.py
+# Per-user pool of Google API service objects built from the packaged (static) discovery docs,
+# each with its own keep-alive HTTP transport. Refreshed tokens are written back to gmail_auth.tokens.
+# Credentials are stored as Credentials.to_json() in creds_json; decoded objects are cached per user
+# and reused until the stored doc's updated_at changes; callers get their own copy, since refresh
+# mutates a Credentials object in place. Legacy pickled creds_b64 docs are read once
+# and rewritten as JSON.
+import os
+import copy
+import json
+import time
+import pickle
+import base64
+import datetime
+import threading
+from contextlib import contextmanager
+
+import httplib2
+import google_auth_httplib2
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+
+import storage
+
+POOL_TTL_SECONDS = int(os.getenv("GOOGLE_CLIENT_POOL_TTL", "900"))
+HTTP_TIMEOUT = int(os.getenv("GOOGLE_HTTP_TIMEOUT", "60"))
+
+_pool_lock = threading.Lock()
+_pool = {}          # (user_id, api) -> {"service", "creds", "lock", "last_used"}
+_discovery = {}     # (api, version) -> parsed discovery document
+_creds_lock = threading.Lock()
+_creds_cache = {}   # user_id -> (updated_at, Credentials)
+CREDS_FIELDS = {"user_id": 1, "creds_json": 1, "creds_b64": 1, "updated_at": 1}
+stats = {"hits": 0, "misses": 0, "evictions": 0, "refreshes": 0, "persisted": 0,
+         "creds_cache_hits": 0, "creds_decodes": 0, "creds_upgraded": 0}
+
+
+# ---------------- Credential encoding ----------------
+def mongo_now() -> datetime.datetime:
+    """utcnow truncated to milliseconds, so it compares equal to the value read back from Mongo."""
+    now = datetime.datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def creds_to_json(creds: Credentials) -> str:
+    return creds.to_json()
+
+def creds_from_json(raw: str) -> Credentials:
+    info = json.loads(raw)
+    return Credentials.from_authorized_user_info(info, scopes=info.get("scopes"))
+
+def _creds_from_legacy_b64(b64: str) -> Credentials:
+    # only for docs written before creds_json; never used for new data
+    return pickle.loads(base64.b64decode(b64.encode()))
+
+def has_creds(doc) -> bool:
+    return bool(doc and (doc.get("creds_json") or doc.get("creds_b64")))
+
+def creds_from_doc(doc) -> Credentials:
+    """
+    Decoded credentials for a tokens doc, reusing the cached decode while updated_at is unchanged.
+    Every call returns a private copy: the cached object is never handed out, so one thread's
+    refresh can't change the token another thread is sending.
+    Raises ValueError when the doc carries no credentials.
+    """
+    user_id, updated_at = doc.get("user_id"), doc.get("updated_at")
+    with _creds_lock:
+        cached = _creds_cache.get(user_id)
+        if cached and updated_at is not None and cached[0] == updated_at:
+            stats["creds_cache_hits"] += 1
+            return copy.copy(cached[1])
+
+    if doc.get("creds_json"):
+        creds = creds_from_json(doc["creds_json"])
+    elif doc.get("creds_b64"):
+        creds = _creds_from_legacy_b64(doc["creds_b64"])
+        if user_id:
+            updated_at = persist_creds(user_id, creds)
+            stats["creds_upgraded"] += 1
+    else:
+        raise ValueError(f"no stored credentials for {user_id}")
+    with _creds_lock:
+        stats["creds_decodes"] += 1
+        if user_id and updated_at is not None:
+            _creds_cache[user_id] = (updated_at, copy.copy(creds))
+    return creds
+
+def load_creds(user_id: str):
+    """Credentials for user_id from gmail_auth.tokens (cached), or None."""
+    doc = storage.tokens_collection.find_one({"user_id": user_id}, CREDS_FIELDS)
+    if not has_creds(doc):
+        return None
+    return creds_from_doc(doc)
+
+def persist_creds(user_id: str, creds: Credentials):
+    """Write a refreshed token back so the next tick (or worker) doesn't refresh again. Returns updated_at."""
+    now = mongo_now()
+    try:
+        storage.tokens_collection.update_one(
+            {"user_id": user_id},
+            {"$set": {"creds_json": creds_to_json(creds), "updated_at": now}, "$unset": {"creds_b64": ""}}
+        )
+        stats["persisted"] += 1
+    except Exception as e:
+        print(f"[ERROR] persist_creds for {user_id}: {e}")
+        return None
+    with _creds_lock:
+        # the caller keeps refreshing its own object; cache a snapshot of this token
+        _creds_cache[user_id] = (now, copy.copy(creds))
+    return now
+
+
+# ---------------- Service construction ----------------
+def _discovery_doc(api: str, version: str):
+    key = (api, version)
+    if key not in _discovery:
+        doc = get_static_doc(api, version)
+        _discovery[key] = json.loads(doc) if doc else None
+    return _discovery[key]
+
+def build_service(api: str, version: str, creds: Credentials):
+    """Build a client over a dedicated keep-alive transport, parsing the discovery doc only once per process."""
+    http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+    doc = _discovery_doc(api, version)
+    if doc:
+        return build_from_document(doc, http=http)
+    return build(api, version, http=http, static_discovery=True, cache_discovery=False)
+
+def refresh_if_needed(creds: Credentials, user_id: str = None) -> bool:
+    """Refresh an expired token; persists it when user_id is given. Returns True if refreshed."""
+    if not (creds and creds.expired and creds.refresh_token):
+        return False
+    try:
+        creds.refresh(Request())
+    except Exception as e:
+        # non-fatal; caller will observe API errors and can re-auth if needed
+        print(f"[WARN] token refresh failed for {user_id}: {e}")
+        return False
+    stats["refreshes"] += 1
+    if user_id:
+        persist_creds(user_id, creds)
+    return True
+
+
+# ---------------- Pool ----------------
+def evict_expired(now: float = None) -> int:
+    now = now or time.monotonic()
+    with _pool_lock:
+        stale = [k for k, e in _pool.items() if now - e["last_used"] > POOL_TTL_SECONDS and not e["lock"].locked()]
+        for k in stale:
+            del _pool[k]
+        stats["evictions"] += len(stale)
+    return len(stale)
+
+def drop_user(user_id: str) -> None:
+    with _pool_lock:
+        for k in [k for k in _pool if k[0] == user_id]:
+            del _pool[k]
+
+def _checkout(user_id: str, creds: Credentials, api: str, version: str):
+    key = (user_id, api)
+    with _pool_lock:
+        entry = _pool.get(key)
+        # a re-login hands us a different grant; don't keep serving the old one
+        if entry and entry["creds"].refresh_token == creds.refresh_token:
+            stats["hits"] += 1
+            return entry
+        stats["misses"] += 1
+        entry = {"service": None, "creds": creds, "lock": threading.Lock(), "last_used": time.monotonic()}
+        _pool[key] = entry
+    return entry
+
+@contextmanager
+def pooled_service(user_id: str, creds: Credentials, api: str = 'gmail', version: str = 'v1'):
+    """
+    Yield the user's cached service for api/version, building it on first use.
+    The entry is held exclusively for the duration (httplib2 transports are not thread-safe).
+    """
+    evict_expired()
+    entry = _checkout(user_id, creds, api, version)
+    with entry["lock"]:
+        pooled_creds = entry["creds"]
+        refresh_if_needed(pooled_creds, user_id)
+        token_before = pooled_creds.token
+        if entry["service"] is None:
+            entry["service"] = build_service(api, version, pooled_creds)
+        try:
+            yield entry["service"]
+        finally:
+            entry["last_used"] = time.monotonic()
+            # AuthorizedHttp refreshes on 401 by itself; keep the stored copy in step
+            if pooled_creds.token != token_before:
+                persist_creds(user_id, pooled_creds)
+
+def get_stats() -> dict:
+    with _pool_lock:
+        snapshot = dict(stats)
+        snapshot["pooled"] = len(_pool)
+    return snapshot
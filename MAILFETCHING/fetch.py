@@ -1,46 +1,51 @@
 # fetch.py
 import os
 import re
-import pickle
-import base64
+import time
+import random
 import datetime
 from base64 import urlsafe_b64decode
 from typing import Optional, List, Tuple
 
-from bs4 import BeautifulSoup
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import Flow
-from pymongo import MongoClient
 from dotenv import load_dotenv
 
+import storage
+from MAILFETCHING import clients, bodytext
+
 load_dotenv()
 
-MONGO_URI = os.getenv("mongo_uri")
 CLIENT_SECRETS_FILE = os.getenv("CLIENT_SECRETS_FILE", "credentials.json")
 REDIRECT_URI = os.getenv("REDIRECT_URI", "https://mailmind-q3lx.onrender.com/oauth2callback")
 
+# batch: one batch HTTP request per 100 messages (default)
+# metadata: like batch, plus an opt-in format='metadata' pass (one more round trip per batch) so
+#           unstored messages read since they were listed are not downloaded in full
+# serial: one messages().get round-trip per message
+FETCH_MODE = os.getenv("GMAIL_FETCH_MODE", "batch")
+# incremental: users.history.list from the stored historyId; full: re-run the unread search every tick
+SYNC_MODE = os.getenv("GMAIL_SYNC_MODE", "incremental")
+SKIP_LABELS = {'TRASH', 'DRAFT', 'SPAM'}
+BATCH_SIZE = 100
+BATCH_MAX_RETRIES = 3
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.modify',
     'https://www.googleapis.com/auth/calendar'
 ]
 
 # Mongo
-_client = MongoClient(MONGO_URI)
-db = _client['Emails']
-tokens_collection = _client['gmail_auth']['tokens']
+tokens_collection = storage.tokens_collection
 
 # ---------------- Utilities ----------------
 def sanitize_email_for_collection(email: str) -> str:
     return email.replace("@", "at").replace(".", "dot")
 
-def creds_to_b64(creds: Credentials) -> str:
-    return base64.b64encode(pickle.dumps(creds)).decode()
-
-def creds_from_b64(b64: str) -> Credentials:
-    return pickle.loads(base64.b64decode(b64.encode()))
+creds_to_json = clients.creds_to_json
+creds_from_json = clients.creds_from_json
 
 # ---------------- OAuth helpers ----------------
 def authenticate_user() -> Optional[str]:
@@ -58,7 +63,7 @@ def exchange_code_for_user(code: str) -> Tuple[Optional[str], Optional[Credentia
         flow.fetch_token(code=code)
         creds: Credentials = flow.credentials
 
-        gmail_service = build('gmail', 'v1', credentials=creds)
+        gmail_service = clients.build_service('gmail', 'v1', creds)
         profile = gmail_service.users().getProfile(userId='me').execute()
         email = profile.get("emailAddress", "unknown")
         user_id = sanitize_email_for_collection(email)
@@ -78,9 +83,9 @@ def save_token_to_db(email: str, user_id: str, creds: Credentials) -> None:
             {"$set": {
                 "user_id": user_id,
                 "email": email,
-                "creds_b64": creds_to_b64(creds),
-                "updated_at": datetime.datetime.utcnow()
-            }},
+                "creds_json": creds_to_json(creds),
+                "updated_at": clients.mongo_now()
+            }, "$unset": {"creds_b64": ""}},
             upsert=True
         )
     except Exception as e:
@@ -88,11 +93,10 @@ def save_token_to_db(email: str, user_id: str, creds: Credentials) -> None:
 
 def load_token_from_db_by_userid(user_id: str) -> Tuple[Optional[Credentials], Optional[str]]:
     try:
-        doc = tokens_collection.find_one({"user_id": user_id})
-        if not doc or "creds_b64" not in doc:
+        doc = tokens_collection.find_one({"user_id": user_id}, {**clients.CREDS_FIELDS, "email": 1})
+        if not clients.has_creds(doc):
             return None, None
-        creds = creds_from_b64(doc["creds_b64"])
-        return creds, doc.get("email")
+        return clients.creds_from_doc(doc), doc.get("email")
     except Exception as e:
         print(f"[ERROR] load_token_from_db_by_userid: {e}")
         return None, None
@@ -100,81 +104,267 @@ def load_token_from_db_by_userid(user_id: str) -> Tuple[Optional[Credentials], O
 # ---------------- Cleaning helpers ----------------
 def clean_full_text(raw_html: str) -> str:
     try:
-        soup = BeautifulSoup(raw_html, 'html.parser')
-        for tag in soup(['script', 'style', 'img', 'a']):
-            tag.decompose()
-        text = soup.get_text(separator=' ')
-        text = re.sub(r'https?://\S+', '', text)
-        text = re.sub(r'\s+', ' ', text)
-        return text.strip()
+        return bodytext.html_to_text(raw_html)
     except Exception:
         return "(Clean failed)"
 
-def extract_plain_text(payload: dict) -> str:
+# bytes of a text/plain part worth decoding; HTML parts get bodytext.MAX_HTML_CHARS
+MAX_PLAIN_BYTES = int(os.getenv("BODY_MAX_PLAIN_BYTES", "32768"))
+
+def _header(part: dict, name: str) -> str:
+    name = name.lower()
+    return next((h.get('value', '') for h in part.get('headers') or [] if h.get('name', '').lower() == name), '')
+
+def _is_attachment(part: dict) -> bool:
+    body = part.get('body') or {}
+    return bool(part.get('filename')) or ('attachmentId' in body and not body.get('data')) \
+        or _header(part, 'Content-Disposition').lower().startswith('attachment')
+
+def select_body_part(payload: dict) -> Optional[dict]:
+    """
+    Walk the full MIME tree (any depth: multipart/mixed, alternative, related, ...) without decoding
+    anything and return the best inline text part: the first text/plain, else the first text/html.
+    """
+    html_part = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        mime = (part.get('mimeType') or '').lower()
+        if mime.startswith('multipart/'):
+            # keep document order
+            stack.extend(reversed(part.get('parts') or []))
+            continue
+        if _is_attachment(part) or not (part.get('body') or {}).get('data'):
+            continue
+        if mime == 'text/plain':
+            return part
+        if mime == 'text/html' and html_part is None:
+            html_part = part
+    return html_part
+
+def decode_part(part: dict, max_bytes: int) -> Tuple[str, bool]:
+    """Base64url-decode at most max_bytes of a part's body. Returns (text, truncated)."""
+    data = part['body']['data']
+    truncated = False
+    max_chars = (max_bytes // 3 + 1) * 4
+    if len(data) > max_chars:
+        data, truncated = data[:max_chars], True
+    data += '=' * (-len(data) % 4)
+    raw = urlsafe_b64decode(data)
+    charset = 'utf-8'
+    m = re.search(r'charset="?([\w.-]+)', _header(part, 'Content-Type'), re.IGNORECASE)
+    if m:
+        charset = m.group(1)
+    try:
+        return raw.decode(charset, errors='ignore'), truncated
+    except LookupError:
+        return raw.decode('utf-8', errors='ignore'), truncated
+
+def extract_body(payload: dict) -> Tuple[str, Optional[dict]]:
+    """Return (clean text, info about the chosen part) for a Gmail message payload."""
     try:
         if not payload:
-            return "(No payload)"
-        # prefer text/plain or text/html parts
-        if 'parts' in payload:
-            for part in payload['parts']:
-                mime = part.get('mimeType', '')
-                data = part.get('body', {}).get('data')
-                if data and mime in ['text/plain', 'text/html']:
-                    decoded = urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-                    return clean_full_text(decoded)
-            # deeper exploration
-            for part in payload['parts']:
-                subparts = part.get('parts') or []
-                for sp in subparts:
-                    data = sp.get('body', {}).get('data')
-                    if data:
-                        decoded = urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-                        return clean_full_text(decoded)
+            return "(No payload)", None
+        part = select_body_part(payload)
+        if part is None:
+            return "(No clean text found)", None
+        mime = part.get('mimeType', '').lower()
+        if mime == 'text/plain':
+            text, truncated = decode_part(part, MAX_PLAIN_BYTES)
+            text = bodytext.normalize_text(text)
         else:
-            mime = payload.get('mimeType', '')
-            data = payload.get('body', {}).get('data')
-            if data and mime in ['text/plain', 'text/html']:
-                decoded = urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-                return clean_full_text(decoded)
-        return "(No clean text found)"
+            html, truncated = decode_part(part, bodytext.MAX_HTML_CHARS)
+            text = clean_full_text(html)
+        info = {
+            "part_id": part.get('partId'),
+            "mime_type": mime,
+            "size": (part.get('body') or {}).get('size'),
+            "truncated": truncated,
+        }
+        return text or "(No clean text found)", info
     except Exception:
-        return "(Extraction failed)"
+        return "(Extraction failed)", None
+
+def extract_plain_text(payload: dict) -> str:
+    return extract_body(payload)[0]
 
 # ---------------- Credential maintenance ----------------
-def ensure_creds_valid(creds: Credentials) -> Credentials:
+def ensure_creds_valid(creds: Credentials, user_id: str = None) -> Credentials:
     """
     Refresh creds if expired and refresh_token available.
+    With user_id the refreshed token is written back to tokens_collection.
     Returns the (possibly refreshed) creds.
     """
-    try:
-        if creds and creds.expired and creds.refresh_token:
-            request = Request()
-            creds.refresh(request)
-    except Exception as e:
-        # non-fatal; caller will observe Gmail API errors and can re-auth if needed
-        print(f"[WARN] ensure_creds_valid: refresh attempt failed: {e}")
+    clients.refresh_if_needed(creds, user_id)
     return creds
 
+# ---------------- Gmail batch helpers ----------------
+fetch_stats = {"round_trips": 0, "messages_fetched": 0, "subrequest_retries": 0,
+               "metadata_round_trips": 0, "metadata_skipped": 0}
+
+def _is_retryable(exc) -> bool:
+    if isinstance(exc, HttpError):
+        return getattr(exc.resp, "status", None) in RETRYABLE_STATUS
+    return True
+
+def batch_get_messages(service, msg_ids: List[str], fmt: str = 'full',
+                       metadata_headers: Optional[List[str]] = None,
+                       max_retries: int = BATCH_MAX_RETRIES, verbose: bool = False,
+                       failed_ids: Optional[List[str]] = None) -> List[dict]:
+    """
+    Fetch messages with the Gmail batch endpoint, BATCH_SIZE sub-requests per HTTP call.
+    Sub-requests failing with 429/5xx are re-batched with exponential backoff.
+    Returns message resources in the order of msg_ids (missing ones are dropped).
+    Ids still failing after max_retries are appended to failed_ids; permanent errors
+    (e.g. 404 for a deleted message) are not, since retrying them cannot help.
+    """
+    results = {}
+    pending = list(dict.fromkeys(msg_ids))
+    attempt = 0
+    while pending:
+        failed = []
+
+        def _callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif _is_retryable(exception):
+                failed.append(request_id)
+            elif verbose:
+                print(f"[WARN] Could not fetch message {request_id}: {exception}")
+
+        for i in range(0, len(pending), BATCH_SIZE):
+            chunk = pending[i:i + BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=_callback)
+            for mid in chunk:
+                kwargs = {"userId": 'me', "id": mid, "format": fmt}
+                if fmt == 'metadata' and metadata_headers:
+                    kwargs["metadataHeaders"] = metadata_headers
+                batch.add(service.users().messages().get(**kwargs), request_id=mid)
+            fetch_stats["round_trips"] += 1
+            try:
+                batch.execute()
+            except Exception as e:
+                if verbose:
+                    print(f"[WARN] batch request failed ({len(chunk)} msgs): {e}")
+                failed.extend(m for m in chunk if m not in results and m not in failed)
+
+        if not failed:
+            break
+        attempt += 1
+        if attempt > max_retries:
+            print(f"[WARN] giving up on {len(failed)} messages after {max_retries} retries")
+            if failed_ids is not None:
+                failed_ids.extend(failed)
+            break
+        fetch_stats["subrequest_retries"] += len(failed)
+        time.sleep(min(30, 2 ** attempt) + random.random())
+        pending = failed
+
+    fetch_stats["messages_fetched"] += len(results)
+    return [results[m] for m in msg_ids if m in results]
+
+def serial_get_messages(service, msg_ids: List[str], verbose: bool = False,
+                        failed_ids: Optional[List[str]] = None) -> List[dict]:
+    messages_full = []
+    for mid in msg_ids:
+        fetch_stats["round_trips"] += 1
+        try:
+            messages_full.append(service.users().messages().get(userId='me', id=mid, format='full').execute())
+        except Exception as e:
+            if verbose:
+                print(f"[WARN] Could not fetch message {mid}: {e}")
+            if failed_ids is not None and _is_retryable(e):
+                failed_ids.append(mid)
+    fetch_stats["messages_fetched"] += len(messages_full)
+    return messages_full
+
+# ---------------- Message ingestion ----------------
+def ingest_message_ids(service, user_id: str, msg_ids: List[str], mode: str = None, verbose: bool = False,
+                       failed_ids: Optional[List[str]] = None) -> List[dict]:
+    """
+    Download and store the given Gmail message IDs for a user, skipping ones already stored.
+    Returns [{'msg_id', 'subject'}, ...] for the inserted docs; ids that could not be
+    downloaded (transient errors) are appended to failed_ids.
+    """
+    mode = mode or FETCH_MODE
+    inserted = []
+    if not msg_ids:
+        return inserted
+
+    # dedupe against what is already stored (one query for the whole page)
+    stored = storage.stored_msg_ids(user_id, msg_ids)
+    new_ids = [mid for mid in msg_ids if mid not in stored]
+
+    if mode == 'metadata' and new_ids:
+        # headers-only pass; messages whose metadata could not be fetched still get the full fetch
+        before = fetch_stats["round_trips"]
+        metas = batch_get_messages(service, new_ids, fmt='metadata', metadata_headers=['Subject'], verbose=verbose)
+        fetch_stats["metadata_round_trips"] += fetch_stats["round_trips"] - before
+        read = {m['id'] for m in metas if 'UNREAD' not in (m.get('labelIds') or ['UNREAD'])}
+        fetch_stats["metadata_skipped"] += len(read)
+        new_ids = [mid for mid in new_ids if mid not in read]
+
+    # Fetch full message bodies
+    if mode == 'serial':
+        messages_full = serial_get_messages(service, new_ids, verbose=verbose, failed_ids=failed_ids)
+    else:
+        messages_full = batch_get_messages(service, new_ids, fmt='full', verbose=verbose, failed_ids=failed_ids)
+
+    # Sort newest-first
+    messages_full.sort(key=lambda m: int(m.get('internalDate', 0)), reverse=True)
+
+    docs = []
+    for msg_data in messages_full:
+        msg_id = msg_data.get('id')
+        if not msg_id:
+            continue
+
+        headers = msg_data.get('payload', {}).get('headers', [])
+        subject = next((h.get('value') for h in headers if h.get('name', '').lower() == 'subject'), "(No Subject)")
+        body, body_part = extract_body(msg_data.get('payload'))
+
+        docs.append({
+            "subject": subject,
+            "body": body,
+            "body_part": body_part,
+            "msg_id": msg_id,
+            "fetched_at": datetime.datetime.utcnow(),
+            "processed": False
+        })
+
+    # unique msg_id index turns concurrent duplicates into skipped writes
+    for doc in storage.insert_emails(user_id, docs):
+        inserted.append({"msg_id": doc["msg_id"], "subject": doc["subject"][:120]})
+
+    return inserted
+
 # ---------------- Core: fetch only unread, newest-first ----------------
-def get_unread_emails(creds: Credentials, user_id: str, limit: int = 10, page_token: str = None, verbose: bool = True):
+def get_unread_emails(creds: Credentials, user_id: str, limit: int = 10, page_token: str = None,
+                      verbose: bool = True, service=None, mode: str = None):
     """
     Fetch a batch of unread emails for the user.
-    Returns dict: { 'inserted': [...], 'next_page_token': '...' }
+    service: optional pre-built Gmail client (or a local stub); mode overrides FETCH_MODE.
+    Returns dict: { 'inserted': [...], 'next_page_token': '...', 'failed': [ids not downloaded] },
+    plus 'error' (a message) when the listing itself or the service could not be used.
     """
     inserted = []
     next_page_token = None
 
-    if not creds:
-        if verbose:
-            print("[WARN] get_unread_emails called with no credentials")
-        return {"inserted": inserted, "next_page_token": None}
+    mode = mode or FETCH_MODE
 
-    creds = ensure_creds_valid(creds)
-    try:
-        service = build('gmail', 'v1', credentials=creds)
-    except Exception as e:
-        print(f"[ERROR] could not build service: {e}")
-        return {"inserted": inserted, "next_page_token": None}
+    if service is None:
+        if not creds:
+            if verbose:
+                print("[WARN] get_unread_emails called with no credentials")
+            return {"inserted": inserted, "next_page_token": None, "error": "no credentials"}
+
+        try:
+            with clients.pooled_service(user_id, creds, 'gmail', 'v1') as service:
+                return get_unread_emails(creds, user_id, limit=limit, page_token=page_token,
+                                         verbose=verbose, service=service, mode=mode)
+        except Exception as e:
+            print(f"[ERROR] could not build service: {e}")
+            return {"inserted": inserted, "next_page_token": None, "error": str(e)}
 
     q = 'is:unread -label:trash -label:drafts'
 
@@ -186,6 +376,7 @@ def get_unread_emails(creds: Credentials, user_id: str, limit: int = 10, page_to
             maxResults=limit,
             pageToken=page_token
         ).execute()
+        fetch_stats["round_trips"] += 1
 
         msg_refs = resp.get('messages', [])
         next_page_token = resp.get('nextPageToken')
@@ -195,51 +386,129 @@ def get_unread_emails(creds: Credentials, user_id: str, limit: int = 10, page_to
                 print("[INFO] No unread messages found.")
             return {"inserted": inserted, "next_page_token": None}
 
-        # Fetch full message bodies
-        messages_full = []
-        for mr in msg_refs:
-            mid = mr.get('id')
-            try:
-                full = service.users().messages().get(userId='me', id=mid, format='full').execute()
-                messages_full.append(full)
-            except Exception as e:
-                if verbose:
-                    print(f"[WARN] Could not fetch message {mid}: {e}")
-
-        # Sort newest-first
-        messages_full.sort(key=lambda m: int(m.get('internalDate', 0)), reverse=True)
+        msg_ids = [mr.get('id') for mr in msg_refs if mr.get('id')]
+        failed = []
+        inserted = ingest_message_ids(service, user_id, msg_ids, mode=mode, verbose=verbose, failed_ids=failed)
+        return {"inserted": inserted, "next_page_token": next_page_token, "failed": failed}
 
-        col = db[user_id]
-        for msg_data in messages_full:
-            msg_id = msg_data.get('id')
-            if not msg_id:
-                continue
-
-            # dedupe
-            if col.find_one({"msg_id": msg_id}, {"_id": 1}):
-                continue
-
-            headers = msg_data.get('payload', {}).get('headers', [])
-            subject = next((h.get('value') for h in headers if h.get('name', '').lower() == 'subject'), "(No Subject)")
-            body = extract_plain_text(msg_data.get('payload'))
+    except Exception as e:
+        print(f"[ERROR] get_unread_emails: {e}")
+        return {"inserted": inserted, "next_page_token": None, "error": str(e)}
 
-            doc = {
-                "subject": subject,
-                "body": body,
-                "msg_id": msg_id,
-                "fetched_at": datetime.datetime.utcnow(),
-                "processed": False
-            }
 
-            try:
-                col.insert_one(doc)
-                inserted.append({"msg_id": msg_id, "subject": subject[:120]})
-            except Exception as e:
-                print(f"[ERROR] insert failed for msg {msg_id}: {e}")
+# ---------------- Incremental sync (historyId) ----------------
+def save_history_id(user_id: str, history_id) -> None:
+    try:
+        tokens_collection.update_one({"user_id": user_id}, {"$set": {"history_id": str(history_id)}})
+    except Exception as e:
+        print(f"[ERROR] save_history_id: {e}")
 
-        return {"inserted": inserted, "next_page_token": next_page_token}
+def list_history_additions(service, start_history_id: str) -> Tuple[List[str], Optional[str]]:
+    """
+    Page through users.history.list for messageAdded events since start_history_id.
+    Returns (unread message ids, latest historyId). Raises HttpError 404 when the id has expired.
+    """
+    msg_ids = []
+    latest = start_history_id
+    page_token = None
+    while True:
+        resp = service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded'],
+            pageToken=page_token
+        ).execute()
+        fetch_stats["round_trips"] += 1
+
+        for h in resp.get('history', []):
+            for added in h.get('messagesAdded', []):
+                msg = added.get('message', {})
+                labels = set(msg.get('labelIds') or [])
+                if msg.get('id') and 'UNREAD' in labels and not labels & SKIP_LABELS:
+                    msg_ids.append(msg['id'])
+        latest = resp.get('historyId', latest)
+        page_token = resp.get('nextPageToken')
+        if not page_token:
+            break
+    return list(dict.fromkeys(msg_ids)), latest
+
+def sync_mailbox(creds: Credentials, user_id: str, limit: int = 10, verbose: bool = True, service=None,
+                 history_id: Optional[str] = None):
+    """
+    Pull new unread mail for a user.
+    With a stored historyId only the additions since the last sync are listed; without one
+    (or when Gmail reports the id as expired) this falls back to a full unread listing and
+    records the mailbox's current historyId for the next call.
+    The full listing pages through every unread message (limit per page) before the cursor is set.
+    The stored historyId only advances when every listed message was downloaded; otherwise the
+    next call lists the same additions again (stored ones are skipped) and retries the rest.
+    Returns the same dict shape as get_unread_emails, plus 'sync': 'incremental' | 'full';
+    'error' is set when the mailbox could not be listed (the caller's poll failed).
+    """
+    if service is None:
+        if not creds:
+            return {"inserted": [], "next_page_token": None, "sync": None, "error": "no credentials"}
+        try:
+            with clients.pooled_service(user_id, creds, 'gmail', 'v1') as service:
+                return sync_mailbox(creds, user_id, limit=limit, verbose=verbose, service=service,
+                                    history_id=history_id)
+        except Exception as e:
+            print(f"[ERROR] could not build service: {e}")
+            return {"inserted": [], "next_page_token": None, "sync": None, "error": str(e)}
+
+    if history_id is None:
+        doc = tokens_collection.find_one({"user_id": user_id}, {"history_id": 1})
+        history_id = (doc or {}).get("history_id")
+
+    if SYNC_MODE == "incremental" and history_id:
+        try:
+            msg_ids, latest = list_history_additions(service, history_id)
+            failed = []
+            inserted = ingest_message_ids(service, user_id, msg_ids, verbose=verbose, failed_ids=failed)
+            if failed:
+                print(f"[WARN] {len(failed)} messages not downloaded for {user_id}; keeping historyId {history_id}")
+            elif latest != history_id:
+                save_history_id(user_id, latest)
+            if verbose:
+                print(f"[INFO] incremental sync for {user_id}: {len(msg_ids)} added, {len(inserted)} inserted")
+            return {"inserted": inserted, "next_page_token": None, "sync": "incremental", "failed": failed}
+        except HttpError as e:
+            if getattr(e.resp, "status", None) != 404:
+                print(f"[ERROR] history.list failed for {user_id}: {e}")
+                return {"inserted": [], "next_page_token": None, "sync": "incremental", "error": str(e)}
+            if verbose:
+                print(f"[INFO] historyId expired for {user_id}, falling back to full sync")
+        except Exception as e:
+            print(f"[ERROR] incremental sync failed for {user_id}: {e}")
+            return {"inserted": [], "next_page_token": None, "sync": "incremental", "error": str(e)}
 
+    # full listing; grab the historyId first so nothing arriving during the listing is missed
+    latest = None
+    try:
+        latest = service.users().getProfile(userId='me').execute().get('historyId')
+        fetch_stats["round_trips"] += 1
     except Exception as e:
-        print(f"[ERROR] get_unread_emails: {e}")
-        return {"inserted": inserted, "next_page_token": None}
-
+        print(f"[WARN] getProfile failed for {user_id}: {e}")
+
+    # the cursor skips everything already in the mailbox, so every unread page is ingested first
+    result = {"inserted": [], "next_page_token": None, "failed": [], "sync": "full"}
+    page_token = None
+    while True:
+        page = get_unread_emails(creds, user_id, limit=limit, page_token=page_token, verbose=verbose,
+                                 service=service)
+        result["inserted"].extend(page["inserted"])
+        result["failed"].extend(page.get("failed", []))
+        if page.get("error"):
+            result["error"] = page["error"]
+            break
+        page_token = page.get("next_page_token")
+        if not page_token:
+            break
+
+    if result.get("error"):
+        print(f"[WARN] unread listing failed for {user_id}; historyId not advanced")
+    elif result["failed"]:
+        print(f"[WARN] {len(result['failed'])} messages not downloaded for {user_id}; historyId not advanced")
+    elif latest:
+        save_history_id(user_id, latest)
+    return result
@@ -0,0 +1,207 @@
+# push.py
+# Push ingestion: Gmail users.watch publishes a notification to a Pub/Sub topic whenever a
+# mailbox changes; Pub/Sub pushes it to /gmail/push, which only marks that user dirty.
+# The scheduler drains the dirty set every few seconds and runs the normal incremental sync
+# for those users alone. Bursts of notifications for one mailbox collapse into one sync.
+#
+# Local stand-in for Pub/Sub (no GCP needed):
+#   python -m MAILFETCHING.push notify <email> [historyId] [--url http://localhost:5000/gmail/push]
+import os
+import sys
+import json
+import time
+import base64
+import datetime
+import threading
+import urllib.request
+from typing import Optional, Tuple
+
+from google.oauth2.credentials import Credentials
+
+from MAILFETCHING import clients
+from MAILFETCHING.fetch import sanitize_email_for_collection
+import storage
+
+PUSH_TOPIC = os.getenv("GMAIL_PUSH_TOPIC")             # projects/<project>/topics/<topic>
+PUSH_TOKEN = os.getenv("GMAIL_PUSH_TOKEN")             # shared secret on the push subscription URL (?token=)
+WATCH_LABELS = [l for l in os.getenv("GMAIL_WATCH_LABELS", "INBOX").split(",") if l]
+# Gmail expires a watch after 7 days; renew anything expiring within this window
+WATCH_RENEW_BEFORE = datetime.timedelta(hours=float(os.getenv("GMAIL_WATCH_RENEW_HOURS", "24")))
+
+tokens_collection = storage.tokens_collection
+
+_lock = threading.Lock()
+_dirty = {}   # user_id -> highest notified historyId
+stats = {
+    "received": 0,
+    "accepted": 0,
+    "coalesced": 0,       # notification for a user already waiting in the dirty set
+    "stale": 0,           # historyId not newer than the last sync
+    "rejected": 0,
+    "drained_users": 0,
+    "watches_registered": 0,
+    "watch_errors": 0,
+    "last_notification_at": None,
+}
+
+
+def _bump(key, n=1):
+    with _lock:
+        stats[key] += n
+
+
+# ---------------- Notifications ----------------
+def parse_notification(envelope: dict) -> Tuple[Optional[str], Optional[int]]:
+    """Pub/Sub push envelope -> (emailAddress, historyId); (None, None) if malformed."""
+    try:
+        data = json.loads(base64.b64decode(envelope["message"]["data"]))
+        return data["emailAddress"], int(data["historyId"])
+    except Exception:
+        return None, None
+
+
+def handle_notification(envelope: dict, token: str = None) -> str:
+    """
+    Record one push. Returns "accepted", "coalesced", "stale", "unknown_user", "bad_token" or "malformed".
+    Only "bad_token" should be answered with an error status (anything non-2xx makes Pub/Sub redeliver).
+    """
+    _bump("received")
+    if PUSH_TOKEN and token != PUSH_TOKEN:
+        _bump("rejected")
+        return "bad_token"
+    email, history_id = parse_notification(envelope)
+    if not email:
+        _bump("rejected")
+        return "malformed"
+
+    user_id = sanitize_email_for_collection(email)
+    doc = tokens_collection.find_one({"user_id": user_id}, {"history_id": 1})
+    if not doc:
+        _bump("rejected")
+        return "unknown_user"
+    try:
+        synced = int(doc.get("history_id") or 0)
+    except ValueError:
+        synced = 0
+    with _lock:
+        stats["last_notification_at"] = time.time()
+        if history_id <= synced:
+            stats["stale"] += 1
+            return "stale"
+        coalesced = user_id in _dirty
+        _dirty[user_id] = max(history_id, _dirty.get(user_id, 0))
+        stats["coalesced" if coalesced else "accepted"] += 1
+    return "coalesced" if coalesced else "accepted"
+
+
+def mark_dirty(user_id: str) -> None:
+    with _lock:
+        _dirty.setdefault(user_id, 0)
+
+
+def take_dirty(exclude=()) -> list:
+    """Pop every dirty user except those in exclude (e.g. still in flight), which stay queued."""
+    with _lock:
+        users = [u for u in _dirty if u not in exclude]
+        for u in users:
+            del _dirty[u]
+        stats["drained_users"] += len(users)
+    return users
+
+
+def pending_users() -> int:
+    with _lock:
+        return len(_dirty)
+
+
+# ---------------- Watch registration ----------------
+def register_watch(creds: Credentials, user_id: str, verbose: bool = False) -> Optional[dict]:
+    """(Re)register users.watch for a mailbox and store its expiration. No-op without GMAIL_PUSH_TOPIC."""
+    if not PUSH_TOPIC:
+        return None
+    body = {"topicName": PUSH_TOPIC, "labelIds": WATCH_LABELS, "labelFilterBehavior": "INCLUDE"}
+    try:
+        with clients.pooled_service(user_id, creds) as service:
+            resp = service.users().watch(userId='me', body=body).execute()
+    except Exception as e:
+        _bump("watch_errors")
+        print(f"[ERROR] users.watch failed for {user_id}: {e}")
+        return None
+
+    expires = datetime.datetime.utcfromtimestamp(int(resp.get("expiration", 0)) / 1000)
+    try:
+        # history_id is left to sync_mailbox: a first full sync must still list existing unread mail
+        tokens_collection.update_one({"user_id": user_id}, {"$set": {"watch_expiration": expires}})
+    except Exception as e:
+        print(f"[ERROR] saving watch for {user_id}: {e}")
+    _bump("watches_registered")
+    if verbose:
+        print(f"[INFO] watch registered for {user_id} until {expires}")
+    return resp
+
+
+def renew_watches(verbose: bool = False) -> int:
+    """Register watches that are missing or expire within GMAIL_WATCH_RENEW_HOURS. Returns how many."""
+    if not PUSH_TOPIC:
+        return 0
+    horizon = datetime.datetime.utcnow() + WATCH_RENEW_BEFORE
+    query = {"$or": [{"watch_expiration": {"$exists": False}}, {"watch_expiration": {"$lt": horizon}}]}
+    renewed = 0
+    for doc in tokens_collection.find(query, clients.CREDS_FIELDS):
+        if not clients.has_creds(doc):
+            continue
+        try:
+            creds = clients.creds_from_doc(doc)
+        except Exception as e:
+            print(f"[ERROR] renew_watches: bad creds for {doc.get('user_id')}: {e}")
+            continue
+        if register_watch(creds, doc["user_id"], verbose=verbose):
+            renewed += 1
+    if verbose:
+        print(f"[INFO] renewed {renewed} Gmail watches")
+    return renewed
+
+
+def get_stats() -> dict:
+    with _lock:
+        snapshot = dict(stats)
+        snapshot["dirty"] = len(_dirty)
+    snapshot["topic"] = PUSH_TOPIC
+    return snapshot
+
+
+# ---------------- Local Pub/Sub stand-in ----------------
+def make_envelope(email: str, history_id: int, message_id: str = None) -> dict:
+    """The JSON body Pub/Sub POSTs to a push endpoint for a Gmail notification."""
+    data = json.dumps({"emailAddress": email, "historyId": int(history_id)}).encode()
+    return {
+        "message": {
+            "data": base64.b64encode(data).decode(),
+            "messageId": message_id or str(int(time.time() * 1000)),
+            "publishTime": datetime.datetime.utcnow().isoformat() + "Z",
+        },
+        "subscription": "projects/local/subscriptions/gmail-push",
+    }
+
+
+def send_local(email: str, history_id: int, url: str) -> int:
+    if PUSH_TOKEN and "token=" not in url:
+        url += ("&" if "?" in url else "?") + f"token={PUSH_TOKEN}"
+    req = urllib.request.Request(url, data=json.dumps(make_envelope(email, history_id)).encode(),
+                                 headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(req) as resp:
+        return resp.status
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    url = "http://localhost:5000/gmail/push"
+    if "--url" in args:
+        i = args.index("--url")
+        url = args[i + 1]
+        del args[i:i + 2]
+    if len(args) < 2 or args[0] != "notify":
+        print("usage: python -m MAILFETCHING.push notify <email> [historyId] [--url <push endpoint>]")
+        sys.exit(1)
+    history = int(args[2]) if len(args) > 2 else int(time.time())
+    print(f"[INFO] {url} -> {send_local(args[1], history, url)}")
@@ -1,13 +1,40 @@
-from googleapiclient.discovery import build
+import os
+import hashlib
 from datetime import datetime, timedelta
 
-def add_events_to_calendar(creds, event):
+from googleapiclient.errors import HttpError
+
+from MAILFETCHING import clients
+import storage
+
+# Calendar accepts up to 1000 calls per batch but recommends staying around 50
+BATCH_SIZE = int(os.getenv("CALENDAR_BATCH_SIZE", "50"))
+
+calendar_stats = {"inserted": 0, "already_synced": 0, "existing_on_calendar": 0, "errors": 0, "batch_requests": 0}
+
+
+def event_id_for(user_id, email_id):
+    """
+    Deterministic Calendar event id for an email: re-inserting the same email's event
+    is rejected by Calendar (409) instead of creating a duplicate.
+    Ids must be base32hex (0-9, a-v); a hex digest qualifies.
+    """
+    return "mm" + hashlib.sha1(f"{user_id}:{email_id}".encode()).hexdigest()
+
+
+def add_events_to_calendar(creds, event, user_id=None):
     """
     Adds an event to Google Calendar.
+    With user_id the user's pooled Calendar client is reused.
     Returns the event link.
     """
-    service = build("calendar", "v3", credentials=creds)
+    if user_id:
+        with clients.pooled_service(user_id, creds, "calendar", "v3") as service:
+            return _insert_event(service, event)
+    return _insert_event(clients.build_service("calendar", "v3", creds), event)
 
+
+def _event_body(event, event_id=None):
     date_str = event.get("date")
     start_time_str = event.get("start_time", "00:00")
     end_time_str = event.get("end_time", "01:00")
@@ -20,13 +47,113 @@ def add_events_to_calendar(creds, event):
         start_dt = datetime.strptime(date_str, "%Y-%m-%d")
         end_dt = start_dt + timedelta(hours=1)
 
-    event_body = {
+    body = {
         "summary": event.get("title", "No Title"),
         "location": event.get("location", ""),
         "description": event.get("description", ""),
         "start": {"dateTime": start_dt.isoformat(), "timeZone": "Asia/Kolkata"},
         "end": {"dateTime": end_dt.isoformat(), "timeZone": "Asia/Kolkata"},
     }
+    if event_id:
+        body["id"] = event_id
+    return body
+
 
-    created_event = service.events().insert(calendarId="primary", body=event_body).execute()
+def _insert_event(service, event):
+    created_event = service.events().insert(calendarId="primary", body=_event_body(event)).execute()
     return created_event.get("htmlLink")
+
+
+def _run_batch(service, requests):
+    """
+    Execute {key: HttpRequest} as batch HTTP requests of BATCH_SIZE.
+    Returns ({key: response}, {key: exception}).
+    """
+    responses, errors = {}, {}
+
+    def _callback(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            responses[request_id] = response
+
+    keys = list(requests)
+    for i in range(0, len(keys), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=_callback)
+        for key in keys[i:i + BATCH_SIZE]:
+            batch.add(requests[key], request_id=key)
+        batch.execute()
+        calendar_stats["batch_requests"] += 1
+    return responses, errors
+
+
+def _sync_batch(service, user_id, new):
+    """Insert {email_id: event} in batches; returns {email_id: (event_id, htmlLink)}."""
+    ids, inserts = {}, {}
+    for email_id, event in new.items():
+        key, event_id = str(email_id), event_id_for(user_id, email_id)
+        try:
+            body = _event_body(event, event_id)
+        except (ValueError, TypeError) as e:
+            # an impossible date/time (2026-02-30, 25:00) only costs this event, not the batch
+            calendar_stats["errors"] += 1
+            print(f"[ERROR] skipping calendar event for {user_id} email {email_id}: {e}")
+            continue
+        ids[key] = (email_id, event_id)
+        inserts[key] = service.events().insert(calendarId="primary", body=body)
+    if not inserts:
+        return {}
+    created, failed = _run_batch(service, inserts)
+
+    # 409: an earlier run already created it (its link was never recorded); read it back
+    conflicts = {key: service.events().get(calendarId="primary", eventId=ids[key][1])
+                 for key, exc in failed.items() if isinstance(exc, HttpError) and exc.resp.status == 409}
+    existing, lookup_failed = _run_batch(service, conflicts) if conflicts else ({}, {})
+
+    links = {}
+    for key, (email_id, event_id) in ids.items():
+        if key in created:
+            calendar_stats["inserted"] += 1
+            links[email_id] = (event_id, created[key].get("htmlLink"))
+        elif key in existing:
+            calendar_stats["existing_on_calendar"] += 1
+            found = existing[key]
+            # a user-deleted event stays "cancelled"; keep it deleted and record no link
+            links[email_id] = (event_id, None if found.get("status") == "cancelled" else found.get("htmlLink"))
+        else:
+            calendar_stats["errors"] += 1
+            print(f"[ERROR] calendar insert failed for {user_id} email {email_id}: "
+                  f"{lookup_failed.get(key) or failed.get(key)}")
+    return links
+
+
+def sync_events(user_id, creds, items):
+    """
+    Put [(email_id, event_details), ...] on the user's calendar.
+    Events already synced (cached with a link) make no API call; the rest are inserted
+    with deterministic ids in batch requests and their links stored in one bulk write.
+    Returns {email_id: htmlLink or None}.
+    """
+    if not items:
+        return {}
+    wanted = dict(items)
+    cached = storage.find_events(user_id, list(wanted))
+    storage.insert_events(user_id, [(eid, ev) for eid, ev in wanted.items() if eid not in cached])
+
+    result, new = {}, {}
+    for email_id, event in wanted.items():
+        doc = cached.get(email_id)
+        if doc and doc.get("calendar_event_id"):
+            calendar_stats["already_synced"] += 1
+            result[email_id] = doc.get("cal_link")
+        else:
+            new[email_id] = event
+    if not new:
+        return result
+
+    with clients.pooled_service(user_id, creds, "calendar", "v3") as service:
+        links = _sync_batch(service, user_id, new)
+    storage.set_event_links(user_id, links)
+    for email_id in new:
+        result[email_id] = links.get(email_id, (None, None))[1]
+    return result
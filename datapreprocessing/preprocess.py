@@ -1,4 +1,12 @@
+import os
 import pandas as pd
-df = pd.read_csv('your_file.csv')
-df_cut = df.iloc[:2000]
-df_cut.to_csv('processed.csv', index=False)
+
+# the streaming trainer (python -m models.streamtrain) handles any size; set MAX_ROWS only for a quick sample
+MAX_ROWS = int(os.getenv("MAX_ROWS", "0")) or None
+CHUNK_SIZE = 50000
+
+written = 0
+for i, chunk in enumerate(pd.read_csv('your_file.csv', chunksize=CHUNK_SIZE, nrows=MAX_ROWS)):
+    chunk.to_csv('processed.csv', index=False, mode='w' if i == 0 else 'a', header=(i == 0))
+    written += len(chunk)
+print(f"[INFO] wrote {written} rows to processed.csv")
@@ -1,13 +1,170 @@
-from pymongo import MongoClient
+# emails_clean.py
+# Retention: TTL indexes do the expiry inside mongod.
+#   per_user layout: a TTL index per user on the email (fetched_at) and _events (added_at) collections
+#   shared layout:   one TTL index on expire_at, which each doc gets from its user's window
+# The sweep below only runs for users whose TTL index could not be set
+# (or for everyone with RETENTION_MODE=sweep).
+# Copies derived from mail content (feature cache, LLM cache, enrichment queue, spam corrections)
+# are not per user, so they expire after the shortest retention window any user has.
+import os
+import time
 import datetime
 
-db_client = MongoClient("your_mongo_uri")
-db = db_client['Emails']
+import storage
+import viewcache
+from models import featurecache, llmcache, enrichment, onlinelearn
 
-def cleanup_old_emails():
-    cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=24)
-    for col_name in db.list_collection_names():
-        if "_events" in col_name:
-            db[col_name].delete_many({"added_at": {"$lt": cutoff}})
+RETENTION_MODE = os.getenv("RETENTION_MODE", "ttl")   # ttl | sweep
+
+db = storage.db
+tokens_collection = storage.tokens_collection
+
+# users whose collections still need the manual sweep
+_needs_sweep = set()
+last_report = {}
+# serverStatus is not cheap; /retention-stats serves a copy at most this old
+TTL_MONITOR_CACHE_SECONDS = float(os.getenv("TTL_MONITOR_CACHE_SECONDS", "60"))
+_ttl_monitor = {"at": None, "value": None}
+
+
+retention_seconds = storage.retention_seconds
+
+
+def apply_retention(user_id: str, seconds: int) -> bool:
+    """Set/refresh the TTL windows on a user's email and _events collections."""
+    if storage.SHARED:
+        # the shared expire_at TTL index is created with the collections
+        storage.ensure_shared_indexes()
+        return True
+    ok = storage.set_ttl_index(storage.emails_collection(user_id), "fetched_at", seconds)
+    ok = storage.set_ttl_index(storage.events_collection(user_id), "added_at", seconds) and ok
+    if ok:
+        _needs_sweep.discard(user_id)
+    else:
+        _needs_sweep.add(user_id)
+    return ok
+
+
+def set_user_retention(user_id: str, hours: float) -> bool:
+    tokens_collection.update_one({"user_id": user_id}, {"$set": {"retention_hours": hours}})
+    if storage.SHARED:
+        storage.set_user_expiry(user_id, int(hours * 3600))
+    return apply_retention(user_id, int(hours * 3600))
+
+
+def ensure_ttl_indexes() -> dict:
+    """Apply every user's retention window; cheap when the indexes already match."""
+    report = {"users": 0, "ttl_ok": 0, "ttl_failed": 0}
+    for user_doc in tokens_collection.find({}, {"user_id": 1, "retention_hours": 1}):
+        user_id = user_doc.get("user_id")
+        if not user_id:
+            continue
+        report["users"] += 1
+        if apply_retention(user_id, retention_seconds(user_doc)):
+            report["ttl_ok"] += 1
         else:
-            db[col_name].delete_many({"fetched_at": {"$lt": cutoff}})
+            report["ttl_failed"] += 1
+    return report
+
+
+def _sweep_collection(col, scope: dict, field: str, cutoff) -> tuple:
+    """delete_many on the (indexed) time field; returns (docs, approx bytes) reclaimed."""
+    try:
+        avg = db.command("collStats", col.name).get("avgObjSize", 0)
+    except Exception:
+        avg = 0
+    deleted = col.delete_many({**scope, field: {"$lt": cutoff}}).deleted_count
+    return deleted, int(deleted * avg)
+
+
+def cleanup_old_emails(verbose: bool = False) -> dict:
+    """
+    Fallback sweep. Only visits users in _needs_sweep (TTL index unavailable) unless
+    RETENTION_MODE=sweep. Returns {'users', 'docs', 'bytes'} reclaimed.
+    """
+    global last_report
+    report = {"users": 0, "docs": 0, "bytes": 0}
+    query = {} if RETENTION_MODE == "sweep" else {"user_id": {"$in": list(_needs_sweep)}}
+    if RETENTION_MODE != "sweep" and not _needs_sweep:
+        last_report = dict(report, at=datetime.datetime.utcnow())
+        return report
+
+    now = datetime.datetime.utcnow()
+    for user_doc in tokens_collection.find(query, {"user_id": 1, "retention_hours": 1}):
+        user_id = user_doc.get("user_id")
+        if not user_id:
+            continue
+        cutoff = now - datetime.timedelta(seconds=retention_seconds(user_doc))
+        scope = storage.user_scope(user_id)
+        docs_a, bytes_a = _sweep_collection(storage.emails_collection(user_id), scope, "fetched_at", cutoff)
+        docs_b, bytes_b = _sweep_collection(storage.events_collection(user_id), scope, "added_at", cutoff)
+        report["users"] += 1
+        report["docs"] += docs_a + docs_b
+        report["bytes"] += bytes_a + bytes_b
+        if docs_a:
+            viewcache.invalidate(user_id)
+
+    last_report = dict(report, at=now)
+    if verbose:
+        print(f"[INFO] retention sweep: {report}")
+    return report
+
+
+def derived_collections() -> list:
+    """(collection, time field, own TTL cap or None) for every copy derived from mail content."""
+    return [
+        (featurecache._collection, "created_at", featurecache.TTL_SECONDS),
+        (llmcache._collection, "created_at", llmcache.TTL_SECONDS),
+        (enrichment.queue_collection, "created_at", None),
+        (onlinelearn.feedback_collection, "created_at", None),
+    ]
+
+
+def derived_retention_seconds() -> int:
+    """The shortest retention window in use, so no derived copy outlives anyone's mail."""
+    windows = [retention_seconds(d) for d in
+               tokens_collection.find({"retention_hours": {"$exists": True}}, {"retention_hours": 1})]
+    return min([storage.DEFAULT_RETENTION_SECONDS] + windows)
+
+
+def apply_derived_retention(verbose: bool = False) -> dict:
+    """TTL the derived collections to the retention window; sweep the ones whose index can't be set."""
+    window = derived_retention_seconds()
+    now = datetime.datetime.utcnow()
+    report = {"seconds": window, "ttl_ok": 0, "swept_docs": 0}
+    for col, field, cap in derived_collections():
+        seconds = min(window, cap) if cap else window
+        if storage.set_ttl_index(col, field, seconds):
+            report["ttl_ok"] += 1
+            continue
+        cutoff = now - datetime.timedelta(seconds=seconds)
+        report["swept_docs"] += col.delete_many({field: {"$lt": cutoff}}).deleted_count
+    if verbose:
+        print(f"[INFO] derived data retention: {report}")
+    return report
+
+
+def ttl_monitor_stats(max_age: float = None) -> dict:
+    """
+    Documents removed by mongod's TTL monitor (needs serverStatus privilege).
+    With max_age, a result fetched less than max_age seconds ago is reused.
+    """
+    now = time.monotonic()
+    if max_age is not None and _ttl_monitor["at"] is not None and now - _ttl_monitor["at"] < max_age:
+        return _ttl_monitor["value"]
+    try:
+        ttl = db.client.admin.command("serverStatus").get("metrics", {}).get("ttl", {})
+        value = {"deleted_documents": ttl.get("deletedDocuments"), "passes": ttl.get("passes")}
+    except Exception as e:
+        value = {"error": str(e)}
+    _ttl_monitor.update(at=now, value=value)
+    return value
+
+
+def run_retention_job(verbose: bool = False) -> dict:
+    """Scheduler entry point: reconcile TTL indexes, then sweep only what TTL can't cover."""
+    report = {"ttl": ensure_ttl_indexes(), "sweep": cleanup_old_emails(verbose=verbose),
+              "derived": apply_derived_retention(verbose=verbose), "ttl_monitor": ttl_monitor_stats()}
+    if verbose:
+        print(f"[INFO] retention job: {report}")
+    return report
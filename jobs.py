@@ -0,0 +1,100 @@
+# jobs.py
+# Fire-and-forget job registry for work requested over HTTP (/manual-process, OAuth login).
+# submit() returns a job id immediately; the work runs on whatever executor the caller hands in
+# (main.py uses the APScheduler pool). A submission whose key matches a queued or running job
+# returns that job instead of starting a second one.
+import os
+import time
+import uuid
+import threading
+
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "3600"))
+ACTIVE_STATES = ("queued", "running")
+
+_lock = threading.Lock()
+_jobs = {}          # job_id -> record
+_active = {}        # key -> job_id while queued/running
+_progress = {}      # job_id -> callable returning a progress dict
+stats = {"submitted": 0, "deduplicated": 0, "succeeded": 0, "failed": 0}
+
+
+def _prune(now):
+    for job_id in [j for j, r in _jobs.items()
+                   if r["state"] not in ACTIVE_STATES and now - r["finished_at"] > JOB_TTL_SECONDS]:
+        del _jobs[job_id]
+
+
+def submit(key, fn, executor):
+    """
+    Queue fn(job_id) under key (e.g. "user:<id>" or "all"). executor(callable) must schedule the
+    callable to run later. Returns (job_id, deduplicated).
+    """
+    now = time.time()
+    with _lock:
+        _prune(now)
+        existing = _active.get(key)
+        if existing:
+            stats["deduplicated"] += 1
+            _jobs[existing]["duplicates"] += 1
+            return existing, True
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {"job_id": job_id, "key": key, "state": "queued", "submitted_at": now,
+                         "started_at": None, "finished_at": None, "result": None, "error": None, "duplicates": 0}
+        _active[key] = job_id
+        stats["submitted"] += 1
+
+    def run():
+        with _lock:
+            _jobs[job_id]["state"] = "running"
+            _jobs[job_id]["started_at"] = time.time()
+        try:
+            result, error, state = fn(job_id), None, "succeeded"
+        except Exception as e:
+            print(f"[ERROR] job {key} ({job_id}) failed: {e}")
+            result, error, state = None, str(e), "failed"
+        with _lock:
+            rec = _jobs[job_id]
+            rec.update(state=state, result=result, error=error, finished_at=time.time())
+            _active.pop(key, None)
+            _progress.pop(job_id, None)
+            stats[state] += 1
+
+    try:
+        executor(run)
+    except Exception as e:
+        with _lock:
+            _jobs[job_id].update(state="failed", error=f"could not schedule: {e}", finished_at=time.time())
+            _active.pop(key, None)
+            stats["failed"] += 1
+    return job_id, False
+
+
+def set_progress(job_id, progress_fn):
+    """Register a callable whose return value is reported as the running job's progress."""
+    with _lock:
+        _progress[job_id] = progress_fn
+
+
+def get(job_id):
+    with _lock:
+        rec = _jobs.get(job_id)
+        if not rec:
+            return None
+        rec = dict(rec)
+        progress_fn = _progress.get(job_id)
+    if progress_fn:
+        try:
+            rec["progress"] = progress_fn()
+        except Exception as e:
+            rec["progress"] = {"error": str(e)}
+    now = time.time()
+    rec["elapsed"] = round((rec["finished_at"] or now) - (rec["started_at"] or rec["submitted_at"]), 3)
+    return rec
+
+
+def get_stats():
+    with _lock:
+        snapshot = dict(stats)
+        snapshot["active"] = dict(_active)
+        snapshot["tracked"] = len(_jobs)
+    return snapshot
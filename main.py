@@ -1,15 +1,20 @@
 import os
-import base64
-import pickle
+import json
+import hashlib
 import datetime
 from threading import Thread
 from flask import Flask, render_template, session, request, redirect, url_for, jsonify
-from pymongo import MongoClient
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
-from MAILFETCHING import fetch 
-from models import primarymodel, secondarymodel
-from emails_clean import cleanup_old_emails
+from MAILFETCHING import fetch, clients, push
+from models import primarymodel, secondarymodel, llmcache, enrichment, onlinelearn
+import calender
+import emails_clean
+import jobs
+import pipeline
+import pollsched
+import storage
+import viewcache
 
 load_dotenv()
 
@@ -22,177 +27,359 @@ app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev-secret")
 mongo_uri = os.getenv("mongo_uri")
 if not mongo_uri:
     raise RuntimeError("mongo_uri not found in environment")
-Client = MongoClient(mongo_uri)
-db = Client["Emails"]
-tokens_coll = Client['gmail_auth']['tokens']  # stores docs with keys: user_id, email, creds_b64, updated_at
+tokens_coll = storage.tokens_collection  # stores docs with keys: user_id, email, creds_json, updated_at, history_id
 
 # -------------------- Background processing helpers --------------------
-def normalize_classification_output(preds):
-    """
-    Normalize various outputs from primarymodel.classify_emails to a list of dicts:
-    - list[dict]
-    - pandas.DataFrame
-    - tuple([list[dict]],) accidental
-    """
-    try:
-        import pandas as pd
-    except Exception:
-        pd = None
-
-    # unwrap accidental single-element tuple
-    if isinstance(preds, tuple) and len(preds) == 1:
-        preds = preds[0]
-
-    # DataFrame -> list of dicts
-    if pd and isinstance(preds, pd.DataFrame):
-        if 'prediction' not in preds.columns and 'pred' in preds.columns:
-            preds = preds.rename(columns={'pred': 'prediction'})
-        return preds.to_dict(orient='records')
-
-    # already list-like
-    if isinstance(preds, list):
-        normalized = []
-        for p in preds:
-            if isinstance(p, dict):
-                normalized.append(p)
-            else:
-                normalized.append({'prediction': str(p)})
-        return normalized
+# queued: non-spam docs go to the async enrichment worker (models/enrichment.py), drained after each tick
+# combined: inline batched LLM calls returning event + summary per email; two_step: extract_event then summarize_email
+ENRICH_MODE = os.getenv("ENRICH_MODE", "queued")
+# poll: sync every mailbox each POLL_MINUTES; push: Gmail watch notifications drive the sync,
+# with a slow poll (POLL_FALLBACK_MINUTES) catching anything a lost notification missed
+INGEST_MODE = os.getenv("INGEST_MODE", "poll")
+POLL_MINUTES = float(os.getenv("POLL_MINUTES", "2"))
+POLL_FALLBACK_MINUTES = float(os.getenv("POLL_FALLBACK_MINUTES", "30"))
+PUSH_DRAIN_SECONDS = float(os.getenv("PUSH_DRAIN_SECONDS", "5"))
+# fixed: one full pass per interval; adaptive: per-user next-poll times from pollsched.py
+POLL_SCHEDULER = os.getenv("POLL_SCHEDULER", "fixed")
+POLL_TICK_SECONDS = float(os.getenv("POLL_TICK_SECONDS", "10"))
+FEEDBACK_APPLY_SECONDS = float(os.getenv("SPAM_FEEDBACK_APPLY_SECONDS", "60"))
+TOKEN_FIELDS = {**clients.CREDS_FIELDS, "history_id": 1}
+PENDING_PROJECTION = {"subject": 1, "body": 1}
+# a rescore reads text only for feature-cache misses; the rest decides whether to keep or enrich a doc
+RESCORE_PROJECTION = {"spam": 1, "spam_feedback": 1, "summary": 1, "event": 1, "enrichment": 1}
+# user ids (sanitized emails, comma separated) allowed to see per-user operational stats
+ADMIN_USERS = {u.strip() for u in os.getenv("ADMIN_USERS", "").split(",") if u.strip()}
+
+def is_admin():
+    return session.get("user_id") in ADMIN_USERS
+
+def load_user_creds(user_doc, verbose=False):
+    """Return (user_id, creds) for a tokens doc; creds is None if unusable, user_id None without one."""
+    user_id = user_doc.get("user_id")
+    if not user_id:
+        if verbose: print("[WARN] user_doc missing user_id, skipping")
+        return None, None
+
+    if not clients.has_creds(user_doc):
+        if verbose: print(f"[WARN] user {user_id} missing creds_json")
+        return user_id, None
 
-    # fallback: wrap scalar into prediction
-    return [{'prediction': str(preds)}]
+    try:
+        # decoded once per token version, not once per tick
+        creds = clients.creds_from_doc(user_doc)
+    except Exception as e:
+        print(f"[ERROR] Failed to load creds for {user_id}: {e}")
+        return user_id, None
+    return user_id, creds
 
-def process_emails_for_user(user_doc, verbose=False):
+def fetch_pending_for_user(user_doc, verbose=False):
     """
-    Fetch and process unread emails for a single user.
-    user_doc must contain 'user_id' and 'creds_b64'.
+    Fetch unread mail for one user and return (user_id, creds, pending_docs).
+    pending_docs are the stored docs with processed != True. Returns None on failure.
     """
+    user_id, creds = load_user_creds(user_doc, verbose=verbose)
+    if not user_id:
+        return None
+    if not creds:
+        pollsched.record_result(user_id, error="unusable credentials")
+        return None
+
+    # pull new unread mail (history.list since the last sync, full listing as fallback)
     try:
-        user_id = user_doc.get("user_id")
-        if not user_id:
-            if verbose: print("[WARN] user_doc missing user_id, skipping")
-            return
-
-        creds_b64 = user_doc.get("creds_b64")
-        if not creds_b64:
-            if verbose: print(f"[WARN] user {user_id} missing creds_b64")
-            return
-
-        # load credentials
-        try:
-            creds = pickle.loads(base64.b64decode(creds_b64.encode()))
-        except Exception as e:
-            print(f"[ERROR] Failed to load creds for {user_id}: {e}")
-            return
+        result = fetch.sync_mailbox(creds, user_id, verbose=verbose, history_id=user_doc.get("history_id"))
+        if verbose:
+            print(f"[INFO] fetch.sync_mailbox ({result.get('sync')}) inserted {len(result.get('inserted', []))} docs for {user_id}")
+    except Exception as e:
+        print(f"[ERROR] fetch.sync_mailbox failed for {user_id}: {e}")
+        pollsched.record_result(user_id, error=e)
+        return None
+    # sync_mailbox reports Gmail/auth failures in the result; they back the mailbox off like a raise
+    pollsched.record_result(user_id, new_messages=len(result.get("inserted", [])), error=result.get("error"))
+
+    if storage.SHARED:
+        # the pipeline pulls every user's pending docs in one indexed query after the fetch stage
+        return user_id, creds, None
+
+    pending = storage.find_pending(user_id, PENDING_PROJECTION)
+    if not pending and verbose:
+        print(f"[INFO] No new docs to process for user {user_id}")
+    return user_id, creds, pending
+
+def _enrich_two_step(user_id, creds, doc, upd, verbose=False):
+    """Legacy path: extract_event, then a second summarize_email call when there is no event."""
+    # attempt event extraction
+    try:
+        event = secondarymodel.extract_event(doc.get("body", ""))
+    except Exception as e:
+        print(f"[ERROR] extract_event failed for {user_id} doc {doc.get('_id')}: {e}")
+        event = None
 
-        # fetch unread emails (fetch.get_unread_emails marks them READ after inserting)
+    if event:
         try:
-            inserted = fetch.get_unread_emails(creds, user_id, verbose=verbose)
-            if verbose:
-                print(f"[INFO] fetch.get_unread_emails inserted {len(inserted)} docs for {user_id}")
+            cal_link = secondarymodel.cache_and_add_event(user_id, doc['_id'], creds, event)
+            upd["event"] = event
+            upd["cal_link"] = cal_link
+            if verbose: print(f"[INFO] Added event for {user_id} doc {doc.get('_id')}")
         except Exception as e:
-            print(f"[ERROR] fetch.get_unread_emails failed for {user_id}: {e}")
-            return
-
-        # get newly inserted docs (processed != True)
-        col = db[user_id]
-        new_docs = list(col.find({"processed": {"$ne": True}}))
-        if not new_docs:
-            if verbose:
-                print(f"[INFO] No new docs to process for user {user_id}")
-            return
-
-        # Build dataframe for classifier
-        import pandas as pd
-        df = pd.DataFrame([{"subject": d.get("subject", ""), "body": d.get("body", ""), "_id": d.get("_id")} for d in new_docs])
-
-        # classify (robust)
+            print(f"[ERROR] Failed to add event for {user_id} doc {doc.get('_id')}: {e}")
+            # fallback: add summary instead
+            try:
+                upd["summary"] = secondarymodel.summarize_email(doc.get("body", ""))
+            except Exception as e2:
+                print(f"[ERROR] Summarize fallback failed for {user_id} doc {doc.get('_id')}: {e2}")
+                upd["summary"] = "(summary failed)"
+    else:
+        # not an event -> summarize
         try:
-            preds_raw = primarymodel.classify_emails(df)
+            upd["summary"] = secondarymodel.summarize_email(doc.get("body", ""))
+            if verbose: print(f"[INFO] Summarized email for {user_id} doc {doc.get('_id')}")
         except Exception as e:
-            print(f"[ERROR] primarymodel.classify_emails raised for {user_id}: {e}")
-            preds_raw = []
-
-        preds = normalize_classification_output(preds_raw)
-        if verbose:
-            print(f"[DEBUG] user={user_id} preds_raw={preds_raw}")
-            print(f"[DEBUG] user={user_id} preds_normalized={preds}")
-
-        if len(preds) != len(new_docs):
-            print(f"[WARN] Classification length mismatch for user {user_id}: docs={len(new_docs)} preds={len(preds)}")
+            print(f"[ERROR] Summarization failed for {user_id} doc {doc.get('_id')}: {e}")
+            upd["summary"] = "(summary failed)"
+
+def _enrich_combined(user_id, doc, upd, result, cal_links, verbose=False):
+    """Apply a combined {event, summary} answer; the summary is the fallback when there is no event."""
+    if not result:
+        upd["summary"] = "(summary failed)"
+        return
+
+    event = result["event"]
+    if event:
+        upd["cal_link"] = cal_links.get(doc['_id'])
+        upd["event"] = event
+        if verbose: print(f"[INFO] Added event for {user_id} doc {doc.get('_id')}")
+        return
+    upd["summary"] = result["summary"]
+    if verbose: print(f"[INFO] Summarized email for {user_id} doc {doc.get('_id')}")
+
+def enrich_user_docs(user_id, creds, docs, labels, probas, verbose=False):
+    """Run event extraction / summarization for non-spam docs; returns [(doc_id, update), ...]."""
+    combined = {}
+    if ENRICH_MODE == "combined":
+        # one batched prompt per token budget instead of one request per email
+        ham = [(str(d["_id"]), d.get("body", "")) for d, spam in zip(docs, labels) if not spam]
+        combined = secondarymodel.enrich_emails_batch(ham) if ham else {}
+        # every event of this user goes to Calendar in one batch request
+        events = [(d["_id"], combined[str(d["_id"])]["event"]) for d in docs
+                  if combined.get(str(d["_id"])) and combined[str(d["_id"])]["event"]]
+        cal_links = secondarymodel.add_events_batch(user_id, creds, events) if events else {}
+
+    updates, queued = [], []
+    for doc, is_spam, spam_score in zip(docs, labels, probas):
+        is_spam = bool(is_spam)
+        upd = {"spam": is_spam, "spam_score": float(spam_score), "processed": True}
+        if not is_spam:
+            if ENRICH_MODE == "queued":
+                upd["enrichment"] = "pending"
+                queued.append(doc)
+            elif ENRICH_MODE == "combined":
+                _enrich_combined(user_id, doc, upd, combined.get(str(doc["_id"])), cal_links, verbose=verbose)
+            else:
+                _enrich_two_step(user_id, creds, doc, upd, verbose=verbose)
+        updates.append((doc["_id"], upd))
+    if queued:
+        enrichment.enqueue(user_id, queued)
+    return updates
 
-        # iterate and update DB
-        for doc, pred in zip(new_docs, preds):
-            try:
-                prediction = pred.get("prediction") if isinstance(pred, dict) else str(pred)
-            except Exception:
-                prediction = str(pred)
-
-            is_spam = (str(prediction).strip().lower() == "spam")
-            upd = {"spam": is_spam, "processed": True}
-
-            if not is_spam:
-                # attempt event extraction
-                try:
-                    event = secondarymodel.extract_event(doc.get("body", ""))
-                except Exception as e:
-                    print(f"[ERROR] extract_event failed for {user_id} doc {doc.get('_id')}: {e}")
-                    event = None
-
-                if event:
-                    try:
-                        cal_link = secondarymodel.cache_and_add_event(user_id, doc['_id'], creds, event)
-                        upd["event"] = event
-                        upd["cal_link"] = cal_link
-                        if verbose: print(f"[INFO] Added event for {user_id} doc {doc.get('_id')}")
-                    except Exception as e:
-                        print(f"[ERROR] Failed to add event for {user_id} doc {doc.get('_id')}: {e}")
-                        # fallback: add summary instead
-                        try:
-                            upd["summary"] = secondarymodel.summarize_email(doc.get("body", ""))
-                        except Exception as e2:
-                            print(f"[ERROR] Summarize fallback failed for {user_id} doc {doc.get('_id')}: {e2}")
-                            upd["summary"] = "(summary failed)"
-                else:
-                    # not an event -> summarize
-                    try:
-                        upd["summary"] = secondarymodel.summarize_email(doc.get("body", ""))
-                        if verbose: print(f"[INFO] Summarized email for {user_id} doc {doc.get('_id')}")
-                    except Exception as e:
-                        print(f"[ERROR] Summarization failed for {user_id} doc {doc.get('_id')}: {e}")
-                        upd["summary"] = "(summary failed)"
-
-            # write update
-            try:
-                col.update_one({"_id": doc["_id"]}, {"$set": upd})
-            except Exception as e:
-                print(f"[ERROR] Failed to update doc {doc.get('_id')} for {user_id}: {e}")
+def enrich_rescued(user_id, docs, verbose=False):
+    """
+    Enrich emails relabelled from spam to not-spam (a /feedback correction or a rescore).
+    Classification skipped them, so they have no summary or event card yet. Queued mode only
+    enqueues; the inline modes call the LLM, so they belong on a background thread or job.
+    """
+    docs = [d for d in docs if not d.get("summary") and not d.get("event") and d.get("enrichment") != "pending"]
+    if not docs:
+        return 0
+    docs = storage.find_emails(user_id, [d["_id"] for d in docs], {"body": 1})
+    creds = clients.load_creds(user_id) if ENRICH_MODE != "queued" else None
+    updates = enrich_user_docs(user_id, creds, docs, [False] * len(docs), [0.0] * len(docs), verbose=verbose)
+    # the label and score stay as the correction / rescore set them
+    keep = ("spam", "spam_score", "processed")
+    storage.apply_updates(user_id, [(doc_id, {k: v for k, v in upd.items() if k not in keep})
+                                    for doc_id, upd in updates])
+    return len(docs)
+
+def persist_updates(user_id, updates):
+    storage.apply_updates(user_id, updates)
+
+def make_pipeline(verbose=False):
+    return pipeline.Pipeline(
+        fetch_fn=lambda user_doc: fetch_pending_for_user(user_doc, verbose=verbose),
+        classify_fn=primarymodel.classify_batch,
+        enrich_fn=lambda *args: enrich_user_docs(*args, verbose=verbose),
+        persist_fn=persist_updates,
+        pending_fn=lambda user_ids: storage.find_pending_many(user_ids, PENDING_PROJECTION),
+        verbose=verbose,
+    )
 
+def process_emails_for_user(user_doc, verbose=False, job_id=None):
+    """
+    Fetch and process unread emails for a single user.
+    user_doc must contain 'user_id', 'creds_json' and 'updated_at'.
+    """
+    try:
+        p = make_pipeline(verbose=verbose)
+        if job_id:
+            jobs.set_progress(job_id, lambda: dict(p.stats))
+        stats = p.run([user_doc])
+        if ENRICH_MODE == "queued":
+            # only this user's backlog; everyone else's is left to the scheduler's drain
+            stats["enrichment"] = enrichment.drain(verbose=verbose, user_id=user_doc.get("user_id"))
+        return stats
     except Exception as e:
         print(f"[ERROR] process_emails_for_user: {e}")
 
-def process_emails_background(verbose=False):
+def process_emails_background(verbose=False, job_id=None):
     """
-    Iterate over tokens collection and process each user.
+    Run one pipeline tick over every user in the tokens collection.
+    Users still in flight from an overlapping tick are skipped.
     """
     if verbose:
         print("[INFO] Running background email processing...")
     try:
-        cursor = tokens_coll.find({}, {"user_id": 1, "creds_b64": 1})
-        for user_doc in cursor:
-            if not user_doc.get("user_id") or not user_doc.get("creds_b64"):
-                continue
-            process_emails_for_user(user_doc, verbose=verbose)
+        user_docs = list(tokens_coll.find({}, TOKEN_FIELDS))
+        p = make_pipeline(verbose=verbose)
+        if job_id:
+            jobs.set_progress(job_id, lambda: dict(p.stats))
+        stats = p.run(user_docs)
+        stats["mongo"] = pipeline.last_tick_stats["mongo"] = storage.reset_stats()
+        if ENRICH_MODE == "queued":
+            # also picks up items left over from earlier ticks
+            stats["enrichment"] = pipeline.last_tick_stats["enrichment"] = enrichment.drain(verbose=verbose)
     except Exception as e:
         print(f"[ERROR] process_emails_background: {e}")
+        stats = None
     if verbose:
         print("[INFO] Background processing complete.")
+    return stats
+
+def process_push_users(verbose=False):
+    """Sync only the users Gmail notified us about since the last drain."""
+    user_ids = push.take_dirty(exclude=set(pipeline.active_users()))
+    if not user_ids:
+        return None
+    try:
+        user_docs = list(tokens_coll.find({"user_id": {"$in": user_ids}}, TOKEN_FIELDS))
+        stats = make_pipeline(verbose=verbose).run(user_docs)
+        stats["trigger"] = "push"
+        stats["mongo"] = storage.reset_stats()
+        if ENRICH_MODE == "queued":
+            stats["enrichment"] = enrichment.drain(verbose=verbose)
+        pipeline.last_tick_stats.update(stats)
+    except Exception as e:
+        print(f"[ERROR] process_push_users: {e}")
+        for user_id in user_ids:
+            push.mark_dirty(user_id)
+        stats = None
+    return stats
+
+def poll_due_users(verbose=False):
+    """Adaptive polling tick: run the pipeline for the users pollsched says are due."""
+    try:
+        pollsched.sync_users([d["user_id"] for d in tokens_coll.find({}, {"user_id": 1}) if d.get("user_id")])
+    except Exception as e:
+        print(f"[ERROR] poll_due_users: listing users failed: {e}")
+        return None
+    user_ids = pollsched.take_due()
+    if not user_ids:
+        return None
+    stats = None
+    try:
+        user_docs = list(tokens_coll.find({"user_id": {"$in": user_ids}}, TOKEN_FIELDS))
+        stats = make_pipeline(verbose=verbose).run(user_docs)
+        stats["trigger"] = "adaptive"
+        stats["mongo"] = storage.reset_stats()
+        if ENRICH_MODE == "queued":
+            stats["enrichment"] = enrichment.drain(verbose=verbose)
+        pipeline.last_tick_stats.update(stats)
+    except Exception as e:
+        print(f"[ERROR] poll_due_users: {e}")
+    finally:
+        # users that never reached sync_mailbox (bad creds, still in flight elsewhere)
+        pollsched.release(user_ids)
+    return stats
 
 # -------------------- Scheduler --------------------
 scheduler = BackgroundScheduler()
-scheduler.add_job(func=cleanup_old_emails, trigger="interval", hours=1)
-# run background processing every 2 minutes
-scheduler.add_job(func=lambda: process_emails_background(verbose=False), trigger="interval", minutes=2)
+# retention is enforced by TTL indexes; this reconciles per-user windows and sweeps only where TTL failed
+scheduler.add_job(func=emails_clean.run_retention_job, trigger="interval", hours=6,
+                  next_run_time=datetime.datetime.now())
+if POLL_SCHEDULER == "adaptive":
+    # pollsched bounds every user's interval by POLL_MAX_SECONDS, which also covers lost push notifications
+    scheduler.add_job(func=lambda: poll_due_users(verbose=False), trigger="interval",
+                      seconds=POLL_TICK_SECONDS, max_instances=1, coalesce=True)
+else:
+    # full polling pass: the primary ingest in poll mode, a slow safety net in push mode
+    scheduler.add_job(func=lambda: process_emails_background(verbose=False), trigger="interval",
+                      minutes=POLL_FALLBACK_MINUTES if INGEST_MODE == "push" else POLL_MINUTES, max_instances=2)
+# spam corrections from /feedback -> partial_fit micro-batches -> promoted model version
+scheduler.add_job(func=onlinelearn.apply_feedback, trigger="interval", seconds=FEEDBACK_APPLY_SECONDS,
+                  max_instances=1, coalesce=True)
+if INGEST_MODE == "push":
+    scheduler.add_job(func=lambda: process_push_users(verbose=False), trigger="interval",
+                      seconds=PUSH_DRAIN_SECONDS, max_instances=1, coalesce=True)
+    scheduler.add_job(func=push.renew_watches, trigger="interval", hours=12,
+                      next_run_time=datetime.datetime.now())
+
+def rescore_users(user_ids=None, job_id=None):
+    """
+    Re-run the spam model over already-processed mail (e.g. after a model swap).
+    Features come from the feature cache, so only the model's predict step is repeated;
+    subject/body are read from Mongo only for the docs the cache misses.
+    Emails the user corrected via /feedback keep their label; emails flipped to not-spam are enriched.
+    """
+    if user_ids is None:
+        user_ids = [d["user_id"] for d in tokens_coll.find({}, {"user_id": 1}) if d.get("user_id")]
+    progress = {"users": len(user_ids), "users_done": 0, "docs": 0, "changed": 0, "enriched": 0}
+    if job_id:
+        jobs.set_progress(job_id, lambda: dict(progress))
+    for user_id in user_ids:
+        def fill(missing, user_id=user_id):
+            return storage.find_emails(user_id, [d["_id"] for d in missing], PENDING_PROJECTION)
+        for docs in storage.iter_processed(user_id, RESCORE_PROJECTION):
+            docs = [d for d in docs if d.get("spam_feedback") is None]
+            if not docs:
+                continue
+            out = primarymodel.classify_batch(docs, fill=fill)
+            updates = [(d["_id"], {"spam": bool(spam), "spam_score": float(score)})
+                       for d, spam, score in zip(docs, out["labels"], out["proba"])]
+            progress["changed"] += sum(1 for d, (_, u) in zip(docs, updates) if d.get("spam") != u["spam"])
+            storage.apply_updates(user_id, updates)
+            rescued = [d for d, (_, u) in zip(docs, updates) if d.get("spam") and not u["spam"]]
+            progress["enriched"] += enrich_rescued(user_id, rescued)
+            progress["docs"] += len(docs)
+        progress["users_done"] += 1
+    return progress
+
+def submit_rescore_job():
+    return jobs.submit("rescore", lambda job_id: rescore_users(job_id=job_id), _run_on_scheduler)
+
+def _run_on_scheduler(run):
+    """Job executor: the scheduler's thread pool once it is running, a plain thread before that."""
+    if scheduler.running:
+        scheduler.add_job(func=run, misfire_grace_time=None)
+    else:
+        Thread(target=run, daemon=True).start()
+
+def submit_user_job(user_id, verbose=False):
+    """Queue processing for one user; returns (job_id, deduplicated)."""
+    def run(job_id):
+        user_doc = tokens_coll.find_one({"user_id": user_id}, TOKEN_FIELDS)
+        if not user_doc:
+            raise ValueError(f"no stored token for {user_id}")
+        stats = process_emails_for_user(user_doc, verbose=verbose, job_id=job_id)
+        if stats is None:
+            raise RuntimeError("processing failed (see server logs)")
+        return stats
+    return jobs.submit(f"user:{user_id}", run, _run_on_scheduler)
+
+def submit_all_users_job(verbose=False):
+    def run(job_id):
+        stats = process_emails_background(verbose=verbose, job_id=job_id)
+        if stats is None:
+            raise RuntimeError("processing failed (see server logs)")
+        return stats
+    return jobs.submit("all", run, _run_on_scheduler)
 
 # don't start scheduler here — we will start it in __main__ to avoid duplicate schedulers in reloader
 
@@ -219,9 +406,8 @@ def oauthcallback():
         print("[ERROR] Failed to exchange code for user.")
         return redirect("/")
 
-    # Save session
+    # Save session (credentials stay server-side in gmail_auth.tokens)
     session['user_id'] = user_id
-    session['creds_b64'] = base64.b64encode(pickle.dumps(creds)).decode()
 
     # Persist token to DB (fetch.exchange_code_for_user already calls save_token_to_db)
     try:
@@ -230,28 +416,19 @@ def oauthcallback():
     except Exception as e:
         print(f"[WARN] save_token_to_db failed: {e}")
 
-    # Immediate fetch so user sees emails right away
-    try:
-        fetch.get_unread_emails(creds, user_id, limit=10, verbose=True)
-    except Exception as e:
-        print(f"[WARN] Immediate fetch failed: {e}")
+    if INGEST_MODE == "push":
+        push.register_watch(creds, user_id, verbose=True)
+
+    # first sync runs in the background; the dashboard fills in as it lands
+    submit_user_job(user_id, verbose=True)
 
     print(f"[INFO] Login successful: user_id={user_id}")
     return redirect(url_for("dashboard"))
 
-@app.route("/dashboard")
-def dashboard():
-    if 'user_id' not in session:
-        return redirect("/")
-
-    user_id = session['user_id']
-    page = int(request.args.get("page", 1))
-    page_size = 10
-    skip = (page - 1) * page_size
-
-    emails_cursor = db[user_id].find().skip(skip).limit(page_size)
-    emails = list(emails_cursor)
+DASHBOARD_PAGE_SIZE = 10
 
+def build_email_views(emails):
+    """Split stored docs into the dashboard's all / event / summary card lists."""
     all_emails, event_emails, summary_emails = [], [], []
 
     for e in emails:
@@ -259,6 +436,7 @@ def dashboard():
         body = e.get("body", "(No body)")
 
         all_emails.append({
+            "id": str(e.get("_id")),
             "subject": subject,
             "body": body,
             "spam": e.get("spam", False)
@@ -283,26 +461,144 @@ def dashboard():
                 "summary": e["summary"]
             })
 
-    next_page = page + 1 if db[user_id].count_documents({}) > skip + page_size else None
+    return all_emails, event_emails, summary_emails
+
+def dashboard_view(user_id, cursor=None, limit=DASHBOARD_PAGE_SIZE):
+    """Materialized page of dashboard lists (+ ETag), served from viewcache until the user's mail changes."""
+    def build():
+        emails, next_cursor = storage.page_emails(user_id, cursor=cursor, limit=limit)
+        all_emails, event_emails, summary_emails = build_email_views(emails)
+        payload = {
+            "status": "ok",
+            "all_emails": all_emails,
+            "event_emails": event_emails,
+            "summary_emails": summary_emails,
+            "next_cursor": next_cursor,
+        }
+        etag = hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+        return payload, etag
+    return viewcache.get_or_build(user_id, (cursor, limit), build)
+
+@app.route("/dashboard")
+def dashboard():
+    if 'user_id' not in session:
+        return redirect("/")
+
+    user_id = session['user_id']
+    pollsched.record_visit(user_id)
+    view, _ = dashboard_view(user_id, cursor=request.args.get("cursor"))
 
     return render_template(
         "dashboard.html",
-        all_emails=all_emails,
-        event_emails=event_emails,
-        summary_emails=summary_emails,
-        next_page=next_page,
-        current_page=page,
+        all_emails=view["all_emails"],
+        event_emails=view["event_emails"],
+        summary_emails=view["summary_emails"],
+        next_cursor=view["next_cursor"],
         last_synced=datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
     )
 
+@app.route("/api/emails")
+def api_emails():
+    """
+    JSON page of the dashboard lists. ?cursor=<next_cursor from the previous page>&limit=N.
+    Responses carry an ETag; an unchanged page is answered with 304.
+    """
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Not logged in"}), 403
+
+    user_id = session['user_id']
+    limit = max(1, min(50, request.args.get("limit", DASHBOARD_PAGE_SIZE, type=int)))
+    payload, etag = dashboard_view(user_id, cursor=request.args.get("cursor"), limit=limit)
+
+    resp = jsonify(payload)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
+
+@app.route("/feedback", methods=["POST"])
+def feedback():
+    """Record a spam / not-spam correction for one of the user's emails: {"id": <email id>, "spam": bool}."""
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Not logged in"}), 403
+    data = request.get_json(silent=True) or {}
+    if not data.get("id") or not isinstance(data.get("spam"), bool):
+        return jsonify({"status": "error", "message": "expected {id, spam: true|false}"}), 400
+
+    user_id = session['user_id']
+    doc = storage.find_email(user_id, data["id"], {"subject": 1, "body": 1, "processed": 1,
+                                                   "summary": 1, "event": 1, "enrichment": 1})
+    if not doc:
+        return jsonify({"status": "error", "message": "unknown email"}), 404
+    learned = onlinelearn.record_feedback(user_id, doc, data["spam"])
+    if not data["spam"] and doc.get("processed"):
+        # a rescued email was never summarized; the inline modes call the LLM off the request
+        _run_on_scheduler(lambda: enrich_rescued(user_id, [doc]))
+    return jsonify({"status": "ok", "id": data["id"], "spam": data["spam"], "learned": learned})
+
+@app.route("/feedback-stats")
+def feedback_stats():
+    return jsonify(onlinelearn.get_stats())
+
+@app.route("/retention-stats")
+def retention_stats():
+    return jsonify({"last_sweep": emails_clean.last_report,
+                    "ttl_monitor": emails_clean.ttl_monitor_stats(max_age=emails_clean.TTL_MONITOR_CACHE_SECONDS)})
+
+@app.route("/view-cache-stats")
+def view_cache_stats():
+    return jsonify(viewcache.get_stats())
+
 @app.route("/manual-process")
 def manual_process():
-    """Trigger background processing on demand — returns counts for debug."""
-    try:
-        process_emails_background(verbose=True)
-        return jsonify({"status": "ok", "message": "Triggered processing (see server logs)."})
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+    """
+    Queue processing and return at once with a job id (poll /jobs/<job_id>).
+    ?scope=user processes only the logged-in user; the default is every user (admins only).
+    A repeat submission while the same job is queued or running returns that job.
+    """
+    if request.args.get("scope") == "user":
+        if 'user_id' not in session:
+            return jsonify({"status": "error", "message": "Not logged in"}), 403
+        job_id, deduplicated = submit_user_job(session['user_id'], verbose=True)
+    else:
+        if not is_admin():
+            return jsonify({"status": "error", "message": "Not allowed"}), 403
+        job_id, deduplicated = submit_all_users_job(verbose=True)
+    return jsonify({
+        "status": "queued",
+        "job_id": job_id,
+        "deduplicated": deduplicated,
+        "status_url": url_for("job_status", job_id=job_id),
+    }), 202
+
+@app.route("/rescore", methods=["POST"])
+def rescore():
+    """Queue a spam re-score of every stored email with the current model (admins only); returns a job id."""
+    if not is_admin():
+        return jsonify({"status": "error", "message": "Not allowed"}), 403
+    job_id, deduplicated = submit_rescore_job()
+    return jsonify({
+        "status": "queued",
+        "job_id": job_id,
+        "deduplicated": deduplicated,
+        "status_url": url_for("job_status", job_id=job_id),
+    }), 202
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "unknown job"}), 404
+    if job["key"].startswith("user:") and job["key"] != f"user:{session.get('user_id')}":
+        return jsonify({"status": "error", "message": "Not your job"}), 403
+    return jsonify(job)
+
+@app.route("/job-stats")
+def job_stats():
+    """Job counters; the active job keys (user:<user id>) only for admins."""
+    stats = jobs.get_stats()
+    if not is_admin():
+        stats["active"] = len(stats["active"])
+    return jsonify(stats)
 
 @app.route("/logout")
 def logout():
@@ -312,13 +608,66 @@ def logout():
 @app.route("/session-debug")
 def session_debug():
     return jsonify(dict(session))
+
+@app.route("/gmail/push", methods=["POST"])
+def gmail_push():
+    """Pub/Sub push endpoint for Gmail watch notifications; just marks the mailbox for the next drain."""
+    outcome = push.handle_notification(request.get_json(silent=True) or {}, token=request.args.get("token"))
+    if outcome == "bad_token":
+        return "", 403
+    # 2xx for everything else so Pub/Sub doesn't redeliver notifications we can't use
+    return "", 204
+
+@app.route("/push-stats")
+def push_stats():
+    return jsonify({"mode": INGEST_MODE, "push": push.get_stats()})
+
+@app.route("/poll-schedule")
+def poll_schedule():
+    """
+    Scheduler overview, or ?user_id=<id> for that user's state and recent scheduling decisions.
+    Users may only look up themselves; the ids in the overview's upcoming list are admin-only.
+    """
+    user_id = request.args.get("user_id")
+    if user_id:
+        if user_id != session.get("user_id") and not is_admin():
+            return jsonify({"status": "error", "message": "Not allowed"}), 403
+        return jsonify(pollsched.explain(user_id) or {"status": "error", "message": "unknown user"})
+    stats = pollsched.get_stats()
+    if not is_admin():
+        stats["next"] = [{"in": n["in"]} for n in stats["next"]]
+    return jsonify({"mode": POLL_SCHEDULER, "scheduler": stats})
+
+@app.route("/pipeline-stats")
+def pipeline_stats():
+    """Last tick counters; the ids of users in flight (derived from their emails) only for admins."""
+    in_flight = pipeline.active_users()
+    return jsonify({"last_tick": pipeline.last_tick_stats, "in_flight": in_flight if is_admin() else len(in_flight)})
+
+@app.route("/client-pool-stats")
+def client_pool_stats():
+    return jsonify({"pool": clients.get_stats(), "gmail": fetch.fetch_stats})
+
+@app.route("/calendar-stats")
+def calendar_stats():
+    return jsonify(calender.calendar_stats)
+
+@app.route("/model-stats")
+def model_stats():
+    return jsonify(primarymodel.get_model_stats())
+
+@app.route("/llm-cache-stats")
+def llm_cache_stats():
+    return jsonify({"cache": llmcache.get_stats(), "llm": secondarymodel.get_llm_stats()})
 @app.route("/fetch-more-emails")
 def fetch_more_emails():
-    if 'user_id' not in session or 'creds_b64' not in session:
+    if 'user_id' not in session:
         return jsonify({"status": "error", "message": "Not logged in"}), 403
 
     user_id = session['user_id']
-    creds = pickle.loads(base64.b64decode(session['creds_b64'].encode()))
+    creds = clients.load_creds(user_id)
+    if not creds:
+        return jsonify({"status": "error", "message": "Not logged in"}), 403
     page_token = request.args.get("page_token")
 
     result = fetch.get_unread_emails(creds, user_id, limit=10, page_token=page_token, verbose=False)
@@ -0,0 +1,112 @@
+# migrate_storage.py
+# One-off move from per-user collections (Emails.<user_id>, Emails.<user_id>_events) into the
+# shared `emails` / `events` collections used by STORAGE_LAYOUT=shared.
+# Idempotent: every copy is an upsert on (user_id, msg_id) / (user_id, email_id), so a rerun
+# after a partial failure only fills in what is missing.
+#
+#   python migrate_storage.py --dry-run
+#   python migrate_storage.py [--user <id>] [--drop-source] [--shard]
+import sys
+import argparse
+import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import storage
+
+BATCH = 1000
+
+
+def _source_users():
+    """User ids that still have a per-user mail collection."""
+    names = set(storage.db.list_collection_names())
+    users = set()
+    for name in names:
+        if name in ("emails", "events") or name.startswith("system."):
+            continue
+        users.add(name[:-len("_events")] if name.endswith("_events") else name)
+    return sorted(users)
+
+
+def _flush(col, ops, dry_run):
+    if not ops or dry_run:
+        return 0
+    try:
+        res = col.bulk_write(ops, ordered=False)
+        return res.upserted_count + res.modified_count
+    except BulkWriteError as e:
+        print(f"[ERROR] bulk upsert into {col.name}: {e.details.get('writeErrors', [])[:3]}")
+        return e.details.get("nUpserted", 0) + e.details.get("nModified", 0)
+
+
+def _copy(src, dst, user_id, key_field, time_field, ttl, dry_run):
+    """Upsert every doc of src into dst with user_id and expire_at added; returns (seen, written)."""
+    seen = written = 0
+    ops = []
+    for doc in src.find({}):
+        seen += 1
+        key = doc.get(key_field)
+        if key is None:
+            print(f"[WARN] {src.name}: skipping {doc['_id']} without {key_field}")
+            continue
+        doc["user_id"] = user_id
+        start = doc.get(time_field) or datetime.datetime.utcnow()
+        doc.setdefault("expire_at", start + datetime.timedelta(seconds=ttl))
+        # _id is kept so dashboard cursors and queued enrichment items still resolve
+        doc_id = doc.pop("_id")
+        ops.append(UpdateOne({"user_id": user_id, key_field: key},
+                             {"$set": doc, "$setOnInsert": {"_id": doc_id}}, upsert=True))
+        if len(ops) >= BATCH:
+            written += _flush(dst, ops, dry_run)
+            ops = []
+    written += _flush(dst, ops, dry_run)
+    return seen, written
+
+
+def migrate_user(user_id, dry_run=False, drop_source=False):
+    token_doc = storage.tokens_collection.find_one({"user_id": user_id}, {"retention_hours": 1})
+    ttl = storage.retention_seconds(token_doc)
+    report = {}
+    for src_name, dst, key_field, time_field in (
+        (user_id, storage.shared_emails, "msg_id", "fetched_at"),
+        (f"{user_id}_events", storage.shared_events, "email_id", "added_at"),
+    ):
+        src = storage.db[src_name]
+        seen, written = _copy(src, dst, user_id, key_field, time_field, ttl, dry_run)
+        copied = dst.count_documents({"user_id": user_id}) if not dry_run else None
+        report[dst.name] = {"source": seen, "written": written, "in_shared": copied}
+        if drop_source and not dry_run and seen and copied is not None and copied >= seen:
+            src.drop()
+            report[dst.name]["dropped_source"] = True
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copy per-user mail/event collections into the shared layout.")
+    parser.add_argument("--user", action="append", help="only migrate this user id (repeatable)")
+    parser.add_argument("--dry-run", action="store_true", help="read and count, write nothing")
+    parser.add_argument("--drop-source", action="store_true", help="drop a per-user collection once fully copied")
+    parser.add_argument("--shard", action="store_true", help="shard emails/events on user_id first (mongos only)")
+    args = parser.parse_args(argv)
+
+    if not args.dry_run:
+        storage.ensure_shared_indexes()
+        if args.shard:
+            storage.shard_collections()
+
+    users = args.user or _source_users()
+    print(f"[INFO] migrating {len(users)} user(s){' (dry run)' if args.dry_run else ''}")
+    for user_id in users:
+        try:
+            report = migrate_user(user_id, dry_run=args.dry_run, drop_source=args.drop_source)
+            print(f"[INFO] {user_id}: {report}")
+        except Exception as e:
+            print(f"[ERROR] migration failed for {user_id}: {e}")
+    if not args.dry_run:
+        print("[INFO] done; set STORAGE_LAYOUT=shared and restart the app")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+# artifacts.py
+# Pickle-free spam model artifacts: every array is a .npy file opened with mmap_mode='r', so
+# gunicorn workers serving the same version share one copy of the pages through the OS page
+# cache instead of each unpickling its own. Only small JSON (params + digests) is parsed.
+#
+#   <version>/model.json          MultinomialNB params + digest of its arrays
+#   <version>/nb_*.npy            feature_log_prob_, class_log_prior_, feature_count_, class_count_, classes_
+#   <version>/vectorizer.json     vectorizer kind + params (+ vocabulary digest)
+#   <version>/vocab_terms.npy     sorted vocabulary terms (fixed-width unicode)
+#   <version>/vocab_index.npy     column index of each sorted term
+#   <version>/idf.npy             idf_ per column
+import os
+import copy
+import json
+import hashlib
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.preprocessing import normalize
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+
+MODEL_META = "model.json"
+VECTORIZER_META = "vectorizer.json"
+NB_ARRAYS = ("feature_log_prob_", "class_log_prior_", "feature_count_", "class_count_", "classes_")
+# MultinomialNB.partial_fit updates these in place; mmap'd copies are read-only
+NB_MUTABLE = ("feature_count_", "class_count_", "feature_log_prob_", "class_log_prior_")
+
+
+class MappedVocabVectorizer:
+    """
+    TfidfVectorizer.transform over a memory-mapped vocabulary.
+    Terms are looked up with np.searchsorted on the sorted term array instead of a per-process
+    dict; tokenisation is the fitted vectorizer's own analyzer, so the output is identical.
+    """
+
+    def __init__(self, params, terms, index, idf):
+        self.params = params
+        self.terms = terms
+        self.index = index
+        self.idf_ = idf
+        self.n_features_ = len(idf)
+        self._analyzer = TfidfVectorizer(**params).build_analyzer()
+
+    def transform(self, texts):
+        lengths, tokens = [], []
+        for text in texts:
+            toks = self._analyzer(text)
+            lengths.append(len(toks))
+            tokens.extend(toks)
+        n = len(lengths)
+        if not tokens:
+            return sp.csr_matrix((n, self.n_features_), dtype=np.float64)
+
+        tok = np.asarray(tokens)
+        pos = np.searchsorted(self.terms, tok)
+        pos = np.minimum(pos, len(self.terms) - 1)
+        hit = self.terms[pos] == tok
+        rows = np.repeat(np.arange(n), lengths)[hit]
+        cols = self.index[pos[hit]]
+        X = sp.csr_matrix((np.ones(len(cols)), (rows, cols)), shape=(n, self.n_features_), dtype=np.float64)
+        X.sum_duplicates()
+
+        if self.params.get("binary"):
+            X.data[:] = 1.0
+        if self.params.get("sublinear_tf"):
+            np.log(X.data, X.data)
+            X.data += 1.0
+        if self.params.get("use_idf", True):
+            X.data *= self.idf_[X.indices]
+        if self.params.get("norm"):
+            X = normalize(X, norm=self.params["norm"], copy=False)
+        return X
+
+
+def _digest(arrays):
+    h = hashlib.sha256()
+    for arr in arrays:
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()
+
+
+def _json_params(params):
+    """get_params() minus what JSON can't carry (dtype, callables)."""
+    return {k: (list(v) if isinstance(v, tuple) else v) for k, v in params.items()
+            if k != "dtype" and not callable(v)}
+
+
+def _restore_params(params):
+    return {k: (tuple(v) if k == "ngram_range" else v) for k, v in params.items()}
+
+
+# ---------------- Save ----------------
+def save_model(directory, model):
+    arrays = {name: np.asarray(getattr(model, name)) for name in NB_ARRAYS}
+    if arrays["classes_"].dtype == object:
+        arrays["classes_"] = arrays["classes_"].astype(str)
+    for name, arr in arrays.items():
+        np.save(os.path.join(directory, f"nb_{name.rstrip('_')}.npy"), arr)
+    meta = {
+        "kind": "multinomial_nb",
+        "params": _json_params(model.get_params()),
+        "digest": _digest(arrays.values()),
+    }
+    with open(os.path.join(directory, MODEL_META), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def save_vectorizer(directory, vectorizer):
+    if isinstance(vectorizer, HashingVectorizer):
+        meta = {"kind": "hashing", "params": _json_params(vectorizer.get_params())}
+    else:
+        if isinstance(vectorizer, MappedVocabVectorizer):
+            params, terms, index, idf = vectorizer.params, vectorizer.terms, vectorizer.index, vectorizer.idf_
+        else:
+            params = _json_params(vectorizer.get_params())
+            items = sorted(vectorizer.vocabulary_.items())
+            terms = np.array([t for t, _ in items])
+            index = np.array([i for _, i in items], dtype=np.int32)
+            idf = np.asarray(vectorizer.idf_, dtype=np.float64)
+        np.save(os.path.join(directory, "vocab_terms.npy"), np.asarray(terms))
+        np.save(os.path.join(directory, "vocab_index.npy"), np.asarray(index))
+        np.save(os.path.join(directory, "idf.npy"), np.asarray(idf))
+        meta = {"kind": "tfidf", "params": params, "digest": _digest((terms, index, idf))}
+    with open(os.path.join(directory, VECTORIZER_META), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+
+
+# ---------------- Load ----------------
+def _mmap(directory, name):
+    return np.load(os.path.join(directory, name), mmap_mode='r')
+
+
+def load_model(directory):
+    with open(os.path.join(directory, MODEL_META)) as f:
+        meta = json.load(f)
+    model = MultinomialNB(**meta["params"])
+    for name in NB_ARRAYS:
+        setattr(model, name, _mmap(directory, f"nb_{name.rstrip('_')}.npy"))
+    model.classes_ = np.array(model.classes_)   # tiny; keep a plain array for label comparisons
+    model.n_features_in_ = model.feature_log_prob_.shape[1]
+    return model
+
+
+def load_vectorizer(directory):
+    with open(os.path.join(directory, VECTORIZER_META)) as f:
+        meta = json.load(f)
+    params = _restore_params(meta["params"])
+    if meta["kind"] == "hashing":
+        return HashingVectorizer(**params)
+    return MappedVocabVectorizer(params, _mmap(directory, "vocab_terms.npy"),
+                                 _mmap(directory, "vocab_index.npy"), _mmap(directory, "idf.npy"))
+
+
+def writable(model):
+    """Copy of a mapped model whose count arrays can be updated by partial_fit."""
+    model = copy.copy(model)
+    for name in NB_MUTABLE:
+        setattr(model, name, np.array(getattr(model, name)))
+    return model
@@ -0,0 +1,386 @@
+# enrichment.py
+# Asyncio LLM enrichment worker: Mongo-backed work queue, token-bucket rate limit,
+# bounded concurrency, exponential backoff and several emails per prompt.
+# Items left over carry into the next tick.
+import os
+import json
+import time
+import random
+import asyncio
+import datetime
+
+from pymongo import ASCENDING, UpdateOne, ReturnDocument
+
+import storage
+from models import secondarymodel, llmcache
+from MAILFETCHING import fetch
+
+RATE_PER_SEC = float(os.getenv("LLM_RATE_PER_SEC", "4"))
+BURST = int(os.getenv("LLM_BURST", "8"))
+CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "6"))
+IN_RUN_RETRIES = int(os.getenv("LLM_IN_RUN_RETRIES", "3"))
+CALL_TIMEOUT = float(os.getenv("LLM_CALL_TIMEOUT", "60"))
+LEASE_SECONDS = 300
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 900
+
+queue_collection = storage.client['mailmind_work']['enrich_queue']
+_index_ready = False
+
+last_drain_stats = {}
+
+
+# ---------------- Model clients ----------------
+class GeminiClient:
+    """
+    Default client: the shared secondarymodel Gemini instance, called through secondarymodel._generate
+    on a worker thread. The sync client is not tied to an event loop (the grpc.aio client behind
+    generate_content_async stays bound to the first drain's loop), and the calls show up in get_llm_stats.
+    """
+
+    async def generate(self, prompt, **kwargs):
+        response = await asyncio.to_thread(secondarymodel._generate, prompt, **kwargs)
+        return response.text
+
+
+class FakeClient:
+    """Local stand-in for load tests: fixed latency, optional failure rate, canned JSON answer."""
+
+    def __init__(self, latency=0.05, error_rate=0.0, answer=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.answer = answer
+        self.calls = 0
+
+    async def generate(self, prompt, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            raise RuntimeError("429 fake rate limit")
+        if self.answer is not None:
+            return self.answer
+        fake = {"event": None, "summary": "Fake summary."}
+        if "Emails:\n" in prompt:
+            # batched prompt: answer every id it carries
+            emails = json.loads(prompt.split("Emails:\n", 1)[1])
+            return json.dumps([{"id": e["id"], **fake} for e in emails])
+        return json.dumps(fake)
+
+
+_client = GeminiClient()
+
+
+def set_client(client):
+    """Swap the model client (e.g. FakeClient) used by subsequent drains."""
+    global _client
+    _client = client
+
+
+# ---------------- Rate limiting / backoff ----------------
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def backoff_seconds(attempt):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+
+# ---------------- Persistent queue ----------------
+def _ensure_index():
+    global _index_ready
+    if _index_ready:
+        return
+    queue_collection.create_index([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next")
+    queue_collection.create_index([("user_id", ASCENDING), ("status", ASCENDING), ("next_attempt_at", ASCENDING)],
+                                  name="user_status_next")
+    storage.ensure_retention_ttl(queue_collection, "created_at")
+    _index_ready = True
+
+
+def enqueue(user_id, docs):
+    """Queue [{'_id', 'body'}, ...] for enrichment; re-enqueueing an existing item is a no-op."""
+    if not docs:
+        return 0
+    _ensure_index()
+    now = datetime.datetime.utcnow()
+    ops = [
+        UpdateOne(
+            {"_id": f"{user_id}:{d['_id']}"},
+            {"$setOnInsert": {
+                "user_id": user_id,
+                "doc_id": d["_id"],
+                "body": d.get("body", ""),
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "created_at": now,
+            }},
+            upsert=True
+        )
+        for d in docs
+    ]
+    res = queue_collection.bulk_write(ops, ordered=False)
+    return res.upserted_count
+
+
+def _claim_next(user_id=None):
+    now = datetime.datetime.utcnow()
+    scope = {"user_id": user_id} if user_id else {}
+    return queue_collection.find_one_and_update(
+        {**scope, "$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            # worker died mid-item
+            {"status": "in_progress", "lease_until": {"$lt": now}},
+        ]},
+        {"$set": {"status": "in_progress", "lease_until": now + datetime.timedelta(seconds=LEASE_SECONDS)}},
+        sort=[("next_attempt_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def pending_count():
+    return queue_collection.count_documents({"status": {"$in": ["pending", "in_progress"]}})
+
+
+def _reschedule(item, error):
+    attempts = item.get("attempts", 0) + 1
+    if attempts >= MAX_ATTEMPTS:
+        print(f"[ERROR] enrichment gave up on {item['_id']} after {attempts} attempts: {error}")
+        storage.apply_updates(item["user_id"], [(item["doc_id"], {"summary": "(summary failed)", "enrichment": "failed"})])
+        # the failure record stays for inspection, the mail body does not
+        queue_collection.update_one(
+            {"_id": item["_id"]},
+            {"$set": {"status": "failed", "attempts": attempts, "error": str(error),
+                      "failed_at": datetime.datetime.utcnow()},
+             "$unset": {"body": ""}}
+        )
+        return "failed"
+    delay = backoff_seconds(attempts)
+    queue_collection.update_one(
+        {"_id": item["_id"]},
+        {"$set": {
+            "status": "pending",
+            "attempts": attempts,
+            "error": str(error),
+            "next_attempt_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=delay),
+        }}
+    )
+    return "retry_later"
+
+
+def _apply_results(done, creds_cache):
+    """
+    Write back [(item, result), ...]: per user, one Calendar batch for all events,
+    one bulk update of the mail docs and one delete of the finished queue items.
+    """
+    by_user = {}
+    for item, result in done:
+        by_user.setdefault(item["user_id"], []).append((item, result))
+
+    for user_id, pairs in by_user.items():
+        events = [(item["doc_id"], result["event"]) for item, result in pairs if result.get("event")]
+        cal_links = {}
+        if events:
+            if user_id not in creds_cache:
+                creds_cache[user_id] = fetch.load_token_from_db_by_userid(user_id)[0]
+            creds = creds_cache[user_id]
+            if creds:
+                cal_links = secondarymodel.add_events_batch(user_id, creds, events)
+
+        updates = []
+        for item, result in pairs:
+            upd = {"enrichment": "done"}
+            if result.get("event"):
+                upd["event"] = result["event"]
+                upd["cal_link"] = cal_links.get(item["doc_id"])
+            else:
+                upd["summary"] = result["summary"]
+            updates.append((item["doc_id"], upd))
+        storage.apply_updates(user_id, updates)
+        queue_collection.delete_many({"_id": {"$in": [item["_id"] for item, _ in pairs]}})
+
+
+# ---------------- Worker ----------------
+async def _call_single(body, bucket, stats):
+    await bucket.acquire()
+    stats["llm_calls"] += 1
+    text = await asyncio.wait_for(
+        _client.generate(
+            secondarymodel.ENRICH_PROMPT.format(email_body=body),
+            generation_config={"response_mime_type": "application/json"},
+        ),
+        timeout=CALL_TIMEOUT
+    )
+    return secondarymodel.validate_enrichment(secondarymodel.parse_json_answer(text))
+
+
+async def _call_batch(batch, bucket, stats, remember):
+    """
+    One request for [(id, body), ...]; a malformed answer is split in half and retried.
+    Returns ({id: answer}, {id: error}): a single email whose own request fails only costs that
+    email. Answers are handed to remember() (the cache) as soon as they are parsed.
+    """
+    if len(batch) == 1:
+        item_id, body = batch[0]
+        try:
+            answers = {item_id: await _call_single(body, bucket, stats)}
+        except Exception as e:
+            return {}, {item_id: e}
+        await remember(answers)
+        return answers, {}
+    await bucket.acquire()
+    stats["llm_calls"] += 1
+    stats["batched_items"] += len(batch)
+    try:
+        text = await asyncio.wait_for(
+            _client.generate(
+                secondarymodel.build_batch_prompt(batch),
+                generation_config={"response_mime_type": "application/json"},
+            ),
+            timeout=CALL_TIMEOUT
+        )
+        answers = secondarymodel.parse_batch_answer(text, {i for i, _ in batch})
+    except secondarymodel.EnrichmentSchemaError:
+        stats["batch_splits"] += 1
+        mid = len(batch) // 2
+        left, left_errors = await _call_batch(batch[:mid], bucket, stats, remember)
+        right, right_errors = await _call_batch(batch[mid:], bucket, stats, remember)
+        return {**left, **right}, {**left_errors, **right_errors}
+    except Exception as e:
+        return {}, {item_id: e for item_id, _ in batch}
+    await remember(answers)
+    return answers, {}
+
+
+async def _enrich_group(items, bucket, stats):
+    """
+    Cached answers first; misses are packed by token budget into batched prompts.
+    Returns ({item id: answer}, {item id: error}).
+    """
+    results, errors, misses, keys = {}, {}, [], {}
+    for item in items:
+        body = item.get("body", "")
+        keys[item["_id"]] = llmcache.cache_key("enrich", secondarymodel.ENRICH_PROMPT_VERSION, body)
+        found, value = await asyncio.to_thread(llmcache.get, keys[item["_id"]])
+        if found:
+            stats["cache_hits"] += 1
+            results[item["_id"]] = value
+        else:
+            misses.append((item["_id"], body))
+
+    async def remember(answers):
+        for item_id, value in answers.items():
+            await asyncio.to_thread(llmcache.put, keys[item_id], "enrich", value)
+
+    for batch in secondarymodel.pack_batches(misses):
+        answers, failed = await _call_batch(batch, bucket, stats, remember)
+        results.update(answers)
+        errors.update(failed)
+    return results, errors
+
+
+async def _drain(max_items, verbose, user_id=None):
+    _ensure_index()
+    bucket = TokenBucket(RATE_PER_SEC, BURST)
+    work = asyncio.Queue(maxsize=CONCURRENCY * secondarymodel.BATCH_MAX_ITEMS)   # bounded: claims stop while workers are busy
+    creds_cache = {}
+    stats = {"claimed": 0, "done": 0, "cache_hits": 0, "llm_calls": 0, "batched_items": 0, "batch_splits": 0,
+             "retries": 0, "retry_later": 0, "failed": 0, "queue_peak": 0}
+
+    async def producer():
+        while max_items is None or stats["claimed"] < max_items:
+            item = await asyncio.to_thread(_claim_next, user_id)
+            if item is None:
+                break
+            stats["claimed"] += 1
+            await work.put(item)
+            stats["queue_peak"] = max(stats["queue_peak"], work.qsize())
+        for _ in range(CONCURRENCY):
+            await work.put(None)
+
+    async def process_group(group):
+        pending, later, errors = group, [], {}
+        for attempt in range(IN_RUN_RETRIES + 1):
+            try:
+                results, failed_errors = await _enrich_group(pending, bucket, stats)
+            except Exception as e:
+                results, failed_errors = {}, {item["_id"]: e for item in pending}
+            errors.update(failed_errors)
+            done = [(item, results[item["_id"]]) for item in pending if item["_id"] in results]
+            if done:
+                await asyncio.to_thread(_apply_results, done, creds_cache)
+                stats["done"] += len(done)
+            # a malformed answer is not transient: leave it to the cross-tick backoff
+            failed = [item for item in pending if item["_id"] not in results]
+            later += [item for item in failed if isinstance(errors.get(item["_id"]), secondarymodel.EnrichmentSchemaError)]
+            pending = [item for item in failed if not isinstance(errors.get(item["_id"]), secondarymodel.EnrichmentSchemaError)]
+            if not pending:
+                break
+            if attempt < IN_RUN_RETRIES:
+                stats["retries"] += len(pending)
+                if verbose:
+                    print(f"[WARN] enrichment retry {attempt + 1} for {len(pending)} items: "
+                          f"{errors.get(pending[0]['_id'])}")
+                await asyncio.sleep(backoff_seconds(attempt))
+        for item in later + pending:
+            outcome = await asyncio.to_thread(_reschedule, item, errors.get(item["_id"]))
+            stats[outcome] += 1
+
+    async def worker():
+        done = False
+        while not done:
+            item = await work.get()
+            if item is None:
+                return
+            # take whatever else is ready so it can share a prompt
+            group = [item]
+            while len(group) < secondarymodel.BATCH_MAX_ITEMS:
+                try:
+                    nxt = work.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if nxt is None:
+                    done = True
+                    break
+                group.append(nxt)
+            await process_group(group)
+
+    started = time.perf_counter()
+    await asyncio.gather(producer(), *(worker() for _ in range(CONCURRENCY)))
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def drain(max_items=None, verbose=False, user_id=None):
+    """
+    Process due queue items until the queue is empty (or max_items). Blocks; returns stats.
+    With user_id only that user's items are claimed (claims are atomic, so this can run
+    alongside the scheduler's drain of everything).
+    """
+    global last_drain_stats
+    try:
+        stats = asyncio.run(_drain(max_items, verbose, user_id))
+    except Exception as e:
+        print(f"[ERROR] enrichment drain: {e}")
+        stats = {"error": str(e)}
+    if user_id is None:
+        last_drain_stats = stats
+    if verbose:
+        print(f"[INFO] enrichment drain: {stats}")
+    return stats
@@ -0,0 +1,158 @@
+# featurecache.py
+# Stored sparse feature rows for the spam model, keyed by (vectorizer version, stored email _id).
+# Each row is the CSR slice of one message: int32 column indices and float32 values,
+# zlib-compressed. Re-scoring a message with a new model (same vectorizer) reads the row
+# instead of re-tokenizing subject + body.
+import os
+import json
+import time
+import zlib
+import hashlib
+import datetime
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+from bson.binary import Binary
+from pymongo.errors import BulkWriteError
+from sklearn.feature_extraction.text import HashingVectorizer
+
+import storage
+
+ENABLED = os.getenv("FEATURE_CACHE", "on") == "on"
+# rows are derived from mail bodies (see storage.ensure_retention_ttl)
+TTL_SECONDS = int(os.getenv("FEATURE_CACHE_TTL_SECONDS", str(storage.DEFAULT_RETENTION_SECONDS)))
+
+_collection = storage.client['mailmind_cache']['features']
+
+_lock = threading.Lock()
+stats = {"hits": 0, "misses": 0, "stored": 0, "read_seconds": 0.0, "transform_seconds": 0.0}
+
+
+def vectorizer_version(vectorizer, artifact_digest: str = None) -> str:
+    """
+    HashingVectorizer output depends only on its parameters, so its version survives retrains.
+    A fitted vocabulary (TF-IDF) is versioned by its artifact digest.
+    """
+    if isinstance(vectorizer, HashingVectorizer):
+        params = json.dumps(vectorizer.get_params(), sort_keys=True, default=str)
+        return "hash-" + hashlib.sha256(params.encode('utf-8')).hexdigest()[:12]
+    return "vocab-" + (artifact_digest or "unknown")[:12]
+
+
+def message_key(doc) -> str:
+    """The stored email's _id: one cache serves every user, and Gmail ids are only unique per mailbox."""
+    return str(doc["_id"])
+
+
+def doc_text(doc) -> str:
+    return f"{doc.get('body') or ''} {doc.get('subject') or ''}"
+
+
+def encode_row(row) -> dict:
+    """One CSR row -> compressed indices/values."""
+    return {
+        "nnz": int(row.nnz),
+        "indices": Binary(zlib.compress(row.indices.astype(np.int32).tobytes())),
+        "data": Binary(zlib.compress(row.data.astype(np.float32).tobytes())),
+    }
+
+
+def decode_row(doc):
+    indices = np.frombuffer(zlib.decompress(doc["indices"]), dtype=np.int32)
+    data = np.frombuffer(zlib.decompress(doc["data"]), dtype=np.float32)
+    return indices, data
+
+
+def _store(version, keys, X):
+    storage.ensure_retention_ttl(_collection, "created_at", TTL_SECONDS)
+    now = datetime.datetime.utcnow()
+    docs = [{"_id": f"{version}:{key}", "version": version, "created_at": now, **encode_row(X[i])}
+            for i, key in enumerate(keys)]
+    try:
+        _collection.insert_many(docs, ordered=False)
+        stored = len(docs)
+    except BulkWriteError as e:
+        # concurrent writers computed the same rows; those copies are identical
+        stored = e.details.get("nInserted", 0)
+    except Exception as e:
+        print(f"[WARN] feature cache write failed: {e}")
+        stored = 0
+    with _lock:
+        stats["stored"] += stored
+
+
+def _with_text(docs, fill):
+    """docs with subject/body: fill(docs) loads them for docs that only carry ids."""
+    if fill is None or not docs:
+        return docs
+    loaded = {d["_id"]: d for d in fill(docs)}
+    return [loaded.get(d["_id"], d) for d in docs]
+
+
+def transform(docs, vectorizer, version: str, fill=None):
+    """
+    Feature matrix for docs (CSR, float64, rows aligned with docs).
+    Cached rows are read in one query; only misses go through vectorizer.transform and are stored.
+    With fill, docs may carry just _id: fill(missing docs) returns them with subject/body,
+    so text is only read for cache misses.
+    """
+    n_features = _n_features(vectorizer)
+    if not ENABLED or not version or n_features is None:
+        start = time.perf_counter()
+        X = vectorizer.transform([doc_text(d) for d in _with_text(docs, fill)])
+        with _lock:
+            stats["misses"] += len(docs)
+            stats["transform_seconds"] += time.perf_counter() - start
+        return X
+
+    keys = [message_key(d) for d in docs]
+    start = time.perf_counter()
+    try:
+        found = {doc["_id"].split(":", 1)[1]: decode_row(doc)
+                 for doc in _collection.find({"_id": {"$in": [f"{version}:{k}" for k in keys]}})}
+    except Exception as e:
+        print(f"[WARN] feature cache lookup failed: {e}")
+        found = {}
+    read_seconds = time.perf_counter() - start
+
+    missing = [i for i, k in enumerate(keys) if k not in found]
+    start = time.perf_counter()
+    if missing:
+        texts = _with_text([docs[i] for i in missing], fill)
+        X_new = sp.csr_matrix(vectorizer.transform([doc_text(d) for d in texts]))
+        X_new.sort_indices()
+        _store(version, [keys[i] for i in missing], X_new)
+        for row, i in enumerate(missing):
+            found[keys[i]] = (X_new[row].indices, X_new[row].data)
+    transform_seconds = time.perf_counter() - start
+
+    rows = [found[k] for k in keys]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(idx) for idx, _ in rows])
+    indices = np.concatenate([idx for idx, _ in rows]) if rows else np.empty(0, dtype=np.int32)
+    data = np.concatenate([val for _, val in rows]).astype(np.float64) if rows else np.empty(0)
+    with _lock:
+        stats["hits"] += len(keys) - len(missing)
+        stats["misses"] += len(missing)
+        stats["read_seconds"] += read_seconds
+        stats["transform_seconds"] += transform_seconds
+    return sp.csr_matrix((data, indices, indptr), shape=(len(rows), n_features))
+
+
+def _n_features(vectorizer):
+    if isinstance(vectorizer, HashingVectorizer):
+        return vectorizer.n_features
+    if hasattr(vectorizer, "n_features_"):
+        return vectorizer.n_features_
+    vocab = getattr(vectorizer, "vocabulary_", None)
+    return len(vocab) if vocab is not None else None
+
+
+def get_stats() -> dict:
+    with _lock:
+        snapshot = dict(stats)
+    lookups = snapshot["hits"] + snapshot["misses"]
+    snapshot["hit_rate"] = round(snapshot["hits"] / lookups, 3) if lookups else None
+    snapshot["enabled"] = ENABLED
+    return snapshot
@@ -0,0 +1,135 @@
+# llmcache.py
+# Content-addressed cache for Gemini responses: in-memory LRU in front of a TTL'd Mongo collection.
+import os
+import re
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+
+import storage
+
+LRU_SIZE = int(os.getenv("LLM_CACHE_LRU_SIZE", "2048"))
+# answers are derived from mail bodies (see storage.ensure_retention_ttl)
+TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(storage.DEFAULT_RETENTION_SECONDS)))
+
+_collection = storage.client['mailmind_cache']['llm_responses']
+
+_lock = threading.Lock()
+_lru = OrderedDict()
+stats = {
+    "memory_hits": 0,
+    "mongo_hits": 0,
+    "misses": 0,
+    "hit_seconds": 0.0,
+    "miss_seconds": 0.0,
+}
+
+_QUOTE_RE = re.compile(r'^\s*>+\s?', re.MULTILINE)
+_WS_RE = re.compile(r'\s+')
+
+
+def prompt_version(template: str) -> str:
+    """Short hash of a prompt template; editing the template changes every cache key built from it."""
+    return hashlib.sha256(template.encode('utf-8')).hexdigest()[:12]
+
+
+def normalize_body(body) -> str:
+    """
+    Collapse the differences that don't change the answer: whitespace and quote markers.
+    Case and URLs are kept: meeting links and codes are case-sensitive and end up in the answer.
+    """
+    text = str(body or '')
+    text = _QUOTE_RE.sub('', text)
+    text = _WS_RE.sub(' ', text)
+    return text.strip()
+
+
+def cache_key(kind: str, version: str, body) -> str:
+    h = hashlib.sha256()
+    h.update(f"{kind}:{version}:".encode('utf-8'))
+    h.update(normalize_body(body).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _remember(key, value, created=None):
+    with _lock:
+        _lru[key] = (value, created or time.time())
+        _lru.move_to_end(key)
+        while len(_lru) > LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+def get(key):
+    """Return (found, value). Every lookup counts as a hit or a miss, whichever path made it."""
+    now = time.time()
+    with _lock:
+        if key in _lru:
+            value, created = _lru[key]
+            if now - created < TTL_SECONDS:
+                _lru.move_to_end(key)
+                stats["memory_hits"] += 1
+                return True, value
+            del _lru[key]
+    try:
+        doc = _collection.find_one({"_id": key}, {"value": 1, "created_at": 1})
+    except Exception as e:
+        print(f"[WARN] llm cache lookup failed: {e}")
+        doc = None
+    created = _timestamp(doc.get("created_at")) if doc else None
+    # the TTL monitor only runs about once a minute; don't serve what it hasn't removed yet
+    if doc is None or (created and now - created >= TTL_SECONDS):
+        with _lock:
+            stats["misses"] += 1
+        return False, None
+    with _lock:
+        stats["mongo_hits"] += 1
+    _remember(key, doc.get("value"), created)
+    return True, doc.get("value")
+
+
+def _timestamp(created_at):
+    return created_at.replace(tzinfo=datetime.timezone.utc).timestamp() if created_at else None
+
+
+def put(key, kind, value):
+    _remember(key, value)
+    storage.ensure_retention_ttl(_collection, "created_at", TTL_SECONDS)
+    try:
+        _collection.update_one(
+            {"_id": key},
+            {"$set": {"kind": kind, "value": value, "created_at": datetime.datetime.utcnow()}},
+            upsert=True
+        )
+    except Exception as e:
+        print(f"[WARN] llm cache write failed: {e}")
+
+
+def cached_call(kind: str, version: str, body, compute):
+    """
+    Return compute(body) through the cache. compute should raise on transient failures
+    so that errors are never cached; None is a valid (cached) answer.
+    """
+    start = time.perf_counter()
+    key = cache_key(kind, version, body)
+    found, value = get(key)
+    if found:
+        with _lock:
+            stats["hit_seconds"] += time.perf_counter() - start
+        return value
+
+    value = compute(body)
+    put(key, kind, value)
+    with _lock:
+        stats["miss_seconds"] += time.perf_counter() - start
+    return value
+
+
+def get_stats() -> dict:
+    with _lock:
+        snapshot = dict(stats)
+        snapshot["lru_entries"] = len(_lru)
+    lookups = snapshot["memory_hits"] + snapshot["mongo_hits"] + snapshot["misses"]
+    snapshot["hit_rate"] = round((lookups - snapshot["misses"]) / lookups, 3) if lookups else None
+    return snapshot
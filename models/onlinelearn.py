@@ -0,0 +1,246 @@
+# onlinelearn.py
+# Online learning from users' spam corrections.
+# /feedback records a correction (and fixes the email's label right away); a scheduler job
+# claims unapplied corrections in micro-batches, partial_fits a copy of the serving model on
+# them, saves the result as a new artifact version and promotes it. The registry swaps the
+# model reference under its lock, so classify_batch callers never see a half-updated model.
+#
+# An applied correction keeps the feature row it was learned from (not the mail text), so a
+# later opposite correction of the same email first subtracts it (negative sample weight)
+# instead of stacking both labels on the model.
+import os
+import json
+import uuid
+import datetime
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+from pymongo import ASCENDING, UpdateOne
+
+import storage
+from models import primarymodel, featurecache, artifacts
+
+MICRO_BATCH = int(os.getenv("SPAM_FEEDBACK_BATCH", "64"))
+# a correction counts as this many training examples
+FEEDBACK_WEIGHT = float(os.getenv("SPAM_FEEDBACK_WEIGHT", "5"))
+KEEP_VERSIONS = int(os.getenv("SPAM_KEEP_VERSIONS", "10"))
+LEASE_SECONDS = 300
+# corrections per user per day that train the shared model; beyond it only the user's own label changes
+USER_DAILY_CAP = int(os.getenv("SPAM_FEEDBACK_USER_DAILY_CAP", "50"))
+
+feedback_collection = storage.client['mailmind_work']['spam_feedback']
+_index_ready = False
+
+_lock = threading.Lock()
+stats = {"recorded": 0, "capped": 0, "applied": 0, "unlearned": 0, "updates": 0, "update_errors": 0,
+         "last_version": None, "last_update_at": None}
+
+
+def _ensure_index():
+    global _index_ready
+    if _index_ready:
+        return
+    feedback_collection.create_index([("user_id", ASCENDING), ("doc_id", ASCENDING)], unique=True, name="user_doc")
+    feedback_collection.create_index([("applied", ASCENDING), ("created_at", ASCENDING)], name="applied_created")
+    feedback_collection.create_index([("user_id", ASCENDING), ("created_at", ASCENDING)], name="user_created")
+    storage.ensure_retention_ttl(feedback_collection, "created_at")
+    _index_ready = True
+
+
+def record_feedback(user_id, doc, is_spam):
+    """
+    Store a correction for one stored email and relabel the email immediately.
+    doc needs _id, subject, body.
+    A second correction of the same email replaces the first; if the first was already learned
+    it is subtracted when the second is applied. Returns False if the user is over
+    SPAM_FEEDBACK_USER_DAILY_CAP: the email is relabelled but the model does not learn from it.
+    """
+    _ensure_index()
+    now = datetime.datetime.utcnow()
+    storage.apply_updates(user_id, [(doc["_id"], {"spam": bool(is_spam), "spam_feedback": bool(is_spam)})])
+    if _over_cap(user_id, doc["_id"], now):
+        with _lock:
+            stats["capped"] += 1
+        return False
+    # claim is left alone: a batch holding this correction releases it, and it is picked up again
+    feedback_collection.update_one(
+        {"user_id": user_id, "doc_id": doc["_id"]},
+        {"$set": {
+            "subject": doc.get("subject", ""),
+            "body": doc.get("body", ""),
+            "label": bool(is_spam),
+            "applied": False,
+            "created_at": now,
+        }, "$setOnInsert": {"claim": None}},
+        upsert=True
+    )
+    with _lock:
+        stats["recorded"] += 1
+    return True
+
+
+def _over_cap(user_id, doc_id, now):
+    """Re-correcting an email already counted today does not use up another slot."""
+    if USER_DAILY_CAP <= 0:
+        return False
+    since = now - datetime.timedelta(days=1)
+    recent = feedback_collection.count_documents(
+        {"user_id": user_id, "created_at": {"$gte": since}, "doc_id": {"$ne": doc_id}})
+    return recent >= USER_DAILY_CAP
+
+
+def _claim_batch(limit):
+    now = datetime.datetime.utcnow()
+    stale = now - datetime.timedelta(seconds=LEASE_SECONDS)
+    query = {"applied": False, "$or": [{"claim": None}, {"claimed_at": {"$lt": stale}}]}
+    ids = [d["_id"] for d in feedback_collection.find(query, {"_id": 1}).sort("created_at", ASCENDING).limit(limit)]
+    if not ids:
+        return None, []
+    token = uuid.uuid4().hex
+    feedback_collection.update_many({"_id": {"$in": ids}, **query}, {"$set": {"claim": token, "claimed_at": now}})
+    return token, list(feedback_collection.find({"claim": token}))
+
+
+def apply_feedback(max_batches=None, verbose=False):
+    """
+    Apply pending corrections, one micro-batch per new model version. Returns batches applied.
+    The serving model is never mutated: each batch trains a copy, which is then promoted.
+    """
+    _ensure_index()
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        token, items = _claim_batch(MICRO_BATCH)
+        if not items:
+            break
+        try:
+            version, learned = _update_model(items)
+        except Exception as e:
+            print(f"[ERROR] spam model update failed: {e}")
+            feedback_collection.update_many({"claim": token}, {"$set": {"claim": None}})
+            with _lock:
+                stats["update_errors"] += 1
+            break
+        _mark_applied(token, items, version, learned)
+        batches += 1
+        with _lock:
+            stats["applied"] += len(items)
+            stats["unlearned"] += sum(1 for fields in learned.values() if fields.get("unlearned"))
+            if learned:
+                stats["updates"] += 1
+                stats["last_version"] = version
+                stats["last_update_at"] = datetime.datetime.utcnow()
+        if verbose:
+            print(f"[INFO] spam model {version}: learned from {len(learned)} of {len(items)} corrections")
+    if batches:
+        primarymodel.prune_versions(KEEP_VERSIONS)
+    return batches
+
+
+def _mark_applied(token, items, version, learned):
+    """
+    Record what each correction taught the model and drop its mail text.
+    A correction changed again while it was being applied keeps its text and stays pending
+    (the new label is learned next run, subtracting what was just learned).
+    """
+    now = datetime.datetime.utcnow()
+    ops = []
+    for item in items:
+        fields = {k: v for k, v in learned.get(item["_id"], {}).items() if k != "unlearned"}
+        ops.append(UpdateOne(
+            {"_id": item["_id"], "claim": token, "label": item["label"]},
+            {"$set": {"applied": True, "applied_version": version, "applied_at": now, "claim": None, **fields},
+             "$unset": {"subject": "", "body": ""}}
+        ))
+        ops.append(UpdateOne({"_id": item["_id"], "claim": token}, {"$set": {"claim": None, **fields}}))
+    feedback_collection.bulk_write(ops, ordered=True)
+
+
+def _lineage(info):
+    """
+    Base version the serving model's feedback updates descend from. A correction learned on
+    another lineage (e.g. before a batch retrain) is not in the serving model, so it is not subtracted.
+    """
+    version = info["version"]
+    if not version:
+        return "legacy:" + (info["digest"] or "")[:12]
+    try:
+        with open(os.path.join(primarymodel.ARTIFACT_DIR, version, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return version
+    return manifest.get("feedback_base") or version
+
+
+def _update_model(items):
+    """Train a copy of the serving model on items; returns (version, {item _id: applied_* fields})."""
+    serving, vectorizer = primarymodel.load_model_and_vectorizer(force_check=True)
+    info = primarymodel.get_model_stats()
+    base = _lineage(info)
+    # the label this copy of the email already taught the model is not learned twice
+    changed = [item for item in items if not (item.get("applied_label") == item["label"]
+                                              and item.get("applied_base") == base)]
+    if not changed:
+        return info["version"], {}
+    # the serving arrays may be read-only mmaps shared with other workers
+    model = artifacts.writable(serving)
+    classes = model.classes_
+
+    # cached rows are keyed by the email's _id, not the correction's
+    emails = [{"_id": item["doc_id"], "subject": item.get("subject"), "body": item.get("body")} for item in changed]
+    X = featurecache.transform(emails, vectorizer, info["vectorizer_version"])
+    # learn exactly the stored (float32) row, so subtracting it later cancels it
+    X.data = X.data.astype(np.float32).astype(np.float64)
+    y = [_as_class(classes, item["label"]) for item in changed]
+    weights = [FEEDBACK_WEIGHT] * len(changed)
+    learned = {}
+    undo = []
+    for i, item in enumerate(changed):
+        fields = {"applied_label": item["label"], "applied_row": featurecache.encode_row(X[i]),
+                  "applied_base": base}
+        if item.get("applied_label") is not None and item.get("applied_base") == base and item.get("applied_row"):
+            undo.append(item)
+            fields["unlearned"] = True
+        learned[item["_id"]] = fields
+    if undo:
+        n_features = X.shape[1]
+        rows = [featurecache.decode_row(item["applied_row"]) for item in undo]
+        X = sp.vstack([X] + [sp.csr_matrix((data.astype(np.float64), indices, [0, len(indices)]),
+                                           shape=(1, n_features)) for indices, data in rows], format="csr")
+        y += [_as_class(classes, item["applied_label"]) for item in undo]
+        weights += [-FEEDBACK_WEIGHT] * len(undo)
+    model.partial_fit(X, np.array(y), sample_weight=np.array(weights))
+
+    version = primarymodel.save_artifacts(model, vectorizer, {
+        "trainer": "feedback",
+        "parent": info["version"],
+        "parent_digest": info["digest"],
+        "feedback_base": base,
+        "corrections": len(changed),
+        "spam_corrections": int(sum(1 for item in changed if item["label"])),
+        "unlearned": len(undo),
+        "sample_weight": FEEDBACK_WEIGHT,
+    })
+    primarymodel.promote(version)
+    # swap now in this process; other processes follow CURRENT on their next reload check
+    primarymodel.load_model_and_vectorizer(force_check=True)
+    return version, learned
+
+
+def _as_class(classes, is_spam):
+    """Map a boolean correction onto the model's own label values (0/1, True/False, 'spam'/'ham')."""
+    spam_idx = primarymodel.spam_class_index(classes)
+    if is_spam:
+        return classes[spam_idx]
+    return classes[1 - spam_idx] if len(classes) == 2 else classes[0]
+
+
+def pending_count():
+    return feedback_collection.count_documents({"applied": False})
+
+
+def get_stats():
+    with _lock:
+        snapshot = dict(stats)
+    snapshot["pending"] = pending_count()
+    return snapshot
@@ -1,54 +1,376 @@
 # primarymodel.py
 
 import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
 from sklearn.naive_bayes import MultinomialNB
 import pickle
+import shutil
+
+from models import featurecache, artifacts
 
 MODEL_PATH = "spam_classifier_model.pkl"
 VECTORIZER_PATH = "vectorizer.pkl"
+DATASET_PATH = 'datapreprocessing/processeddataset/processed.csv'
+
+# versioned artifacts: <ARTIFACT_DIR>/<version>/ holds memory-mapped .npy arrays + JSON metadata
+# (see artifacts.py) and manifest.json; older versions may hold {model,vectorizer}.pkl instead.
+# CURRENT names the promoted version. Without a CURRENT the root-level pickles above are converted
+# and promoted on first load (SPAM_CONVERT_LEGACY=off serves them as pickles, with a warning).
+ARTIFACT_DIR = os.getenv("SPAM_ARTIFACT_DIR", "model_artifacts")
+CURRENT_POINTER = os.path.join(ARTIFACT_DIR, "CURRENT")
+CONVERT_LEGACY = os.getenv("SPAM_CONVERT_LEGACY", "on") == "on"
+# one process converts (under an O_EXCL lock file); the others wait this long for its CURRENT
+CONVERT_WAIT_SECONDS = float(os.getenv("SPAM_CONVERT_WAIT_SECONDS", "60"))
+CONVERT_LOCK = os.path.join(ARTIFACT_DIR, ".convert.lock")
+
+# how often (seconds) the registry stats the artifacts to look for a retrained model
+RELOAD_CHECK_SECONDS = float(os.getenv("MODEL_RELOAD_CHECK_SECONDS", "30"))
+
+# tfidf: fitted vocabulary (original); hashing: stateless HashingVectorizer, fixed memory, no vocabulary lookup
+FEATURE_MODE = os.getenv("SPAM_FEATURE_MODE", "tfidf")
+HASH_N_FEATURES = int(os.getenv("SPAM_HASH_FEATURES", str(2 ** 18)))
+
+# -------------------- Model registry --------------------
+# process-wide: the model/vectorizer pair is loaded once and shared by every caller;
+# array artifacts are mmap'd, so workers on one host share the pages too
+_registry_lock = threading.Lock()
+_registry = {
+    "model": None,
+    "vectorizer": None,
+    "signature": None,   # ((model path, vectorizer path), ((mtime_ns, size), (mtime_ns, size)))
+    "digest": None,      # sha256 over both artifacts, used to skip no-op reloads
+    "vectorizer_version": None,  # feature cache namespace; unchanged by a model-only retrain
+    "version": None,     # promoted artifact version, None for the root-level pickles
+    "checked_at": 0.0,
+    "loaded_at": None,
+    "legacy_checked": False,   # root-level pickles converted (or warned about) once per process
+}
+_stats = {
+    "loads": 0,
+    "load_seconds": 0.0,
+    "reload_checks": 0,
+    "predict_calls": 0,
+    "predict_rows": 0,
+    "predict_seconds": 0.0,
+}
+
+def make_vectorizer(mode=None):
+    if (mode or FEATURE_MODE) == "hashing":
+        # non-negative counts, l2-normalised: MultinomialNB needs non-negative features
+        return HashingVectorizer(stop_words='english', n_features=HASH_N_FEATURES,
+                                 alternate_sign=False, norm='l2')
+    return TfidfVectorizer(stop_words='english', max_features=5000)
 
 def train_model():
-    print("[INFO] Training model from dataset...")
-    df = pd.read_csv('datapreprocessing/processeddataset/processed.csv')
+    print(f"[INFO] Training model from dataset ({FEATURE_MODE} features)...")
+    df = pd.read_csv(DATASET_PATH)
     df['comt'] = df['body'] + ' ' + df['subject']
     X = df['comt']
     y = df['is_spam']
-    vectorizer = TfidfVectorizer(stop_words='english', max_features=5000)
+    vectorizer = make_vectorizer()
     X_tfidf = vectorizer.fit_transform(X)
     model = MultinomialNB()
     model.fit(X_tfidf, y)
-    with open(MODEL_PATH, 'wb') as model_file:
-        pickle.dump(model, model_file)
-    with open(VECTORIZER_PATH, 'wb') as vec_file:
-        pickle.dump(vectorizer, vec_file)
-    print("[INFO] Training complete. Model saved.")
-
-def load_model_and_vectorizer():
-    if not os.path.exists(MODEL_PATH) or not os.path.exists(VECTORIZER_PATH):
-        train_model()
+    version = save_artifacts(model, vectorizer, {"trainer": "batch", "feature_mode": FEATURE_MODE,
+                                                  "dataset": os.path.abspath(DATASET_PATH), "rows": len(df)})
+    promote(version)
+    print(f"[INFO] Training complete. Model saved as {version}.")
+
+def convert_legacy():
+    """Re-save the root-level pickles in the array format and promote them."""
     with open(MODEL_PATH, 'rb') as model_file:
         model = pickle.load(model_file)
     with open(VECTORIZER_PATH, 'rb') as vec_file:
         vectorizer = pickle.load(vec_file)
+    version = save_artifacts(model, vectorizer, {"trainer": "converted", "source": [MODEL_PATH, VECTORIZER_PATH]})
+    promote(version)
+    return version
+
+def _convert_root_pickles():
+    """
+    Called without a CURRENT: convert the root-level pickles once so serving never unpickles them.
+    On failure (or with SPAM_CONVERT_LEGACY=off) the pickles are served as before, with a warning.
+    """
+    if _registry["legacy_checked"] or not (os.path.exists(MODEL_PATH) and os.path.exists(VECTORIZER_PATH)):
+        return
+    _registry["legacy_checked"] = True
+    if CONVERT_LEGACY:
+        try:
+            if _convert_once():
+                return
+        except Exception as e:
+            print(f"[WARN] Converting {MODEL_PATH} / {VECTORIZER_PATH} failed: {e}")
+    print(f"[WARN] Serving pickled {MODEL_PATH} / {VECTORIZER_PATH}; "
+          "run `python -m models.primarymodel convert` to switch to array artifacts")
+
+def _convert_once():
+    """
+    Convert under an exclusive lock file so N workers starting together promote one version.
+    A process that finds the lock taken waits for the holder's CURRENT. Returns True once a
+    CURRENT exists.
+    """
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    deadline = time.monotonic() + CONVERT_WAIT_SECONDS
+    while True:
+        try:
+            fd = os.open(CONVERT_LOCK, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if current_version():
+                return True
+            if time.monotonic() >= deadline:
+                print(f"[WARN] {CONVERT_LOCK} still held after {CONVERT_WAIT_SECONDS:.0f}s; remove it if no "
+                      "conversion is running")
+                return False
+            time.sleep(0.5)
+    try:
+        os.close(fd)
+        # the previous holder may have finished between our check and the lock
+        if not current_version():
+            version = convert_legacy()
+            print(f"[INFO] Converted {MODEL_PATH} / {VECTORIZER_PATH} to array artifacts ({version})")
+        return True
+    finally:
+        os.remove(CONVERT_LOCK)
+
+# -------------------- Versioned artifacts --------------------
+def current_version():
+    try:
+        with open(CURRENT_POINTER) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def artifact_paths(version=None):
+    """
+    (model path, vectorizer path) of `version`, the promoted version, or the root-level pickles.
+    For array artifacts these are the JSON metadata files, which carry the arrays' digests.
+    """
+    version = version or current_version()
+    if version:
+        d = os.path.join(ARTIFACT_DIR, version)
+        if os.path.exists(os.path.join(d, artifacts.MODEL_META)):
+            return os.path.join(d, artifacts.MODEL_META), os.path.join(d, artifacts.VECTORIZER_META)
+        return os.path.join(d, "model.pkl"), os.path.join(d, "vectorizer.pkl")
+    return MODEL_PATH, VECTORIZER_PATH
+
+def save_artifacts(model, vectorizer, manifest, version=None):
+    """Write a new immutable artifact version (not yet served) and return its name."""
+    version = version or datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    final_dir = os.path.join(ARTIFACT_DIR, version)
+    tmp_dir = final_dir + ".tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    artifacts.save_model(tmp_dir, model)
+    artifacts.save_vectorizer(tmp_dir, vectorizer)
+    with open(os.path.join(tmp_dir, "manifest.json"), 'w') as f:
+        json.dump({"version": version, **manifest}, f, indent=2, default=str)
+    os.replace(tmp_dir, final_dir)
+    return version
+
+def promote(version):
+    """Atomically point CURRENT at `version`; every process's registry picks it up on its next check."""
+    if not os.path.exists(artifact_paths(version)[0]):
+        raise FileNotFoundError(f"artifact version {version} not found under {ARTIFACT_DIR}")
+    tmp = CURRENT_POINTER + ".tmp"
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.replace(tmp, CURRENT_POINTER)
+    print(f"[INFO] Promoted spam model {version}")
+
+def prune_versions(keep):
+    """Delete all but the newest `keep` artifact versions (the promoted one is always kept)."""
+    current = current_version()
+    try:
+        versions = sorted(d for d in os.listdir(ARTIFACT_DIR)
+                          if os.path.isdir(os.path.join(ARTIFACT_DIR, d)) and not d.endswith(".tmp"))
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    for version in versions[:-keep] if keep > 0 else versions:
+        if version == current:
+            continue
+        shutil.rmtree(os.path.join(ARTIFACT_DIR, version), ignore_errors=True)
+        removed += 1
+    return removed
+
+def _artifact_signature():
+    paths = artifact_paths()
+    sig = []
+    for path in paths:
+        st = os.stat(path)
+        sig.append((st.st_mtime_ns, st.st_size))
+    return paths, tuple(sig)
+
+def _artifact_digest(paths=(MODEL_PATH, VECTORIZER_PATH)):
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def _read_pair(model_path, vectorizer_path):
+    if model_path.endswith(".json"):
+        directory = os.path.dirname(model_path)
+        return artifacts.load_model(directory), artifacts.load_vectorizer(directory)
+    with open(model_path, 'rb') as model_file:
+        model = pickle.load(model_file)
+    with open(vectorizer_path, 'rb') as vec_file:
+        vectorizer = pickle.load(vec_file)
     return model, vectorizer
 
-def classify_emails(useremails):
+def _load_artifacts(signature, digest, attempts=3):
+    """
+    Load the pair named by signature and install it in the registry.
+    Version directories are immutable, but root-level pickles can be replaced one file at a time
+    while we read them: the pair is only installed if the digest still matches after loading.
+    Returns False (registry untouched) if the artifacts kept changing under us.
+    """
+    for _ in range(attempts):
+        model_path, vectorizer_path = signature[0]
+        start = time.perf_counter()
+        model, vectorizer = _read_pair(model_path, vectorizer_path)
+        elapsed = time.perf_counter() - start
+
+        after = _artifact_signature()
+        if after == signature or _artifact_digest(after[0]) == digest:
+            break
+        print("[WARN] Model artifacts changed while loading, reloading")
+        signature, digest = after, _artifact_digest(after[0])
+    else:
+        return False
+
+    vectorizer_version = featurecache.vectorizer_version(vectorizer, _artifact_digest((vectorizer_path,)))
+    version = os.path.basename(os.path.dirname(model_path)) or None
+
+    _registry.update({
+        "model": model,
+        "vectorizer": vectorizer,
+        "vectorizer_version": vectorizer_version,
+        "version": version,
+        "signature": signature,
+        "digest": digest,
+        "loaded_at": time.time(),
+    })
+    _stats["loads"] += 1
+    _stats["load_seconds"] += elapsed
+    print(f"[INFO] Loaded spam model {version or model_path} ({elapsed:.3f}s, digest={digest[:12]})")
+    return True
+
+def load_model_and_vectorizer(force_check=False):
+    """
+    Return the resident (model, vectorizer) pair.
+    Artifacts are loaded on first use and hot-reloaded when a retrained pair is
+    dropped in place or a new version is promoted (mtime/size change and a different content hash).
+    Root-level pickles without a CURRENT are converted to a promoted version first.
+    Never trains: missing artifacts raise FileNotFoundError.
+    """
+    now = time.monotonic()
+    with _registry_lock:
+        loaded = _registry["model"] is not None
+        if loaded and not force_check and now - _registry["checked_at"] < RELOAD_CHECK_SECONDS:
+            return _registry["model"], _registry["vectorizer"]
+
+        _registry["checked_at"] = now
+        _stats["reload_checks"] += 1
+        if current_version() is None:
+            _convert_root_pickles()
+        try:
+            signature = _artifact_signature()
+        except FileNotFoundError:
+            if loaded:
+                # artifact mid-replace or removed; keep serving the resident copy
+                print("[WARN] Model artifacts missing on disk, keeping resident model")
+                return _registry["model"], _registry["vectorizer"]
+            raise FileNotFoundError(
+                f"{MODEL_PATH} / {VECTORIZER_PATH} not found; run `python -m models.primarymodel` to train"
+            )
+
+        if signature != _registry["signature"]:
+            digest = _artifact_digest(signature[0])
+            if digest != _registry["digest"]:
+                if not _load_artifacts(signature, digest):
+                    if not loaded:
+                        raise RuntimeError("spam model artifacts kept changing while loading; retry later")
+                    print("[WARN] Model artifacts still changing, keeping resident model")
+            else:
+                # touched but identical content
+                _registry["signature"] = signature
+
+        return _registry["model"], _registry["vectorizer"]
+
+def get_model_stats():
+    """Snapshot of registry load / predict counters."""
+    with _registry_lock:
+        stats = dict(_stats)
+        stats["digest"] = _registry["digest"]
+        stats["loaded_at"] = _registry["loaded_at"]
+        stats["vectorizer_version"] = _registry["vectorizer_version"]
+        stats["version"] = _registry["version"]
+    stats["feature_cache"] = featurecache.get_stats()
+    return stats
+
+def spam_class_index(classes):
+    for i, c in enumerate(classes):
+        if c is True or str(c).strip().lower() in ("1", "true", "spam"):
+            return i
+    return len(classes) - 1
+
+def _spam_class_index(model):
+    return spam_class_index(model.classes_)
+
+def classify_batch(docs, fill=None):
+    """
+    Classify docs from any number of users in one vectorized pass.
+    docs: iterable of mappings with '_id', 'subject', 'body' (or only '_id' plus
+    fill, which loads subject/body for feature-cache misses; see featurecache.transform).
+    Returns {'ids': ndarray[object], 'labels': ndarray[bool] (True = spam),
+             'proba': ndarray[float] (spam probability)}, aligned with the input order.
+    """
+    docs = list(docs)
+    if not docs:
+        return {"ids": np.empty(0, dtype=object), "labels": np.empty(0, dtype=bool), "proba": np.empty(0)}
+
     model, vectorizer = load_model_and_vectorizer()
-    test_df = pd.DataFrame(useremails)
-    if test_df.empty:
+    with _registry_lock:
+        # a reload between the two reads would pair features with the wrong vectorizer; skip the cache then
+        version = _registry["vectorizer_version"] if _registry["vectorizer"] is vectorizer else None
+    ids = np.fromiter((d.get("_id") for d in docs), dtype=object, count=len(docs))
+
+    start = time.perf_counter()
+    X = featurecache.transform(docs, vectorizer, version, fill=fill)
+    proba = model.predict_proba(X)[:, _spam_class_index(model)]
+    elapsed = time.perf_counter() - start
+    with _registry_lock:
+        _stats["predict_calls"] += 1
+        _stats["predict_rows"] += len(docs)
+        _stats["predict_seconds"] += elapsed
+
+    return {"ids": ids, "labels": proba >= 0.5, "proba": proba}
+
+def classify_emails(useremails):
+    """Backwards-compatible wrapper returning one dict per email."""
+    records = pd.DataFrame(useremails).to_dict(orient='records') if not isinstance(useremails, list) else useremails
+    if not records:
         return []
-    test_df['subject'] = test_df.get('subject', '(No Subject)')
-    test_df['body'] = test_df.get('body', '(No Body)')
-    test_df['combined_text'] = test_df['body'].fillna('') + ' ' + test_df['subject'].fillna('')
-    X_test_tfidf = vectorizer.transform(test_df['combined_text'])
-    predictions = model.predict(X_test_tfidf)
-    result = []
-    for i, email in test_df.iterrows():
-        result.append({
-            'subject': email['subject'],
-            'body': email['body'],
-            'prediction': 'Spam' if predictions[i] == 1 else 'Not Spam'
-        })
-    return result   # ✅ FIXED HERE
+    out = classify_batch(records)
+    return [
+        {'subject': r.get('subject', '(No Subject)'),
+         'body': r.get('body', '(No Body)'),
+         'prediction': 'Spam' if spam else 'Not Spam'}
+        for r, spam in zip(records, out["labels"])
+    ]
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["convert"]:
+        convert_legacy()
+    else:
+        train_model()
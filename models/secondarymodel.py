@@ -1,7 +1,8 @@
 import google.generativeai as genai
-import json, re, datetime
-from pymongo import MongoClient
-from calender import add_events_to_calendar
+import json, re, time, datetime, threading
+from collections import deque
+import calender
+from models import llmcache
 import os
 from dotenv import load_dotenv
 
@@ -10,45 +11,201 @@ load_dotenv()
 
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
-# MongoDB setup
-db_client = MongoClient(os.getenv("mongo_uri"))
-db = db_client['Emails']
-
 # Create model instance ONCE
 model = genai.GenerativeModel("models/gemini-2.0-flash-001")
 
+# call counters + recent latencies for every generate_content round-trip
+_llm_lock = threading.Lock()
+_llm_latencies = deque(maxlen=1000)
+llm_stats = {"calls": 0, "errors": 0, "seconds": 0.0}
+
+
+def _generate(prompt, **kwargs):
+    start = time.perf_counter()
+    try:
+        return model.generate_content(prompt, **kwargs)
+    except Exception:
+        with _llm_lock:
+            llm_stats["errors"] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        with _llm_lock:
+            llm_stats["calls"] += 1
+            llm_stats["seconds"] += elapsed
+            _llm_latencies.append(elapsed)
+
+
+def _percentile(sorted_vals, q):
+    if not sorted_vals:
+        return None
+    idx = min(len(sorted_vals) - 1, int(round(q * (len(sorted_vals) - 1))))
+    return round(sorted_vals[idx], 4)
 
-def extract_event(email_body):
-    if isinstance(email_body, tuple):
-        email_body = email_body[0]
 
-    prompt = f"""
+def get_llm_stats():
+    with _llm_lock:
+        snapshot = dict(llm_stats)
+        lat = sorted(_llm_latencies)
+    snapshot["p50_seconds"] = _percentile(lat, 0.50)
+    snapshot["p99_seconds"] = _percentile(lat, 0.99)
+    return snapshot
+
+
+EVENT_PROMPT = """
 Extract an EVENT from this email if any exists.
 Return JSON with fields: "title", "date", "start_time", "end_time", "location", "description".
 If no event → return {{}}
 Email:
 \"\"\"{email_body}\"\"\""""
 
+SUMMARY_PROMPT = "Summarize the following email in 2-3 concise sentences:\n\"\"\"{email_body}\"\"\""
+
+ENRICH_PROMPT = """
+Read the email below and answer with a single JSON object, no prose:
+{{"event": null or {{"title": str, "date": "YYYY-MM-DD", "start_time": "HH:MM", "end_time": "HH:MM",
+                   "location": str, "description": str}},
+  "summary": "2-3 concise sentences summarizing the email"}}
+Use "event": null when the email does not describe a concrete event with a date.
+Email:
+\"\"\"{email_body}\"\"\""""
+
+BATCH_ENRICH_PROMPT = """
+For EACH email in the JSON array below, extract the event (if any) and write a summary.
+Answer with a JSON array only, exactly one object per input email, echoing its "id":
+[{{"id": "<email id>",
+   "event": null or {{"title": str, "date": "YYYY-MM-DD", "start_time": "HH:MM", "end_time": "HH:MM",
+                     "location": str, "description": str}},
+   "summary": "2-3 concise sentences summarizing that email"}}]
+Use "event": null when an email does not describe a concrete event with a date.
+Emails:
+{emails_json}"""
+
+# batches are packed by an approximate token budget (~4 chars per token)
+BATCH_TOKEN_BUDGET = int(os.getenv("LLM_BATCH_TOKEN_BUDGET", "6000"))
+BATCH_MAX_ITEMS = int(os.getenv("LLM_BATCH_MAX_ITEMS", "20"))
+BATCH_MAX_BODY_CHARS = int(os.getenv("LLM_BATCH_MAX_BODY_CHARS", "4000"))
+
+# cache keys include these, so editing a template invalidates its cached answers
+EVENT_PROMPT_VERSION = llmcache.prompt_version(EVENT_PROMPT)
+SUMMARY_PROMPT_VERSION = llmcache.prompt_version(SUMMARY_PROMPT)
+# single and batched prompts produce the same record, so either template changing invalidates it
+ENRICH_PROMPT_VERSION = llmcache.prompt_version(ENRICH_PROMPT + BATCH_ENRICH_PROMPT)
+
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_TIME_RE = re.compile(r'^\d{1,2}:\d{2}$')
+EVENT_FIELDS = ("title", "date", "start_time", "end_time", "location", "description")
+
+
+class EnrichmentSchemaError(ValueError):
+    """The combined enrichment answer did not match the expected schema."""
+
+
+def _parses(value, fmt):
+    try:
+        datetime.datetime.strptime(value, fmt)
+        return True
+    except ValueError:
+        return False
+
+
+def _normalize_event(event):
+    """
+    Apply the extract_event defaults and validate the event. Returns None for no event.
+    A malformed event is dropped with a warning so the rest of the answer (the summary) is kept.
+    """
+    if not event:
+        return None
     try:
-        response = model.generate_content(prompt)
-        text = response.text.strip()
+        return _validate_event(event)
+    except EnrichmentSchemaError as e:
+        print(f"[WARN] dropping malformed event: {e}")
+        return None
+
+
+def _validate_event(event):
+    if not isinstance(event, dict):
+        raise EnrichmentSchemaError(f"event must be an object or null, got {type(event).__name__}")
+    if not event.get("title") or not event.get("date"):
+        return None
+
+    event = {k: event.get(k) for k in EVENT_FIELDS}
+    event["start_time"] = event["start_time"] or "00:00"
+    event["end_time"] = event["end_time"] or "01:00"
+    event["location"] = event["location"] or "N/A"
+    event["description"] = event["description"] or ""
+    for k in EVENT_FIELDS:
+        if not isinstance(event[k], str):
+            raise EnrichmentSchemaError(f"event.{k} must be a string")
+    # the regexes pin the shape, strptime the values (2026-02-30 and 25:00 match the regexes)
+    if not _DATE_RE.match(event["date"]) or not _parses(event["date"], "%Y-%m-%d"):
+        raise EnrichmentSchemaError(f"event.date not YYYY-MM-DD: {event['date']!r}")
+    for k in ("start_time", "end_time"):
+        if not _TIME_RE.match(event[k]) or not _parses(event[k], "%H:%M"):
+            raise EnrichmentSchemaError(f"event.{k} not HH:MM: {event[k]!r}")
+    return event
+
+
+def validate_enrichment(data):
+    """Validate a parsed combined answer -> {'event': dict | None, 'summary': str}."""
+    if not isinstance(data, dict):
+        raise EnrichmentSchemaError("answer must be a JSON object")
+    summary = data.get("summary")
+    if not isinstance(summary, str) or not summary.strip():
+        raise EnrichmentSchemaError("summary must be a non-empty string")
+    return {"event": _normalize_event(data.get("event")), "summary": summary.strip()}
+
 
-        match = re.search(r'({.*})', text, re.DOTALL)
+def parse_json_answer(text):
+    text = (text or "").strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        match = re.search(r'([\[{].*[\]}])', text, re.DOTALL)
         if not match:
-            return None
+            raise EnrichmentSchemaError("no JSON found in model answer")
+        try:
+            return json.loads(match.group(1))
+        except ValueError as e:
+            raise EnrichmentSchemaError(f"malformed JSON: {e}")
+
+
+def _extract_event_uncached(email_body):
+    # API errors propagate so they are not cached; "no event" is cached as None
+    response = _generate(EVENT_PROMPT.format(email_body=email_body))
+    text = response.text.strip()
+
+    match = re.search(r'({.*})', text, re.DOTALL)
+    if not match:
+        return None
 
+    try:
         event = json.loads(match.group(1))
+    except ValueError:
+        return None
+
+    if not event.get("title") or not event.get("date"):
+        return None
+
+    event.setdefault("start_time", "00:00")
+    event.setdefault("end_time", "01:00")
+    event.setdefault("location", "N/A")
+    event.setdefault("description", "")
 
-        if not event.get("title") or not event.get("date"):
-            return None
+    return event
 
-        event.setdefault("start_time", "00:00")
-        event.setdefault("end_time", "01:00")
-        event.setdefault("location", "N/A")
-        event.setdefault("description", "")
 
-        return event
+def _summarize_uncached(email_body):
+    response = _generate(SUMMARY_PROMPT.format(email_body=email_body))
+    return response.text.strip()
+
+
+def extract_event(email_body):
+    if isinstance(email_body, tuple):
+        email_body = email_body[0]
 
+    try:
+        return llmcache.cached_call("event", EVENT_PROMPT_VERSION, email_body, _extract_event_uncached)
     except Exception as e:
         print(f"[ERROR extract_event]: {e}")
         return None
@@ -58,30 +215,148 @@ def summarize_email(email_body):
     if isinstance(email_body, tuple):
         email_body = email_body[0]
 
-    prompt = f"Summarize the following email in 2-3 concise sentences:\n\"\"\"{email_body}\"\"\""
-
     try:
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        return llmcache.cached_call("summary", SUMMARY_PROMPT_VERSION, email_body, _summarize_uncached)
     except Exception as e:
         print(f"[ERROR summarize_email]: {e}")
         return None
 
 
-def cache_and_add_event(user_id, email_id, creds, event_details):
-    events_collection = db[f"{user_id}_events"]
+def _enrich_uncached(email_body):
+    response = _generate(
+        ENRICH_PROMPT.format(email_body=email_body),
+        generation_config={"response_mime_type": "application/json"},
+    )
+    return validate_enrichment(parse_json_answer(response.text))
 
-    existing = events_collection.find_one({"email_id": email_id})
-    if not existing:
-        events_collection.insert_one({
-            "email_id": email_id,
-            **event_details,
-            "added_at": datetime.datetime.utcnow()
-        })
+
+def enrich_email(email_body):
+    """
+    One LLM round-trip returning {'event': dict | None, 'summary': str}.
+    Returns None when the call fails or the answer does not validate.
+    """
+    if isinstance(email_body, tuple):
+        email_body = email_body[0]
 
     try:
-        cal_link = add_events_to_calendar(creds, event_details)
-        return cal_link
+        return llmcache.cached_call("enrich", ENRICH_PROMPT_VERSION, email_body, _enrich_uncached)
     except Exception as e:
-        print(f"[ERROR adding to calendar]: {e}")
+        print(f"[ERROR enrich_email]: {e}")
         return None
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def pack_batches(items, token_budget=None, max_items=None):
+    """
+    Group [(id, body), ...] into batches whose prompt fits token_budget.
+    Bodies are truncated to BATCH_MAX_BODY_CHARS; a body that alone exceeds the budget goes in its own batch.
+    """
+    token_budget = token_budget or BATCH_TOKEN_BUDGET
+    max_items = max_items or BATCH_MAX_ITEMS
+    overhead = estimate_tokens(BATCH_ENRICH_PROMPT)
+    batches, current, used = [], [], overhead
+    for item_id, body in items:
+        body = str(body or "")[:BATCH_MAX_BODY_CHARS]
+        cost = estimate_tokens(body) + 8
+        if current and (used + cost > token_budget or len(current) >= max_items):
+            batches.append(current)
+            current, used = [], overhead
+        current.append((str(item_id), body))
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_batch_prompt(batch):
+    emails_json = json.dumps([{"id": i, "email": body} for i, body in batch], ensure_ascii=False)
+    return BATCH_ENRICH_PROMPT.format(emails_json=emails_json)
+
+
+def parse_batch_answer(text, expected_ids):
+    """Map a JSON array answer back to {id: {'event', 'summary'}}; any missing/invalid entry is malformed."""
+    data = parse_json_answer(text)
+    if not isinstance(data, list):
+        raise EnrichmentSchemaError("batch answer must be a JSON array")
+    results = {}
+    for entry in data:
+        if isinstance(entry, dict) and str(entry.get("id")) in expected_ids:
+            results[str(entry["id"])] = validate_enrichment(entry)
+    missing = set(expected_ids) - set(results)
+    if missing:
+        raise EnrichmentSchemaError(f"batch answer missing {len(missing)} ids")
+    return results
+
+
+def _enrich_batch_with_split(batch, remember):
+    """
+    One request for the batch; a malformed answer is retried as two half-size batches.
+    Returns {id: answer} for the emails that got one: a single email whose own request fails
+    is only missing from the result. Answers are handed to remember() as soon as they are parsed.
+    """
+    if len(batch) == 1:
+        item_id, body = batch[0]
+        try:
+            answers = {item_id: _enrich_uncached(body)}
+        except Exception as e:
+            print(f"[ERROR enrich_emails_batch] email {item_id}: {e}")
+            return {}
+    else:
+        try:
+            response = _generate(build_batch_prompt(batch), generation_config={"response_mime_type": "application/json"})
+            answers = parse_batch_answer(response.text, {i for i, _ in batch})
+        except EnrichmentSchemaError as e:
+            print(f"[WARN] malformed batch answer ({len(batch)} emails), splitting: {e}")
+            mid = len(batch) // 2
+            return {**_enrich_batch_with_split(batch[:mid], remember),
+                    **_enrich_batch_with_split(batch[mid:], remember)}
+        except Exception as e:
+            print(f"[ERROR enrich_emails_batch] batch of {len(batch)}: {e}")
+            return {}
+    remember(answers)
+    return answers
+
+
+def enrich_emails_batch(items):
+    """
+    Batched enrich_email: items is [(id, body), ...]; returns {id: {'event', 'summary'} | None}.
+    Cached answers are reused and only the misses are packed into prompts.
+    """
+    results, misses, keys = {}, [], {}
+    for item_id, body in items:
+        item_id = str(item_id)
+        keys[item_id] = llmcache.cache_key("enrich", ENRICH_PROMPT_VERSION, body)
+        found, value = llmcache.get(keys[item_id])
+        if found:
+            results[item_id] = value
+        else:
+            misses.append((item_id, body))
+
+    def remember(answers):
+        for item_id, value in answers.items():
+            llmcache.put(keys[item_id], "enrich", value)
+
+    for batch in pack_batches(misses):
+        answers = _enrich_batch_with_split(batch, remember)
+        for item_id, _ in batch:
+            results[item_id] = answers.get(item_id)
+    return results
+
+
+def add_events_batch(user_id, creds, items):
+    """
+    Cache and calendar [(email_id, event_details), ...] for one user in one batch.
+    Returns {email_id: cal_link}; calendar API failures leave the links None.
+    """
+    try:
+        return calender.sync_events(user_id, creds, items)
+    except Exception as e:
+        print(f"[ERROR adding to calendar]: {e}")
+        return {email_id: None for email_id, _ in items}
+
+
+def cache_and_add_event(user_id, email_id, creds, event_details):
+    return add_events_batch(user_id, creds, [(email_id, event_details)]).get(email_id)
@@ -0,0 +1,152 @@
+# streamtrain.py
+# Out-of-core training for the spam model: the labelled CSV is read in chunks, each chunk is
+# hashed into features on all cores (HashingVectorizer is stateless, so workers need no shared
+# vocabulary) and fed to MultinomialNB.partial_fit. Memory is bounded by the chunk size and the
+# model's n_classes x n_features counts, not by the dataset.
+#
+#   python -m models.streamtrain [--csv path] [--chunk-size 50000] [--jobs N] [--promote]
+import os
+import sys
+import time
+import argparse
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.naive_bayes import MultinomialNB
+
+from models import primarymodel
+
+CHUNK_SIZE = int(os.getenv("SPAM_TRAIN_CHUNK_SIZE", "50000"))
+CLASSES = np.array([0, 1])
+SPAM_LABELS = ("1", "1.0", "true", "spam")
+HAM_LABELS = ("0", "0.0", "false", "ham")
+
+_worker_vectorizer = None
+
+
+def _init_worker(params):
+    global _worker_vectorizer
+    _worker_vectorizer = primarymodel.make_vectorizer("hashing").set_params(**params)
+
+
+def _hash_texts(texts):
+    return _worker_vectorizer.transform(texts)
+
+
+def _labels(series):
+    """
+    is_spam as 0/1 whatever the CSV used (0/1, True/False, spam/ham).
+    Returns (labels, known): rows with any other value (including NaN) have known=False.
+    """
+    text = series.astype(str).str.strip().str.lower()
+    spam = text.isin(SPAM_LABELS)
+    known = spam | text.isin(HAM_LABELS)
+    return spam.astype(np.int64).to_numpy(), known.to_numpy()
+
+
+def iter_chunks(csv_path, chunk_size, unknown=None):
+    """
+    Yield (texts, labels) per CSV chunk; only body, subject and is_spam are read.
+    Rows with an unrecognised label are skipped and counted in unknown ({raw value: rows}).
+    """
+    for df in pd.read_csv(csv_path, usecols=['body', 'subject', 'is_spam'], dtype={'body': str, 'subject': str},
+                          chunksize=chunk_size):
+        labels, known = _labels(df['is_spam'])
+        if not known.all():
+            bad = df['is_spam'][~known].astype(str)
+            print(f"[WARN] skipping {len(bad)} rows with unknown is_spam values: {sorted(set(bad))[:5]}")
+            if unknown is not None:
+                for value, n in bad.value_counts().items():
+                    unknown[value] = unknown.get(value, 0) + int(n)
+            df, labels = df[known], labels[known]
+        texts = (df['body'].fillna('') + ' ' + df['subject'].fillna('')).tolist()
+        yield texts, labels
+
+
+def train_streaming(csv_path=None, chunk_size=CHUNK_SIZE, n_jobs=None, promote=False, verbose=True):
+    """
+    Train MultinomialNB on hashed features chunk by chunk and save a new artifact version.
+    Every chunk is scored before it is learned from (progressive validation), so the reported
+    accuracy is on data the model had not seen yet. Returns the manifest.
+    """
+    csv_path = csv_path or primarymodel.DATASET_PATH
+    n_jobs = n_jobs or os.cpu_count() or 1
+    vectorizer = primarymodel.make_vectorizer("hashing")
+    model = MultinomialNB()
+    params = vectorizer.get_params()
+
+    started = time.perf_counter()
+    rows = chunks = correct = scored = 0
+    hash_seconds = predict_seconds = fit_seconds = 0.0
+    unknown = {}
+    source = hashlib.sha256()
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(params,)) as pool:
+        for texts, y in iter_chunks(csv_path, chunk_size, unknown):
+            if not texts:
+                continue
+            t0 = time.perf_counter()
+            step = max(1, -(-len(texts) // n_jobs))
+            parts = [texts[i:i + step] for i in range(0, len(texts), step)]
+            X = sp.vstack(list(pool.map(_hash_texts, parts)), format='csr')
+            t1 = time.perf_counter()
+            if chunks:
+                correct += int((model.predict(X) == y).sum())
+                scored += len(y)
+            t2 = time.perf_counter()
+            model.partial_fit(X, y, classes=CLASSES)
+            t3 = time.perf_counter()
+            hash_seconds += t1 - t0
+            predict_seconds += t2 - t1
+            fit_seconds += t3 - t2
+
+            rows += len(y)
+            chunks += 1
+            source.update(f"{len(y)}:{int(y.sum())};".encode())
+            if verbose:
+                print(f"[INFO] chunk {chunks}: {rows} rows, hash {t1 - t0:.2f}s, predict {t2 - t1:.2f}s, fit {t3 - t2:.2f}s")
+
+    if not rows:
+        raise ValueError(f"no rows read from {csv_path}")
+    manifest = {
+        "trainer": "streaming",
+        "feature_mode": "hashing",
+        "vectorizer_params": {k: v for k, v in params.items() if k != 'dtype'},
+        "dataset": os.path.abspath(csv_path),
+        "dataset_shape_digest": source.hexdigest()[:16],
+        "rows": rows,
+        "skipped_unknown_labels": sum(unknown.values()),
+        "unknown_label_values": dict(sorted(unknown.items(), key=lambda kv: -kv[1])[:20]),
+        "chunks": chunks,
+        "chunk_size": chunk_size,
+        "n_jobs": n_jobs,
+        "class_counts": model.class_count_.tolist(),
+        "progressive_accuracy": round(correct / scored, 4) if scored else None,
+        "hash_seconds": round(hash_seconds, 3),
+        "predict_seconds": round(predict_seconds, 3),
+        "fit_seconds": round(fit_seconds, 3),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    version = primarymodel.save_artifacts(model, vectorizer, manifest)
+    manifest["version"] = version
+    print(f"[INFO] Saved spam model {version}: {rows} rows, progressive accuracy {manifest['progressive_accuracy']}")
+    if promote:
+        primarymodel.promote(version)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chunked, out-of-core training of the spam model.")
+    parser.add_argument("--csv", default=primarymodel.DATASET_PATH, help="labelled CSV with body, subject, is_spam")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--jobs", type=int, default=None, help="feature extraction processes (default: all cores)")
+    parser.add_argument("--promote", action="store_true", help="serve the new version once saved")
+    args = parser.parse_args(argv)
+    train_streaming(args.csv, chunk_size=args.chunk_size, n_jobs=args.jobs, promote=args.promote)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
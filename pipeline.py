@@ -0,0 +1,245 @@
+# pipeline.py
+# Staged worker-pool pipeline used by the background scheduler:
+#   fetch (per user, N workers) -> classify (cross-user micro-batches) -> enrich (per user, N workers) -> persist
+import os
+import time
+import queue
+import threading
+
+FETCH_WORKERS = int(os.getenv("PIPELINE_FETCH_WORKERS", "4"))
+ENRICH_WORKERS = int(os.getenv("PIPELINE_ENRICH_WORKERS", "4"))
+QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "16"))
+CLASSIFY_BATCH_DOCS = int(os.getenv("PIPELINE_CLASSIFY_BATCH_DOCS", "512"))
+
+_STOP = object()
+
+# users currently owned by some tick; overlapping scheduler runs skip them
+_active_lock = threading.Lock()
+_active_users = set()
+
+last_tick_stats = {}
+
+
+def _claim_users(user_ids):
+    with _active_lock:
+        claimed = [u for u in user_ids if u not in _active_users]
+        _active_users.update(claimed)
+    return claimed
+
+
+def _release_user(user_id):
+    with _active_lock:
+        _active_users.discard(user_id)
+
+
+def active_users():
+    with _active_lock:
+        return sorted(_active_users)
+
+
+class Pipeline:
+    """
+    One tick of background processing.
+
+    fetch_fn(user_doc) -> (user_id, creds, docs) | None
+        docs=None defers the pending lookup to pending_fn, run once after all fetches
+    pending_fn(user_ids) -> {user_id: docs} (e.g. storage.find_pending_many)
+    classify_fn(docs) -> dict of arrays aligned with docs (e.g. primarymodel.classify_batch)
+    enrich_fn(user_id, creds, docs, labels, probas) -> list of (doc_id, update)
+    persist_fn(user_id, updates) -> None
+    """
+
+    def __init__(self, fetch_fn, classify_fn, enrich_fn, persist_fn, pending_fn=None,
+                 fetch_workers=FETCH_WORKERS, enrich_workers=ENRICH_WORKERS,
+                 queue_size=QUEUE_SIZE, classify_batch_docs=CLASSIFY_BATCH_DOCS, verbose=False):
+        self.fetch_fn = fetch_fn
+        self.classify_fn = classify_fn
+        self.enrich_fn = enrich_fn
+        self.persist_fn = persist_fn
+        self.pending_fn = pending_fn
+        self.fetch_workers = max(1, fetch_workers)
+        self.enrich_workers = max(1, enrich_workers)
+        self.queue_size = queue_size
+        self.classify_batch_docs = classify_batch_docs
+        self.verbose = verbose
+
+        self._stats_lock = threading.Lock()
+        self.stats = {}
+        self._deferred = {}
+
+    # ---------------- stats helpers ----------------
+    def _bump(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def _put(self, q, stage, item):
+        q.put(item)
+        depth = q.qsize()
+        with self._stats_lock:
+            peaks = self.stats["queue_peak"]
+            peaks[stage] = max(peaks.get(stage, 0), depth)
+
+    def _error(self, stage, user_id, exc):
+        print(f"[ERROR] pipeline {stage} failed for {user_id}: {exc}")
+        self._bump(f"{stage}_errors")
+        _release_user(user_id)
+
+    # ---------------- stages ----------------
+    def _fetch_worker(self, users_q, classify_q):
+        while True:
+            try:
+                user_doc = users_q.get_nowait()
+            except queue.Empty:
+                return
+            user_id = user_doc.get("user_id")
+            try:
+                item = self.fetch_fn(user_doc)
+            except Exception as e:
+                self._error("fetch", user_id, e)
+                continue
+            if item and item[2] is None and self.pending_fn:
+                with self._stats_lock:
+                    self._deferred[item[0]] = item[1]
+                continue
+            if not item or not item[2]:
+                # nothing pending, user is done for this tick
+                _release_user(user_id)
+                continue
+            self._bump("users_with_work")
+            self._put(classify_q, "classify", item)
+
+    def _load_deferred(self, classify_q):
+        """One pending lookup for every user whose fetch deferred it."""
+        deferred, self._deferred = self._deferred, {}
+        if not deferred:
+            return
+        try:
+            grouped = self.pending_fn(list(deferred))
+        except Exception as e:
+            for user_id in deferred:
+                self._error("pending", user_id, e)
+            return
+        for user_id, creds in deferred.items():
+            docs = grouped.get(user_id)
+            if not docs:
+                _release_user(user_id)
+                continue
+            self._bump("users_with_work")
+            self._put(classify_q, "classify", (user_id, creds, docs))
+
+    def _classify_worker(self, classify_q, enrich_q):
+        done = False
+        while not done:
+            first = classify_q.get()
+            if first is _STOP:
+                return
+            batch, n_docs = [first], len(first[2])
+            # drain whatever else is ready, up to the doc budget
+            while n_docs < self.classify_batch_docs:
+                try:
+                    nxt = classify_q.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is _STOP:
+                    done = True
+                    break
+                batch.append(nxt)
+                n_docs += len(nxt[2])
+            self._classify_batch(batch, enrich_q)
+
+    def _classify_batch(self, batch, enrich_q):
+        all_docs = [d for _, _, docs in batch for d in docs]
+        try:
+            result = self.classify_fn(all_docs)
+        except Exception as e:
+            for user_id, _, _ in batch:
+                self._error("classify", user_id, e)
+            return
+        self._bump("classify_batches")
+        self._bump("docs", len(all_docs))
+
+        offset = 0
+        for user_id, creds, docs in batch:
+            end = offset + len(docs)
+            self._put(enrich_q, "enrich",
+                      (user_id, creds, docs, result["labels"][offset:end], result["proba"][offset:end]))
+            offset = end
+
+    def _enrich_worker(self, enrich_q, persist_q):
+        while True:
+            item = enrich_q.get()
+            if item is _STOP:
+                return
+            user_id, creds, docs, labels, probas = item
+            try:
+                updates = self.enrich_fn(user_id, creds, docs, labels, probas)
+            except Exception as e:
+                self._error("enrich", user_id, e)
+                continue
+            self._put(persist_q, "persist", (user_id, updates))
+
+    def _persist_worker(self, persist_q):
+        while True:
+            item = persist_q.get()
+            if item is _STOP:
+                return
+            user_id, updates = item
+            try:
+                self.persist_fn(user_id, updates)
+                self._bump("users_done")
+            except Exception as e:
+                self._bump("persist_errors")
+                print(f"[ERROR] pipeline persist failed for {user_id}: {e}")
+            finally:
+                _release_user(user_id)
+
+    # ---------------- driver ----------------
+    def run(self, user_docs):
+        """Process user_docs through every stage; blocks until the tick is done and returns stats."""
+        global last_tick_stats
+        started = time.perf_counter()
+        self.stats = {"queue_peak": {"classify": 0, "enrich": 0, "persist": 0}}
+
+        by_id = {}
+        for d in user_docs:
+            if d.get("user_id") and (d.get("creds_json") or d.get("creds_b64")):
+                by_id.setdefault(d["user_id"], d)
+        claimed = _claim_users(list(by_id))
+        self.stats["users_seen"] = len(by_id)
+        self.stats["users_skipped_in_flight"] = len(by_id) - len(claimed)
+
+        users_q = queue.Queue()
+        for user_id in claimed:
+            users_q.put(by_id[user_id])
+        classify_q = queue.Queue(maxsize=self.queue_size)
+        enrich_q = queue.Queue(maxsize=self.queue_size)
+        persist_q = queue.Queue(maxsize=self.queue_size)
+
+        def spawn(target, *args):
+            t = threading.Thread(target=target, args=args, daemon=True)
+            t.start()
+            return t
+
+        fetchers = [spawn(self._fetch_worker, users_q, classify_q) for _ in range(self.fetch_workers)]
+        classifier = spawn(self._classify_worker, classify_q, enrich_q)
+        enrichers = [spawn(self._enrich_worker, enrich_q, persist_q) for _ in range(self.enrich_workers)]
+        persister = spawn(self._persist_worker, persist_q)
+
+        for t in fetchers:
+            t.join()
+        self._load_deferred(classify_q)
+        classify_q.put(_STOP)
+        classifier.join()
+        for _ in enrichers:
+            enrich_q.put(_STOP)
+        for t in enrichers:
+            t.join()
+        persist_q.put(_STOP)
+        persister.join()
+
+        self.stats["tick_seconds"] = round(time.perf_counter() - started, 3)
+        self.stats["finished_at"] = time.time()
+        last_tick_stats = dict(self.stats)
+        if self.verbose:
+            print(f"[INFO] pipeline tick: {self.stats}")
+        return self.stats
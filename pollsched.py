@@ -0,0 +1,170 @@
+# pollsched.py
+# Adaptive per-user poll scheduler. Instead of polling every mailbox on one fixed interval,
+# each user gets a next-due time derived from:
+#   - recent mail arrival rate (EWMA of new messages per hour): busy mailboxes poll sooner
+#   - last dashboard visit: someone looking at the dashboard gets ACTIVE_INTERVAL at most
+#   - errors: exponential backoff, capped at MAX_BACKOFF
+# Due users are popped from a min-heap, at most MAX_CONCURRENT in flight at once.
+# Every decision is kept (last DECISION_LOG per user) so /poll-schedule can explain it.
+import os
+import time
+import heapq
+import threading
+from collections import deque
+
+MIN_INTERVAL = float(os.getenv("POLL_MIN_SECONDS", "30"))
+MAX_INTERVAL = float(os.getenv("POLL_MAX_SECONDS", "1800"))
+ACTIVE_INTERVAL = float(os.getenv("POLL_ACTIVE_SECONDS", "30"))
+ACTIVE_WINDOW = float(os.getenv("POLL_ACTIVE_WINDOW_SECONDS", "600"))
+MAX_BACKOFF = float(os.getenv("POLL_MAX_BACKOFF_SECONDS", "3600"))
+MAX_CONCURRENT = int(os.getenv("POLL_MAX_CONCURRENT", "8"))
+# aim for about this many new messages per poll
+TARGET_PER_POLL = float(os.getenv("POLL_TARGET_MESSAGES", "1"))
+RATE_ALPHA = float(os.getenv("POLL_RATE_ALPHA", "0.3"))
+DECISION_LOG = int(os.getenv("POLL_DECISION_LOG", "20"))
+
+_lock = threading.Lock()
+_heap = []        # (due, seq, user_id); stale entries skipped on pop
+_seq = 0
+_users = {}       # user_id -> state dict
+stats = {"polls": 0, "errors": 0, "skipped_cap": 0, "visits": 0}
+
+
+def _new_state(now):
+    return {
+        "due": now,
+        "rate_per_hour": 0.0,
+        "last_poll": None,
+        "last_visit": None,
+        "failures": 0,
+        "in_flight": False,
+        "decisions": deque(maxlen=DECISION_LOG),
+    }
+
+
+def _push(user_id, st, due, reason, now, **detail):
+    global _seq
+    st["due"] = due
+    _seq += 1
+    heapq.heappush(_heap, (due, _seq, user_id))
+    st["decisions"].append({"at": now, "next_in": round(due - now, 1), "reason": reason, **detail})
+
+
+def next_interval(st, now):
+    """(seconds until the next poll, reason) for one user's state."""
+    if st["failures"]:
+        return min(MAX_BACKOFF, MIN_INTERVAL * 2 ** st["failures"]), f"backoff after {st['failures']} error(s)"
+    rate = st["rate_per_hour"]
+    if rate > 0:
+        interval = min(MAX_INTERVAL, max(MIN_INTERVAL, TARGET_PER_POLL / rate * 3600))
+        reason = f"arrival rate {rate:.2f}/h"
+    else:
+        interval, reason = MAX_INTERVAL, "no recent mail"
+    if st["last_visit"] and now - st["last_visit"] < ACTIVE_WINDOW and interval > ACTIVE_INTERVAL:
+        interval, reason = ACTIVE_INTERVAL, "dashboard open recently"
+    return interval, reason
+
+
+def sync_users(user_ids, now=None):
+    """Track exactly user_ids: new users are due immediately, removed users are forgotten."""
+    now = now or time.time()
+    with _lock:
+        for user_id in user_ids:
+            if user_id not in _users:
+                st = _users[user_id] = _new_state(now)
+                _push(user_id, st, now, "new user", now)
+        for user_id in set(_users) - set(user_ids):
+            del _users[user_id]
+
+
+def take_due(now=None, limit=None):
+    """Pop users whose poll is due, respecting the global concurrency cap; marks them in flight."""
+    now = now or time.time()
+    with _lock:
+        in_flight = sum(1 for st in _users.values() if st["in_flight"])
+        room = MAX_CONCURRENT - in_flight
+        if limit is not None:
+            room = min(room, limit)
+        due = []
+        while _heap and _heap[0][0] <= now:
+            if len(due) >= room:
+                stats["skipped_cap"] += 1
+                break
+            when, _, user_id = heapq.heappop(_heap)
+            st = _users.get(user_id)
+            if not st or st["due"] != when or st["in_flight"]:
+                continue
+            st["in_flight"] = True
+            due.append(user_id)
+    return due
+
+
+def record_result(user_id, new_messages=0, error=None, now=None):
+    """Called once a poll of user_id finishes; reschedules it."""
+    now = now or time.time()
+    with _lock:
+        st = _users.get(user_id)
+        if not st:
+            return
+        st["in_flight"] = False
+        stats["polls"] += 1
+        if error:
+            stats["errors"] += 1
+            st["failures"] += 1
+        else:
+            st["failures"] = 0
+            if st["last_poll"]:
+                hours = max((now - st["last_poll"]) / 3600, 1e-6)
+                sample = new_messages / hours
+                st["rate_per_hour"] = RATE_ALPHA * sample + (1 - RATE_ALPHA) * st["rate_per_hour"]
+            st["last_poll"] = now
+        interval, reason = next_interval(st, now)
+        _push(user_id, st, now + interval, reason, now, new_messages=new_messages,
+              error=str(error) if error else None)
+
+
+def release(user_ids, now=None):
+    """Reschedule users that were taken but never reached record_result (e.g. skipped by the pipeline)."""
+    now = now or time.time()
+    with _lock:
+        for user_id in user_ids:
+            st = _users.get(user_id)
+            if st and st["in_flight"]:
+                st["in_flight"] = False
+                interval, reason = next_interval(st, now)
+                _push(user_id, st, now + min(interval, MIN_INTERVAL), "released without a result", now)
+
+
+def record_visit(user_id, now=None):
+    """Dashboard hit: pull the next poll forward to ACTIVE_INTERVAL if it is further out."""
+    now = now or time.time()
+    with _lock:
+        st = _users.get(user_id)
+        if not st:
+            return
+        stats["visits"] += 1
+        st["last_visit"] = now
+        if not st["in_flight"] and st["due"] > now + ACTIVE_INTERVAL:
+            _push(user_id, st, now + ACTIVE_INTERVAL, "dashboard visit", now)
+
+
+def explain(user_id):
+    with _lock:
+        st = _users.get(user_id)
+        if not st:
+            return None
+        out = {k: v for k, v in st.items() if k != "decisions"}
+        out["decisions"] = list(st["decisions"])
+    return out
+
+
+def get_stats(now=None):
+    now = now or time.time()
+    with _lock:
+        snapshot = dict(stats)
+        snapshot["users"] = len(_users)
+        snapshot["in_flight"] = sum(1 for st in _users.values() if st["in_flight"])
+        snapshot["due_now"] = sum(1 for st in _users.values() if st["due"] <= now and not st["in_flight"])
+        upcoming = sorted((st["due"], u) for u, st in _users.items() if not st["in_flight"])[:10]
+    snapshot["next"] = [{"user_id": u, "in": round(due - now, 1)} for due, u in upcoming]
+    return snapshot
@@ -0,0 +1,389 @@
+# storage.py
+# Shared Mongo client and the data-access layer for mail and events.
+# STORAGE_LAYOUT=per_user keeps one collection per user (db[user_id], db[f"{user_id}_events"]);
+# STORAGE_LAYOUT=shared uses single `emails` / `events` collections keyed by user_id
+# (see migrate_storage.py to move existing data).
+import os
+import json
+import base64
+import datetime
+import threading
+from typing import List, Tuple, Optional
+
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from dotenv import load_dotenv
+
+import viewcache
+
+load_dotenv()
+
+MONGO_URI = os.getenv("mongo_uri")
+STORAGE_LAYOUT = os.getenv("STORAGE_LAYOUT", "per_user")
+SHARED = STORAGE_LAYOUT == "shared"
+DUPLICATE_KEY = 11000
+DEFAULT_RETENTION_SECONDS = int(float(os.getenv("RETENTION_HOURS", "24")) * 3600)
+BODY_PREVIEW_CHARS = int(os.getenv("BODY_PREVIEW_CHARS", "600"))
+
+# dashboard list view: only what the cards render, body cut server-side
+EMAIL_LIST_PROJECTION = {
+    "subject": 1,
+    "body": {"$substrCP": [{"$ifNull": ["$body", ""]}, 0, BODY_PREVIEW_CHARS]},
+    "spam": 1,
+    "event": 1,
+    "cal_link": 1,
+    "summary": 1,
+    "fetched_at": 1,
+}
+
+client = MongoClient(MONGO_URI)
+db = client['Emails']
+tokens_collection = client['gmail_auth']['tokens']
+shared_emails = db['emails']
+shared_events = db['events']
+
+# round trips issued vs. what the old one-call-per-doc code would have needed
+stats = {"round_trips": 0, "round_trips_saved": 0, "duplicates_skipped": 0}
+_stats_lock = threading.Lock()
+
+_indexed = set()
+_indexed_lock = threading.Lock()
+
+
+def _count(issued: int, per_doc_equivalent: int) -> None:
+    with _stats_lock:
+        stats["round_trips"] += issued
+        stats["round_trips_saved"] += max(0, per_doc_equivalent - issued)
+
+
+def reset_stats() -> dict:
+    with _stats_lock:
+        snapshot = dict(stats)
+        for k in stats:
+            stats[k] = 0
+    return snapshot
+
+
+# ---------------- Layout ----------------
+def emails_collection(user_id: str):
+    return shared_emails if SHARED else db[user_id]
+
+
+def events_collection(user_id: str):
+    return shared_events if SHARED else db[f"{user_id}_events"]
+
+
+def user_scope(user_id: str) -> dict:
+    """Filter that restricts a query on emails_collection/events_collection to one user."""
+    return {"user_id": user_id} if SHARED else {}
+
+
+def retention_seconds(user_doc) -> int:
+    hours = (user_doc or {}).get("retention_hours")
+    try:
+        return int(float(hours) * 3600) if hours else DEFAULT_RETENTION_SECONDS
+    except (TypeError, ValueError):
+        return DEFAULT_RETENTION_SECONDS
+
+
+def _expire_at(user_id: str, start: datetime.datetime) -> datetime.datetime:
+    doc = tokens_collection.find_one({"user_id": user_id}, {"retention_hours": 1})
+    return start + datetime.timedelta(seconds=retention_seconds(doc))
+
+
+def ensure_shared_indexes() -> None:
+    """Compound indexes for the shared layout, every one prefixed by user_id (the shard key prefix)."""
+    with _indexed_lock:
+        if "__shared__" in _indexed:
+            return
+        shared_emails.create_index([("user_id", ASCENDING), ("msg_id", ASCENDING)], unique=True, name="user_msg_unique")
+        shared_emails.create_index([("user_id", ASCENDING), ("processed", ASCENDING)], name="user_processed")
+        shared_emails.create_index([("user_id", ASCENDING), ("fetched_at", DESCENDING), ("_id", DESCENDING)],
+                                   name="user_fetched_at_id")
+        shared_events.create_index([("user_id", ASCENDING), ("email_id", ASCENDING)], unique=True, name="user_email_unique")
+        # per-user retention: each doc carries its own expiry
+        for col in (shared_emails, shared_events):
+            set_ttl_index(col, "expire_at", 0)
+        _indexed.add("__shared__")
+
+
+def shard_collections() -> None:
+    """On a mongos: shard emails/events on user_id (+ the per-user unique key so uniqueness holds)."""
+    client.admin.command("enableSharding", db.name)
+    client.admin.command("shardCollection", f"{db.name}.emails", key={"user_id": 1, "msg_id": 1}, unique=True)
+    client.admin.command("shardCollection", f"{db.name}.events", key={"user_id": 1, "email_id": 1}, unique=True)
+
+
+def ensure_user_indexes(user_id: str) -> None:
+    """Create msg_id (unique), processed and fetched_at indexes on a user's collection once per process."""
+    if SHARED:
+        ensure_shared_indexes()
+        return
+    with _indexed_lock:
+        if user_id in _indexed:
+            return
+        col = db[user_id]
+        try:
+            col.create_index([("msg_id", ASCENDING)], unique=True, name="msg_id_unique")
+        except OperationFailure as e:
+            # pre-existing duplicates; dedupe still works via the $in prefilter
+            print(f"[WARN] unique msg_id index not created for {user_id}: {e}")
+        col.create_index([("processed", ASCENDING)], name="processed")
+        # retention: Mongo's TTL monitor expires old mail; per-user windows are set by emails_clean
+        set_ttl_index(col, "fetched_at", DEFAULT_RETENTION_SECONDS, overwrite=False)
+        # keyset pagination for the dashboard (newest first)
+        col.create_index([("fetched_at", DESCENDING), ("_id", DESCENDING)], name="fetched_at_id")
+        db[f"{user_id}_events"].create_index([("email_id", ASCENDING)], name="email_id")
+        _indexed.add(user_id)
+
+
+def set_ttl_index(col, field: str, seconds: int, overwrite: bool = True) -> bool:
+    """
+    Make {field: 1} a TTL index expiring after `seconds`, converting/updating an existing index
+    on that key with collMod. overwrite=False leaves an existing TTL value alone. Returns success.
+    """
+    try:
+        for info in col.index_information().values():
+            if info["key"] != [(field, ASCENDING)]:
+                continue
+            current = info.get("expireAfterSeconds")
+            if current == seconds or (current is not None and not overwrite):
+                return True
+            col.database.command("collMod", col.name,
+                                 index={"keyPattern": {field: ASCENDING}, "expireAfterSeconds": seconds})
+            return True
+        col.create_index([(field, ASCENDING)], name=f"{field}_ttl", expireAfterSeconds=seconds)
+        return True
+    except Exception as e:
+        print(f"[WARN] TTL index on {col.name}.{field} not set: {e}")
+        return False
+
+
+def ensure_retention_ttl(col, field: str = "created_at", seconds: int = None) -> None:
+    """
+    Once per process: expire a collection of copies derived from mail content (caches, queues)
+    with the mail retention window. An existing window is kept; emails_clean reconciles it with
+    the shortest window any user has.
+    """
+    key = f"ttl:{col.full_name}.{field}"
+    with _indexed_lock:
+        if key in _indexed:
+            return
+        if set_ttl_index(col, field, seconds or DEFAULT_RETENTION_SECONDS, overwrite=False):
+            _indexed.add(key)
+
+
+# ---------------- Mail ----------------
+def stored_msg_ids(user_id: str, msg_ids: List[str]) -> set:
+    ensure_user_indexes(user_id)
+    _count(1, len(msg_ids))
+    query = {**user_scope(user_id), "msg_id": {"$in": list(msg_ids)}}
+    return {d["msg_id"] for d in emails_collection(user_id).find(query, {"msg_id": 1, "_id": 0})}
+
+
+def insert_emails(user_id: str, docs: List[dict]) -> List[dict]:
+    """
+    insert_many(ordered=False); duplicate-key errors are the dedupe.
+    Returns the docs that were actually inserted.
+    """
+    if not docs:
+        return []
+    ensure_user_indexes(user_id)
+    if SHARED:
+        expire_at = _expire_at(user_id, datetime.datetime.utcnow())
+        for d in docs:
+            d["user_id"] = user_id
+            d.setdefault("expire_at", expire_at)
+    try:
+        emails_collection(user_id).insert_many(docs, ordered=False)
+        failed = set()
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        dups = [err for err in errors if err.get("code") == DUPLICATE_KEY]
+        with _stats_lock:
+            stats["duplicates_skipped"] += len(dups)
+        for err in errors:
+            if err.get("code") != DUPLICATE_KEY:
+                print(f"[ERROR] insert failed for {user_id}: {err.get('errmsg')}")
+        failed = {err["index"] for err in errors}
+    # find_one + insert_one per doc before
+    _count(1, 2 * len(docs))
+    inserted = [d for i, d in enumerate(docs) if i not in failed]
+    if inserted:
+        viewcache.invalidate(user_id)
+    return inserted
+
+
+def find_pending(user_id: str, projection=None) -> List[dict]:
+    ensure_user_indexes(user_id)
+    _count(1, 1)
+    return list(emails_collection(user_id).find({**user_scope(user_id), "processed": {"$ne": True}}, projection))
+
+
+def iter_processed(user_id: str, projection=None, batch_size: int = 500):
+    """Yield lists of already-classified docs (for re-scoring after a model swap)."""
+    ensure_user_indexes(user_id)
+    cursor = emails_collection(user_id).find({**user_scope(user_id), "processed": True}, projection,
+                                             batch_size=batch_size)
+    chunk = []
+    for doc in cursor:
+        chunk.append(doc)
+        if len(chunk) >= batch_size:
+            _count(1, 1)
+            yield chunk
+            chunk = []
+    if chunk:
+        _count(1, 1)
+        yield chunk
+
+
+def find_email(user_id: str, doc_id, projection=None) -> Optional[dict]:
+    """One of the user's emails by _id (a str id from the dashboard is accepted)."""
+    if isinstance(doc_id, str):
+        try:
+            doc_id = ObjectId(doc_id)
+        except Exception:
+            return None
+    _count(1, 1)
+    return emails_collection(user_id).find_one({**user_scope(user_id), "_id": doc_id}, projection)
+
+
+def find_emails(user_id: str, doc_ids: list, projection=None) -> List[dict]:
+    """Several of the user's emails by _id, one query."""
+    if not doc_ids:
+        return []
+    _count(1, len(doc_ids))
+    return list(emails_collection(user_id).find({**user_scope(user_id), "_id": {"$in": list(doc_ids)}}, projection))
+
+
+def find_pending_many(user_ids: List[str], projection=None) -> dict:
+    """
+    {user_id: [pending docs]} for several users. In the shared layout this is one
+    query on the (user_id, processed) index; per-user collections need one query each.
+    """
+    if not SHARED:
+        return {u: find_pending(u, projection) for u in user_ids}
+    ensure_shared_indexes()
+    projection = dict(projection, user_id=1) if projection else None
+    grouped = {u: [] for u in user_ids}
+    for d in shared_emails.find({"user_id": {"$in": list(user_ids)}, "processed": {"$ne": True}}, projection):
+        grouped[d["user_id"]].append(d)
+    _count(1, len(user_ids))
+    return grouped
+
+
+def apply_updates(user_id: str, updates: List[Tuple[object, dict]]) -> int:
+    """Apply [(doc_id, $set fields), ...] in one bulk_write. Returns modified count."""
+    if not updates:
+        return 0
+    scope = user_scope(user_id)
+    ops = [UpdateOne({**scope, "_id": doc_id}, {"$set": upd}) for doc_id, upd in updates]
+    try:
+        res = emails_collection(user_id).bulk_write(ops, ordered=False)
+        modified = res.modified_count
+    except BulkWriteError as e:
+        print(f"[ERROR] bulk update failed for {user_id}: {e.details.get('writeErrors', [])[:3]}")
+        modified = e.details.get("nModified", 0)
+    _count(1, len(ops))
+    viewcache.invalidate(user_id)
+    return modified
+
+
+def set_user_expiry(user_id: str, seconds: int) -> None:
+    """Shared layout: recompute expire_at for a user's mail and events after a retention change."""
+    ms = seconds * 1000
+    shared_emails.update_many({"user_id": user_id}, [{"$set": {"expire_at": {"$add": ["$fetched_at", ms]}}}])
+    shared_events.update_many({"user_id": user_id}, [{"$set": {"expire_at": {"$add": ["$added_at", ms]}}}])
+
+
+# ---------------- Events ----------------
+def find_events(user_id: str, email_ids: list) -> dict:
+    """{email_id: event doc} for the given emails, one query."""
+    if not email_ids:
+        return {}
+    _count(1, len(email_ids))
+    query = {**user_scope(user_id), "email_id": {"$in": list(email_ids)}}
+    return {d["email_id"]: d for d in events_collection(user_id).find(query)}
+
+
+def insert_events(user_id: str, items: List[Tuple[object, dict]]) -> None:
+    """Cache [(email_id, event_details), ...] with one unordered insert; existing ones are skipped."""
+    if not items:
+        return
+    ensure_user_indexes(user_id)
+    now = datetime.datetime.utcnow()
+    expire_at = _expire_at(user_id, now) if SHARED else None
+    docs = []
+    for email_id, details in items:
+        doc = {**user_scope(user_id), "email_id": email_id, **details, "added_at": now}
+        if expire_at:
+            doc["expire_at"] = expire_at
+        docs.append(doc)
+    try:
+        events_collection(user_id).insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for err in e.details.get("writeErrors", []):
+            if err.get("code") != DUPLICATE_KEY:
+                print(f"[ERROR] event insert failed for {user_id}: {err.get('errmsg')}")
+    _count(1, len(docs))
+
+
+def set_event_links(user_id: str, links: dict) -> None:
+    """Record {email_id: (calendar_event_id, htmlLink)} on the cached events with one bulk_write."""
+    if not links:
+        return
+    now = datetime.datetime.utcnow()
+    scope = user_scope(user_id)
+    ops = [UpdateOne({**scope, "email_id": email_id},
+                     {"$set": {"calendar_event_id": event_id, "cal_link": link, "synced_at": now}})
+           for email_id, (event_id, link) in links.items()]
+    try:
+        events_collection(user_id).bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        print(f"[ERROR] event link update failed for {user_id}: {e.details.get('writeErrors', [])[:3]}")
+    _count(1, len(ops))
+
+
+# ---------------- Dashboard pagination ----------------
+def encode_cursor(doc: dict) -> str:
+    fetched_at = doc.get("fetched_at")
+    raw = json.dumps({"t": fetched_at.isoformat() if fetched_at else None, "id": str(doc["_id"])})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Optional[dict]:
+    """Cursor -> query for docs strictly after it in (fetched_at desc, _id desc) order; None if invalid."""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        oid = ObjectId(raw["id"])
+        t = datetime.datetime.fromisoformat(raw["t"]) if raw.get("t") else None
+    except Exception:
+        return None
+    if t is None:
+        # docs without fetched_at sort last; page through them by _id only
+        return {"fetched_at": None, "_id": {"$lt": oid}}
+    return {"$or": [
+        {"fetched_at": {"$lt": t}},
+        {"fetched_at": t, "_id": {"$lt": oid}},
+        {"fetched_at": None},
+    ]}
+
+
+def page_emails(user_id: str, cursor: str = None, limit: int = 10, projection=None) -> Tuple[List[dict], Optional[str]]:
+    """
+    Newest-first page of a user's emails using keyset pagination on (fetched_at, _id).
+    Fetches limit+1 rows to know whether there is a next page. Returns (docs, next_cursor).
+    """
+    ensure_user_indexes(user_id)
+    query = decode_cursor(cursor) if cursor else {}
+    if query is None:
+        query = {}
+    query.update(user_scope(user_id))
+    docs = list(
+        emails_collection(user_id).find(query, projection or EMAIL_LIST_PROJECTION)
+        .sort([("fetched_at", DESCENDING), ("_id", DESCENDING)])
+        .limit(limit + 1)
+    )
+    next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+    return docs[:limit], next_cursor
@@ -0,0 +1,30 @@
+# conftest.py
+# The suites run without Google or a live mongod: Gmail is a local stub (gmailstub.py) and, when
+# mongomock is installed, pymongo.MongoClient is swapped for it before storage.py builds its
+# module-level client. Suites whose dependencies are missing are skipped.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import mongomock
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+except ImportError:
+    mongomock = None
+
+
+@pytest.fixture
+def mongo():
+    """The storage module on an empty mongomock server, with fresh index bookkeeping and counters."""
+    if mongomock is None:
+        pytest.skip("mongomock not installed")
+    storage = pytest.importorskip("storage")
+    for name in storage.client.list_database_names():
+        storage.client.drop_database(name)
+    storage._indexed.clear()
+    storage.reset_stats()
+    return storage
@@ -0,0 +1,150 @@
+# gmailstub.py
+# In-memory stand-in for the Gmail API client built by googleapiclient: users().messages().list/get,
+# users().history().list, users().getProfile and new_batch_http_request. Every HTTP call a real client
+# would make (one per executed request, one per executed batch) is counted in round_trips.
+import base64
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+def message(msg_id, subject="Hello", body="hi there", unread=True, internal_date=0):
+    data = base64.urlsafe_b64encode(body.encode()).decode()
+    return {
+        "id": msg_id,
+        "internalDate": str(internal_date),
+        "labelIds": ["INBOX"] + (["UNREAD"] if unread else []),
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": [{"name": "Subject", "value": subject}],
+            "body": {"data": data, "size": len(body)},
+        },
+    }
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({"status": status}), b"{}")
+
+
+class _Request:
+    def __init__(self, gmail, fn):
+        self._gmail = gmail
+        self._fn = fn
+
+    def execute(self):
+        self._gmail.round_trips += 1
+        return self._fn()
+
+
+class _Batch:
+    def __init__(self, gmail, callback):
+        self._gmail = gmail
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id):
+        if len(self._requests) >= 100:
+            raise ValueError("Gmail batches hold at most 100 requests")
+        self._requests.append((request_id, request))
+
+    def execute(self):
+        self._gmail.round_trips += 1
+        self._gmail.batch_sizes.append(len(self._requests))
+        for request_id, request in self._requests:
+            try:
+                response, exc = request._fn(), None
+            except HttpError as e:
+                response, exc = None, e
+            self._callback(request_id, response, exc)
+
+
+class _Messages:
+    def __init__(self, gmail):
+        self._gmail = gmail
+
+    def list(self, userId, q=None, maxResults=100, pageToken=None):
+        def run():
+            if self._gmail.list_failures > 0:
+                self._gmail.list_failures -= 1
+                raise http_error(503)
+            ids = [m for m in self._gmail.store if "UNREAD" in self._gmail.store[m]["labelIds"]]
+            start = int(pageToken or 0)
+            resp = {"messages": [{"id": m} for m in ids[start:start + maxResults]]}
+            if start + maxResults < len(ids):
+                resp["nextPageToken"] = str(start + maxResults)
+            return resp
+        return _Request(self._gmail, run)
+
+    def get(self, userId, id, format="full", metadataHeaders=None):
+        return _Request(self._gmail, lambda: self._gmail.get(id, format))
+
+
+class _History:
+    def __init__(self, gmail):
+        self._gmail = gmail
+
+    def list(self, userId, startHistoryId, historyTypes=None, pageToken=None):
+        def run():
+            if int(startHistoryId) < self._gmail.oldest_history_id:
+                raise http_error(404)
+            added = [{"messagesAdded": [{"message": {"id": m, "labelIds": labels}}]}
+                     for m, labels in self._gmail.added_since(int(startHistoryId))]
+            return {"history": added, "historyId": str(self._gmail.history_id)}
+        return _Request(self._gmail, run)
+
+
+class StubGmail:
+    """
+    store: {msg_id: message resource}. failures: {msg_id: n}, the next n gets of that id answer 503
+    (float('inf') keeps failing); ids missing from the store answer 404.
+    list_failures: the next n messages.list calls answer 503.
+    """
+
+    def __init__(self, messages=(), failures=None, history_id=100):
+        self.store = {}
+        self.failures = dict(failures or {})
+        self.round_trips = 0
+        self.batch_sizes = []
+        self.gets = []
+        self.history_id = history_id
+        self.oldest_history_id = 0
+        self.list_failures = 0
+        self._added = []
+        for m in messages:
+            self.add(m)
+
+    def add(self, msg):
+        self.history_id += 1
+        self.store[msg["id"]] = msg
+        self._added.append((self.history_id, msg["id"], msg["labelIds"]))
+
+    def added_since(self, history_id):
+        return [(m, labels) for h, m, labels in self._added if h > history_id]
+
+    def get(self, msg_id, fmt):
+        self.gets.append((msg_id, fmt))
+        if self.failures.get(msg_id, 0) > 0:
+            self.failures[msg_id] -= 1
+            raise http_error(503)
+        if msg_id not in self.store:
+            raise http_error(404)
+        msg = self.store[msg_id]
+        if fmt == "metadata":
+            return {k: v for k, v in msg.items() if k != "payload"}
+        return msg
+
+    # client surface
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Messages(self)
+
+    def history(self):
+        return _History(self)
+
+    def getProfile(self, userId):
+        return _Request(self, lambda: {"historyId": str(self.history_id)})
+
+    def new_batch_http_request(self, callback):
+        return _Batch(self, callback)
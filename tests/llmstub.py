@@ -0,0 +1,50 @@
+# llmstub.py
+# Stand-in for google.generativeai.GenerativeModel: answers the event, summary and combined
+# enrichment prompts from secondarymodel.py with canned text and records every call.
+import json
+import re
+import time
+
+
+class _Response:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubModel:
+    """
+    events: {marker: event dict}; an email containing marker describes that event.
+    latency: seconds each call sleeps, so per-email timings reflect the number of round trips.
+    fail: {marker: exception} raised for a single-email prompt containing marker; a batched
+    prompt holding such an email is answered without it (which makes the answer malformed).
+    """
+
+    def __init__(self, events=None, latency=0.0, fail=None):
+        self.events = events or {}
+        self.latency = latency
+        self.fail = fail or {}
+        self.prompts = []
+
+    def _event_for(self, body):
+        return next((e for marker, e in self.events.items() if marker in body), None)
+
+    def _summary_for(self, body):
+        return f"Summary of: {body[:30]}"
+
+    def generate_content(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        time.sleep(self.latency)
+        if prompt.lstrip().startswith("For EACH email"):
+            emails = json.loads(prompt[prompt.index("Emails:") + len("Emails:"):])
+            return _Response(json.dumps([{"id": e["id"], "event": self._event_for(e["email"]),
+                                          "summary": self._summary_for(e["email"])} for e in emails
+                                         if not any(marker in e["email"] for marker in self.fail)]))
+        for marker, exc in self.fail.items():
+            if marker in prompt:
+                raise exc
+        body = re.search(r'"""(.*)"""', prompt, re.DOTALL).group(1)
+        if "Extract an EVENT" in prompt:
+            return _Response(json.dumps(self._event_for(body) or {}))
+        if prompt.startswith("Summarize"):
+            return _Response(self._summary_for(body))
+        return _Response(json.dumps({"event": self._event_for(body), "summary": self._summary_for(body)}))
@@ -0,0 +1,51 @@
+# test_bodytext.py
+# HTML-to-text engines on inputs that used to end up as "(Clean failed)" or lose text.
+import pytest
+
+from MAILFETCHING import bodytext
+
+ENGINES = sorted(bodytext.ENGINES)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_xml_declaration(engine):
+    html = "<?xml version='1.0' encoding='utf-8'?><html><body><p>Quarterly report</p></body></html>"
+
+    assert bodytext.html_to_text(html, engine=engine) == "Quarterly report"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("html", [" ", "\n\t  \n", "<!-- nothing here -->"])
+def test_empty_documents(engine, html):
+    assert bodytext.html_to_text(html, engine=engine) == ""
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_links_images_scripts_and_urls_are_dropped(engine):
+    html = ("<html><head><style>p {color: red}</style><script>var x = 1;</script></head><body>"
+            "<p>Hello <a href='https://x.example/a'>click here</a> world</p>"
+            "<img src='logo.png' alt='logo'><p>See https://x.example/raw for more</p></body></html>")
+
+    assert bodytext.html_to_text(html, engine=engine) == "Hello world See for more"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_unclosed_link_does_not_swallow_the_document(engine):
+    html = "<p>Intro <a href='https://x.example'>unsubscribe</p><p>Meeting moved to Friday</p><div>Thanks</div>"
+
+    text = bodytext.html_to_text(html, engine=engine)
+
+    assert "Meeting moved to Friday" in text
+    assert text.endswith("Thanks")
+
+
+def test_stream_link_ends_at_the_next_link():
+    html = "<a href='1'>one <a href='2'>two</a> after"
+
+    assert bodytext.html_to_text(html, engine="stream") == "after"
+
+
+def test_input_is_capped():
+    html = "<p>" + "word " * 1000 + "</p><p>tail</p>"
+
+    assert "tail" not in bodytext.html_to_text(html, engine="stream", max_chars=200)
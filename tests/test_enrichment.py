@@ -0,0 +1,125 @@
+# test_enrichment.py
+# Combined enrichment (one LLM call per email) against the extract-then-summarize path,
+# with a stub model in place of Gemini.
+import statistics
+import time
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+pytest.importorskip("googleapiclient")
+
+from llmstub import StubModel
+
+EVENT = {"title": "Standup", "date": "2026-03-02", "start_time": "09:30", "end_time": "09:45",
+         "location": "Room 1", "description": ""}
+
+
+@pytest.fixture
+def secondarymodel(mongo, monkeypatch):
+    from models import secondarymodel, llmcache
+    llmcache._lru.clear()
+    monkeypatch.setattr(secondarymodel, "llm_stats", {"calls": 0, "errors": 0, "seconds": 0.0})
+    return secondarymodel
+
+
+def _two_step(sm, body):
+    event = sm.extract_event(body)
+    return {"event": event, "summary": None if event else sm.summarize_email(body)}
+
+
+def _timed(fn, bodies):
+    timings = []
+    for body in bodies:
+        start = time.perf_counter()
+        fn(body)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def test_combined_mode_makes_one_call_per_email(secondarymodel, monkeypatch):
+    bodies = [f"newsletter number {i}" for i in range(8)]
+    two_step = StubModel(latency=0.005)
+    monkeypatch.setattr(secondarymodel, "model", two_step)
+    two_step_times = _timed(lambda b: _two_step(secondarymodel, b), bodies)
+
+    combined = StubModel(latency=0.005)
+    monkeypatch.setattr(secondarymodel, "model", combined)
+    combined_times = _timed(secondarymodel.enrich_email, [b + " (again)" for b in bodies])
+
+    assert len(two_step.prompts) == 2 * len(bodies)
+    assert len(combined.prompts) == len(bodies)
+    assert statistics.median(combined_times) < statistics.median(two_step_times)
+    assert max(combined_times) < max(two_step_times)
+
+
+def test_combined_answer_carries_event_and_summary(secondarymodel, monkeypatch):
+    stub = StubModel(events={"standup": EVENT})
+    monkeypatch.setattr(secondarymodel, "model", stub)
+
+    result = secondarymodel.enrich_email("daily standup tomorrow")
+
+    assert result["event"] == EVENT
+    assert result["summary"].startswith("Summary of")
+    assert len(stub.prompts) == 1
+
+
+def test_cached_answer_is_not_requested_again(secondarymodel, monkeypatch):
+    stub = StubModel()
+    monkeypatch.setattr(secondarymodel, "model", stub)
+
+    secondarymodel.enrich_email("hello there")
+    secondarymodel.enrich_email("hello   there")
+
+    assert len(stub.prompts) == 1
+
+
+@pytest.mark.parametrize("bad", [
+    {"date": "2026-02-30"},
+    {"date": "next tuesday"},
+    {"start_time": "25:00"},
+    {"end_time": "9.30"},
+    {"title": 42},
+])
+def test_malformed_event_is_dropped_and_summary_kept(secondarymodel, bad):
+    result = secondarymodel.validate_enrichment({"event": {**EVENT, **bad}, "summary": "Kept."})
+
+    assert result == {"event": None, "summary": "Kept."}
+
+
+def test_missing_summary_is_a_schema_error(secondarymodel):
+    with pytest.raises(secondarymodel.EnrichmentSchemaError):
+        secondarymodel.validate_enrichment({"event": EVENT, "summary": ""})
+
+
+def test_batch_split_keeps_sibling_answers_when_one_email_fails(secondarymodel, monkeypatch):
+    from models import llmcache
+    stub = StubModel(fail={"boom": RuntimeError("400 blocked")})
+    monkeypatch.setattr(secondarymodel, "model", stub)
+    items = [("a", "alpha mail"), ("b", "boom mail"), ("c", "gamma mail"), ("d", "delta mail")]
+
+    results = secondarymodel.enrich_emails_batch(items)
+
+    assert results["b"] is None
+    assert all(results[i]["summary"] for i in "acd")
+    # answered emails are cached even though a sibling failed
+    calls = len(stub.prompts)
+    again = secondarymodel.enrich_emails_batch(items)
+    assert len(stub.prompts) == calls + 1          # only "boom" is asked again
+    assert again["a"] == results["a"]
+    found, _ = llmcache.get(llmcache.cache_key("enrich", secondarymodel.ENRICH_PROMPT_VERSION, "gamma mail"))
+    assert found
+
+
+def test_batched_lookups_count_misses(secondarymodel, monkeypatch):
+    from models import llmcache
+    monkeypatch.setattr(llmcache, "stats", {k: type(v)() for k, v in llmcache.stats.items()})
+    monkeypatch.setattr(secondarymodel, "model", StubModel())
+
+    secondarymodel.enrich_emails_batch([("a", "first mail"), ("b", "second mail"), ("c", "third mail")])
+    secondarymodel.enrich_emails_batch([("a", "first mail")])
+
+    cache = llmcache.get_stats()
+    assert cache["misses"] == 3
+    assert cache["memory_hits"] + cache["mongo_hits"] == 1
+    assert cache["hit_rate"] == 0.25
@@ -0,0 +1,106 @@
+# test_enrichqueue.py
+# The queued enrichment worker (models/enrichment.py) over mongomock with a stub Gemini model.
+import pytest
+
+pytest.importorskip("google.generativeai")
+pytest.importorskip("googleapiclient")
+
+from llmstub import StubModel
+
+USER = "daveatexampledotcom"
+
+
+@pytest.fixture
+def enrichment(mongo, monkeypatch):
+    from models import enrichment, secondarymodel, llmcache
+    llmcache._lru.clear()
+    monkeypatch.setattr(enrichment, "_client", enrichment.GeminiClient())
+    monkeypatch.setattr(enrichment, "backoff_seconds", lambda attempt: 0)
+    monkeypatch.setattr(secondarymodel, "llm_stats", {"calls": 0, "errors": 0, "seconds": 0.0})
+    return enrichment
+
+
+def _enqueue(enrichment, mongo, bodies, user_id=USER):
+    docs = [{"msg_id": body, "body": body, "processed": True} for body in bodies]
+    mongo.insert_emails(user_id, docs)
+    enrichment.enqueue(user_id, docs)
+    return docs
+
+
+def test_successive_drains_share_the_gemini_client(enrichment, mongo, monkeypatch):
+    from models import secondarymodel
+    stub = StubModel()
+    monkeypatch.setattr(secondarymodel, "model", stub)
+
+    _enqueue(enrichment, mongo, ["first email"])
+    first = enrichment.drain()
+    _enqueue(enrichment, mongo, ["second email"])
+    second = enrichment.drain()
+
+    assert first["done"] == 1 and second["done"] == 1
+    assert secondarymodel.get_llm_stats()["calls"] == len(stub.prompts) == 2
+    assert mongo.db[USER].count_documents({"enrichment": "done"}) == 2
+
+
+def test_schema_errors_are_not_retried_in_run(enrichment, mongo, monkeypatch):
+    from models import secondarymodel
+
+    class Garbled(StubModel):
+        def generate_content(self, prompt, **kwargs):
+            self.prompts.append(prompt)
+            return type("R", (), {"text": "not json"})()
+
+    stub = Garbled()
+    monkeypatch.setattr(secondarymodel, "model", stub)
+    _enqueue(enrichment, mongo, ["garbled answer"])
+
+    stats = enrichment.drain()
+
+    assert len(stub.prompts) == 1
+    assert stats["retries"] == 0 and stats["retry_later"] == 1
+
+
+def test_failed_items_drop_their_body(enrichment, mongo, monkeypatch):
+    from models import secondarymodel
+    monkeypatch.setattr(enrichment, "MAX_ATTEMPTS", 1)
+    monkeypatch.setattr(secondarymodel, "model", StubModel(fail={"doomed": RuntimeError("500")}))
+    _enqueue(enrichment, mongo, ["doomed email"])
+
+    stats = enrichment.drain()
+
+    item = enrichment.queue_collection.find_one()
+    assert stats["failed"] == 1
+    assert item["status"] == "failed" and "body" not in item
+    assert mongo.db[USER].find_one()["enrichment"] == "failed"
+
+
+def test_one_failing_email_does_not_fail_its_batch(enrichment, mongo, monkeypatch):
+    from models import secondarymodel
+    stub = StubModel(fail={"boom": RuntimeError("400 blocked")})
+    monkeypatch.setattr(secondarymodel, "model", stub)
+    monkeypatch.setattr(enrichment, "CONCURRENCY", 1)
+    _enqueue(enrichment, mongo, ["alpha mail", "boom mail", "gamma mail", "delta mail"])
+
+    stats = enrichment.drain()
+
+    assert stats["done"] == 3
+    assert stats["retry_later"] == 1 and stats["failed"] == 0
+    assert mongo.db[USER].count_documents({"enrichment": "done"}) == 3
+    # siblings were answered once; only the failing email was retried in-run
+    boom_prompts = [p for p in stub.prompts if "boom" in p and not p.lstrip().startswith("For EACH")]
+    assert len(boom_prompts) == 1 + enrichment.IN_RUN_RETRIES
+    for sibling in ("alpha mail", "gamma mail", "delta mail"):
+        assert sum(sibling in p for p in stub.prompts) <= 2   # its batch, at most one split half
+
+
+def test_user_drain_leaves_other_users_items(enrichment, mongo, monkeypatch):
+    from models import secondarymodel
+    monkeypatch.setattr(secondarymodel, "model", StubModel())
+    other = "frankatexampledotcom"
+    _enqueue(enrichment, mongo, ["mine"])
+    _enqueue(enrichment, mongo, ["theirs one", "theirs two"], user_id=other)
+
+    stats = enrichment.drain(user_id=USER)
+
+    assert stats["claimed"] == 1
+    assert enrichment.queue_collection.count_documents({"user_id": other, "status": "pending"}) == 2
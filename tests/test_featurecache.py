@@ -0,0 +1,60 @@
+# test_featurecache.py
+# Cached spam features: rows are reused per (vectorizer version, stored email), and text is only
+# loaded for cache misses.
+import pytest
+
+pytest.importorskip("sklearn")
+
+
+@pytest.fixture
+def featurecache(mongo):
+    from models import featurecache
+    return featurecache
+
+
+@pytest.fixture
+def vectorizer():
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    return TfidfVectorizer().fit(["win a free prize now", "meeting notes for monday", "free lunch monday"])
+
+
+def _docs():
+    return [{"_id": 1, "msg_id": "m1", "subject": "prize", "body": "win a free prize"},
+            {"_id": 2, "msg_id": "m2", "subject": "notes", "body": "meeting monday"}]
+
+
+def test_cached_rows_match_a_fresh_transform(featurecache, vectorizer):
+    docs = _docs()
+    first = featurecache.transform(docs, vectorizer, "vocab-test")
+    second = featurecache.transform(docs, vectorizer, "vocab-test")
+
+    expected = vectorizer.transform([featurecache.doc_text(d) for d in docs])
+    assert abs(first - expected).max() < 1e-6
+    assert abs(second - expected).max() < 1e-6
+
+
+def test_text_is_loaded_only_for_misses(featurecache, vectorizer):
+    full = {d["_id"]: d for d in _docs()}
+    featurecache.transform([full[1]], vectorizer, "vocab-test")
+    loaded = []
+
+    def fill(missing):
+        loaded.extend(d["_id"] for d in missing)
+        return [full[d["_id"]] for d in missing]
+
+    ids_only = [{"_id": 1, "msg_id": "m1"}, {"_id": 2, "msg_id": "m2"}]
+    X = featurecache.transform(ids_only, vectorizer, "vocab-test", fill=fill)
+
+    assert loaded == [2]
+    expected = vectorizer.transform([featurecache.doc_text(full[i]) for i in (1, 2)])
+    assert abs(X - expected).max() < 1e-6
+
+
+def test_same_gmail_id_in_two_mailboxes_gets_separate_rows(featurecache, vectorizer):
+    mine = {"_id": 1, "msg_id": "m1", "subject": "prize", "body": "win a free prize"}
+    theirs = {"_id": 2, "msg_id": "m1", "subject": "notes", "body": "meeting monday"}
+    featurecache.transform([mine], vectorizer, "vocab-test")
+
+    X = featurecache.transform([theirs], vectorizer, "vocab-test")
+
+    assert abs(X - vectorizer.transform([featurecache.doc_text(theirs)])).max() < 1e-6
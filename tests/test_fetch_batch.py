@@ -0,0 +1,89 @@
+# test_fetch_batch.py
+# Gmail batch fetching against the local stub: round trips, sub-request retries and the
+# opt-in metadata pass, with the fetched mail stored through storage.py (mongomock).
+import pytest
+
+pytest.importorskip("googleapiclient")
+pytest.importorskip("google_auth_oauthlib")
+
+from gmailstub import StubGmail, message
+
+USER = "aliceatexampledotcom"
+
+
+@pytest.fixture
+def fetch(mongo, monkeypatch):
+    from MAILFETCHING import fetch
+    monkeypatch.setattr(fetch.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(fetch, "fetch_stats", dict.fromkeys(fetch.fetch_stats, 0))
+    return fetch
+
+
+def _stored(mongo):
+    return {d["msg_id"]: d for d in mongo.emails_collection(USER).find()}
+
+
+def test_batch_mode_fetches_100_messages_per_round_trip(fetch, mongo):
+    gmail = StubGmail([message(f"m{i}", subject=f"s{i}", internal_date=i) for i in range(150)])
+
+    result = fetch.get_unread_emails(None, USER, limit=150, verbose=False, service=gmail, mode="batch")
+
+    assert len(result["inserted"]) == 150
+    assert gmail.round_trips == 3          # list + two batches
+    assert gmail.batch_sizes == [100, 50]
+    stored = _stored(mongo)
+    assert len(stored) == 150
+    assert stored["m7"]["subject"] == "s7"
+    assert stored["m7"]["body"] == "hi there"
+    assert stored["m7"]["processed"] is False
+
+
+def test_serial_mode_costs_one_round_trip_per_message(fetch):
+    gmail = StubGmail([message(f"m{i}") for i in range(5)])
+
+    result = fetch.get_unread_emails(None, USER, limit=10, verbose=False, service=gmail, mode="serial")
+
+    assert len(result["inserted"]) == 5
+    assert gmail.round_trips == 6
+
+
+def test_stored_messages_are_not_fetched_again(fetch):
+    gmail = StubGmail([message(f"m{i}") for i in range(5)])
+    fetch.get_unread_emails(None, USER, limit=10, verbose=False, service=gmail, mode="batch")
+    gmail.round_trips = 0
+
+    result = fetch.get_unread_emails(None, USER, limit=10, verbose=False, service=gmail, mode="batch")
+
+    assert result["inserted"] == []
+    assert gmail.round_trips == 1          # the listing only
+
+
+def test_retryable_subrequests_are_rebatched(fetch, mongo):
+    gmail = StubGmail([message("m1"), message("m2")], failures={"m1": 2})
+
+    inserted = fetch.ingest_message_ids(gmail, USER, ["m1", "m2"], mode="batch")
+
+    assert {d["msg_id"] for d in inserted} == {"m1", "m2"}
+    assert gmail.batch_sizes == [2, 1, 1]
+    assert fetch.fetch_stats["subrequest_retries"] == 2
+    assert set(_stored(mongo)) == {"m1", "m2"}
+
+
+def test_metadata_mode_skips_messages_read_since_listing(fetch, mongo):
+    gmail = StubGmail([message("m1"), message("m2", unread=False)])
+
+    inserted = fetch.ingest_message_ids(gmail, USER, ["m1", "m2"], mode="metadata")
+
+    assert [d["msg_id"] for d in inserted] == ["m1"]
+    assert ("m2", "full") not in gmail.gets
+    assert fetch.fetch_stats["metadata_round_trips"] == 1
+    assert fetch.fetch_stats["metadata_skipped"] == 1
+
+
+def test_metadata_failures_still_get_the_full_fetch(fetch, mongo):
+    # metadata gives up after 1 + BATCH_MAX_RETRIES attempts; the full fetch then succeeds
+    gmail = StubGmail([message("m1")], failures={"m1": 1 + fetch.BATCH_MAX_RETRIES})
+
+    inserted = fetch.ingest_message_ids(gmail, USER, ["m1"], mode="metadata")
+
+    assert [d["msg_id"] for d in inserted] == ["m1"]
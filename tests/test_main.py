@@ -0,0 +1,120 @@
+# test_main.py
+# App-level wiring: how a sync result feeds the adaptive poll scheduler, which operational
+# routes are limited to admins, and enrichment of emails relabelled as not spam.
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("apscheduler")
+pytest.importorskip("googleapiclient")
+
+USER = "erinatexampledotcom"
+
+
+@pytest.fixture
+def main(mongo, monkeypatch):
+    monkeypatch.setenv("mongo_uri", "mongodb://localhost")
+    import main
+    import pollsched
+    monkeypatch.setattr(pollsched, "_users", {})
+    monkeypatch.setattr(pollsched, "_heap", [])
+    return main
+
+
+def _poll(main, monkeypatch, result, now=None):
+    import pollsched
+    now = now or time.time()
+    pollsched.sync_users([USER], now=now)
+    assert pollsched.take_due(now=now) == [USER]
+    monkeypatch.setattr(main.clients, "creds_from_doc", lambda doc: object())
+    monkeypatch.setattr(main.fetch, "sync_mailbox", lambda *args, **kwargs: result)
+    main.fetch_pending_for_user({"user_id": USER, "creds_json": "{}"})
+    return pollsched._users[USER]
+
+
+def test_sync_error_backs_the_mailbox_off(main, monkeypatch):
+    import pollsched
+    st = _poll(main, monkeypatch, {"inserted": [], "sync": "incremental", "error": "503"})
+
+    assert st["failures"] == 1
+    assert st["decisions"][-1]["reason"].startswith("backoff")
+    assert st["due"] - st["decisions"][-1]["at"] == pollsched.MIN_INTERVAL * 2
+
+
+def test_clean_sync_resets_the_backoff(main, monkeypatch):
+    _poll(main, monkeypatch, {"inserted": [], "sync": "incremental", "error": "503"})
+    st = _poll(main, monkeypatch, {"inserted": [], "sync": "incremental"}, now=time.time() + 3600 * 24)
+
+    assert st["failures"] == 0
+
+
+def test_unusable_credentials_back_off(main):
+    import pollsched
+    pollsched.sync_users([USER])
+    pollsched.take_due()
+
+    assert main.fetch_pending_for_user({"user_id": USER}) is None
+    assert pollsched._users[USER]["failures"] == 1
+
+
+def _client(main, user_id=None):
+    client = main.app.test_client()
+    if user_id:
+        with client.session_transaction() as sess:
+            sess["user_id"] = user_id
+    return client
+
+
+def test_job_stats_hide_user_keys_from_non_admins(main, monkeypatch):
+    import jobs
+    monkeypatch.setattr(jobs, "_active", {f"user:{USER}": "j1"})
+    monkeypatch.setattr(main, "ADMIN_USERS", {"adminatexampledotcom"})
+
+    assert _client(main, USER).get("/job-stats").get_json()["active"] == 1
+    assert _client(main, "adminatexampledotcom").get("/job-stats").get_json()["active"] == {f"user:{USER}": "j1"}
+
+
+def test_all_users_manual_process_is_admin_only(main, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(main, "submit_all_users_job", lambda verbose=False: submitted.append(1) or ("j1", False))
+    monkeypatch.setattr(main, "ADMIN_USERS", {"adminatexampledotcom"})
+
+    assert _client(main, USER).get("/manual-process").status_code == 403
+    assert _client(main, "adminatexampledotcom").get("/manual-process").status_code == 202
+    assert submitted == [1]
+
+
+def _stored_spam(mongo, **fields):
+    import datetime
+    doc = {"msg_id": "m1", "subject": "hi", "body": "lunch friday?", "processed": True, "spam": True,
+           "fetched_at": datetime.datetime.utcnow(), **fields}
+    return mongo.insert_emails(USER, [doc])[0]
+
+
+def test_rescued_email_is_queued_for_enrichment(main, mongo, monkeypatch):
+    monkeypatch.setattr(main, "ENRICH_MODE", "queued")
+    monkeypatch.setattr(main, "_run_on_scheduler", lambda run: run())
+    monkeypatch.setattr(main.onlinelearn, "record_feedback", lambda user_id, doc, is_spam: True)
+    doc = _stored_spam(mongo)
+
+    resp = _client(main, USER).post("/feedback", json={"id": str(doc["_id"]), "spam": False})
+
+    assert resp.status_code == 200
+    assert main.enrichment.queue_collection.count_documents({"doc_id": doc["_id"]}) == 1
+    assert mongo.find_email(USER, doc["_id"], {"enrichment": 1})["enrichment"] == "pending"
+
+
+def test_rescore_enriches_emails_flipped_to_ham(main, mongo, monkeypatch):
+    import numpy as np
+    monkeypatch.setattr(main, "ENRICH_MODE", "queued")
+    flipped, summarized = _stored_spam(mongo), _stored_spam(mongo, msg_id="m2", summary="old")
+
+    def classify(docs, fill=None):
+        return {"labels": np.zeros(len(docs), dtype=bool), "proba": np.zeros(len(docs))}
+    monkeypatch.setattr(main.primarymodel, "classify_batch", classify)
+
+    progress = main.rescore_users([USER])
+
+    assert progress["changed"] == 2 and progress["enriched"] == 1
+    assert [d["doc_id"] for d in main.enrichment.queue_collection.find()] == [flipped["_id"]]
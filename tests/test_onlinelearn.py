@@ -0,0 +1,83 @@
+# test_onlinelearn.py
+# Spam corrections: a flipped correction replaces the earlier one in the model instead of
+# stacking on it, applied corrections drop their mail text, and each user's share is capped.
+import datetime
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sklearn")
+
+USER = "daveatexampledotcom"
+
+
+@pytest.fixture
+def onlinelearn(mongo, tmp_path, monkeypatch):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.naive_bayes import MultinomialNB
+    from models import primarymodel, onlinelearn
+
+    monkeypatch.setattr(primarymodel, "ARTIFACT_DIR", str(tmp_path))
+    monkeypatch.setattr(primarymodel, "CURRENT_POINTER", str(tmp_path / "CURRENT"))
+    monkeypatch.setattr(primarymodel, "_registry", {**primarymodel._registry, "model": None, "signature": None,
+                                                    "digest": None, "version": None})
+    monkeypatch.setattr(onlinelearn, "_index_ready", False)
+
+    texts = ["win a free prize now", "claim your free money", "meeting notes for monday", "lunch on friday"]
+    vectorizer = TfidfVectorizer().fit(texts)
+    model = MultinomialNB().fit(vectorizer.transform(texts), [1, 1, 0, 0])
+    primarymodel.promote(primarymodel.save_artifacts(model, vectorizer, {"trainer": "batch"}))
+    return onlinelearn
+
+
+def _email(mongo, msg_id="m1"):
+    doc = {"msg_id": msg_id, "subject": "free lunch", "body": "monday prize", "processed": True,
+           "fetched_at": datetime.datetime.utcnow()}
+    return mongo.insert_emails(USER, [doc])[0]
+
+
+def _counts():
+    from models import primarymodel
+    model, _ = primarymodel.load_model_and_vectorizer(force_check=True)
+    return np.array(model.feature_count_), np.array(model.class_count_)
+
+
+def test_flipped_correction_replaces_the_applied_one(mongo, onlinelearn):
+    doc = _email(mongo)
+    base_features, base_classes = _counts()
+
+    onlinelearn.record_feedback(USER, doc, True)
+    assert onlinelearn.apply_feedback() == 1
+    onlinelearn.record_feedback(USER, doc, False)
+    assert onlinelearn.apply_feedback() == 1
+    features, classes = _counts()
+
+    # only the not-spam correction remains: the spam row was subtracted again
+    assert classes[1] == pytest.approx(base_classes[1])
+    assert classes[0] == pytest.approx(base_classes[0] + onlinelearn.FEEDBACK_WEIGHT)
+    assert np.allclose(features[1], base_features[1])
+    assert onlinelearn.get_stats()["unlearned"] == 1
+
+
+def test_applied_correction_drops_mail_text(mongo, onlinelearn):
+    doc = _email(mongo)
+    onlinelearn.record_feedback(USER, doc, True)
+    onlinelearn.apply_feedback()
+
+    stored = onlinelearn.feedback_collection.find_one({"doc_id": doc["_id"]})
+    assert stored["applied"] is True
+    assert "body" not in stored and "subject" not in stored
+    assert stored["applied_label"] is True
+
+
+def test_user_over_daily_cap_only_relabels(mongo, onlinelearn, monkeypatch):
+    monkeypatch.setattr(onlinelearn, "USER_DAILY_CAP", 1)
+    first, second = _email(mongo, "m1"), _email(mongo, "m2")
+
+    assert onlinelearn.record_feedback(USER, first, True) is True
+    assert onlinelearn.record_feedback(USER, second, True) is False
+    # re-correcting an email already counted is not a new slot
+    assert onlinelearn.record_feedback(USER, first, False) is True
+
+    assert onlinelearn.feedback_collection.count_documents({}) == 1
+    assert mongo.find_email(USER, second["_id"], {"spam": 1})["spam"] is True
@@ -0,0 +1,72 @@
+# test_primarymodel.py
+# Model registry: root-level pickles left from before versioned artifacts are converted and
+# promoted on first load (by one process at a time), so serving reads the memory-mapped arrays.
+import os
+import pickle
+
+import pytest
+
+pytest.importorskip("sklearn")
+
+
+@pytest.fixture
+def primarymodel(tmp_path, monkeypatch):
+    from models import primarymodel
+    monkeypatch.setattr(primarymodel, "ARTIFACT_DIR", str(tmp_path / "artifacts"))
+    monkeypatch.setattr(primarymodel, "CURRENT_POINTER", str(tmp_path / "artifacts" / "CURRENT"))
+    monkeypatch.setattr(primarymodel, "CONVERT_LOCK", str(tmp_path / "artifacts" / ".convert.lock"))
+    monkeypatch.setattr(primarymodel, "MODEL_PATH", str(tmp_path / "model.pkl"))
+    monkeypatch.setattr(primarymodel, "VECTORIZER_PATH", str(tmp_path / "vectorizer.pkl"))
+    monkeypatch.setattr(primarymodel, "_registry", {**primarymodel._registry, "model": None, "signature": None,
+                                                    "digest": None, "version": None, "legacy_checked": False})
+    return primarymodel
+
+
+def _write_pickles(primarymodel):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.naive_bayes import MultinomialNB
+    texts = ["win a free prize now", "meeting notes for monday"]
+    vectorizer = TfidfVectorizer().fit(texts)
+    model = MultinomialNB().fit(vectorizer.transform(texts), [1, 0])
+    with open(primarymodel.MODEL_PATH, 'wb') as f:
+        pickle.dump(model, f)
+    with open(primarymodel.VECTORIZER_PATH, 'wb') as f:
+        pickle.dump(vectorizer, f)
+
+
+def test_root_pickles_are_converted_on_first_load(primarymodel):
+    from models import artifacts
+    _write_pickles(primarymodel)
+
+    model, vectorizer = primarymodel.load_model_and_vectorizer()
+
+    assert primarymodel.current_version() is not None
+    assert primarymodel.get_model_stats()["version"] == primarymodel.current_version()
+    assert isinstance(vectorizer, artifacts.MappedVocabVectorizer)
+    out = primarymodel.classify_batch([{"_id": 1, "subject": "prize", "body": "win free"}])
+    assert out["labels"].tolist() == [True]
+    assert not os.path.exists(primarymodel.CONVERT_LOCK)
+
+
+def test_a_held_conversion_lock_is_not_converted_twice(primarymodel, monkeypatch):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    monkeypatch.setattr(primarymodel, "CONVERT_WAIT_SECONDS", 0.1)
+    _write_pickles(primarymodel)
+    os.makedirs(primarymodel.ARTIFACT_DIR)
+    open(primarymodel.CONVERT_LOCK, 'w').close()      # another worker is converting
+
+    _, vectorizer = primarymodel.load_model_and_vectorizer()
+
+    assert os.listdir(primarymodel.ARTIFACT_DIR) == [".convert.lock"]
+    assert isinstance(vectorizer, TfidfVectorizer)
+
+
+def test_conversion_can_be_turned_off(primarymodel, monkeypatch):
+    monkeypatch.setattr(primarymodel, "CONVERT_LEGACY", False)
+    _write_pickles(primarymodel)
+
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    _, vectorizer = primarymodel.load_model_and_vectorizer()
+
+    assert primarymodel.current_version() is None
+    assert isinstance(vectorizer, TfidfVectorizer)
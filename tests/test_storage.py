@@ -0,0 +1,91 @@
+# test_storage.py
+# storage.py against mongomock: msg_id/processed/fetched_at indexes, insert_many dedupe,
+# bulk classification updates, the round-trip accounting and retention TTLs on derived data.
+import datetime
+
+USER = "carolatexampledotcom"
+
+
+def _doc(msg_id):
+    return {"msg_id": msg_id, "subject": f"s-{msg_id}", "body": "b", "processed": False,
+            "fetched_at": datetime.datetime.utcnow()}
+
+
+def test_user_collection_gets_its_indexes(mongo):
+    mongo.ensure_user_indexes(USER)
+
+    info = mongo.db[USER].index_information()
+    assert info["msg_id_unique"]["unique"] is True
+    assert info["msg_id_unique"]["key"] == [("msg_id", 1)]
+    assert info["processed"]["key"] == [("processed", 1)]
+    assert any(i["key"] == [("fetched_at", 1)] for i in info.values())
+
+
+def test_duplicate_msg_ids_are_skipped(mongo):
+    assert len(mongo.insert_emails(USER, [_doc("a"), _doc("b")])) == 2
+
+    inserted = mongo.insert_emails(USER, [_doc("b"), _doc("c"), _doc("a")])
+
+    assert [d["msg_id"] for d in inserted] == ["c"]
+    assert mongo.db[USER].count_documents({}) == 3
+    assert mongo.stats["duplicates_skipped"] == 2
+
+
+def test_stored_msg_ids_is_one_query(mongo):
+    mongo.insert_emails(USER, [_doc("a"), _doc("b")])
+    mongo.reset_stats()
+
+    assert mongo.stored_msg_ids(USER, ["a", "b", "z"]) == {"a", "b"}
+    assert mongo.stats["round_trips"] == 1
+    assert mongo.stats["round_trips_saved"] == 2
+
+
+def test_updates_are_one_bulk_write(mongo):
+    mongo.insert_emails(USER, [_doc(m) for m in "abcd"])
+    pending = mongo.find_pending(USER, {"msg_id": 1})
+    mongo.reset_stats()
+
+    modified = mongo.apply_updates(USER, [(d["_id"], {"processed": True, "spam": d["msg_id"] == "b"})
+                                          for d in pending])
+
+    assert modified == 4
+    assert mongo.find_pending(USER) == []
+    assert mongo.db[USER].find_one({"msg_id": "b"})["spam"] is True
+    stats = mongo.reset_stats()
+    # bulk_write + the find_pending check, against one update_one per doc + one find
+    assert stats["round_trips"] == 2
+    assert stats["round_trips_saved"] == 3
+
+
+def test_a_tick_reports_round_trips_saved(mongo):
+    # dedupe + insert of 10 new messages: 2 round trips instead of find_one + insert_one per message
+    ids = [f"m{i}" for i in range(10)]
+    stored = mongo.stored_msg_ids(USER, ids)
+    mongo.insert_emails(USER, [_doc(m) for m in ids if m not in stored])
+
+    stats = mongo.reset_stats()
+    assert stats["round_trips"] == 2
+    assert stats["round_trips_saved"] == 9 + 19
+
+
+def test_retention_ttl_keeps_an_existing_window(mongo):
+    col = mongo.client["mailmind_cache"]["derived"]
+    mongo.set_ttl_index(col, "created_at", 600)
+
+    mongo.ensure_retention_ttl(col)
+
+    info = [i for i in col.index_information().values() if i["key"] == [("created_at", 1)]]
+    assert [i["expireAfterSeconds"] for i in info] == [600]
+
+
+def test_retention_ttl_is_set_once_per_process(mongo, monkeypatch):
+    col = mongo.client["mailmind_cache"]["derived"]
+    mongo.ensure_retention_ttl(col)
+    calls = []
+    monkeypatch.setattr(mongo, "set_ttl_index", lambda *args, **kwargs: calls.append(args) or True)
+
+    mongo.ensure_retention_ttl(col)
+
+    assert calls == []
+    info = [i for i in col.index_information().values() if i["key"] == [("created_at", 1)]]
+    assert info[0]["expireAfterSeconds"] == mongo.DEFAULT_RETENTION_SECONDS
@@ -0,0 +1,111 @@
+# test_sync.py
+# Incremental sync from the stored historyId, against the Gmail stub and mongomock.
+import pytest
+
+pytest.importorskip("googleapiclient")
+pytest.importorskip("google_auth_oauthlib")
+
+from gmailstub import StubGmail, message
+
+USER = "bobatexampledotcom"
+
+
+@pytest.fixture
+def fetch(mongo, monkeypatch):
+    from MAILFETCHING import fetch
+    monkeypatch.setattr(fetch.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(fetch, "SYNC_MODE", "incremental")
+    monkeypatch.setattr(fetch, "FETCH_MODE", "batch")
+    mongo.tokens_collection.insert_one({"user_id": USER})
+    return fetch
+
+
+def _history_id(mongo):
+    return mongo.tokens_collection.find_one({"user_id": USER})["history_id"]
+
+
+def test_first_sync_is_full_then_incremental(fetch, mongo):
+    gmail = StubGmail([message("m1"), message("m2")])
+
+    first = fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+    assert first["sync"] == "full"
+    assert _history_id(mongo) == str(gmail.history_id)
+
+    gmail.add(message("m3"))
+    gmail.round_trips = 0
+    second = fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+
+    assert second["sync"] == "incremental"
+    assert [d["msg_id"] for d in second["inserted"]] == ["m3"]
+    assert gmail.round_trips == 2          # history.list + one batch
+    assert _history_id(mongo) == str(gmail.history_id)
+
+
+def test_quiet_mailbox_costs_one_call(fetch, mongo):
+    gmail = StubGmail([message("m1")])
+    fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+    gmail.round_trips = 0
+
+    result = fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+
+    assert result["inserted"] == []
+    assert gmail.round_trips == 1
+
+
+def test_history_id_is_kept_until_failed_messages_are_fetched(fetch, mongo):
+    gmail = StubGmail([message("m1")])
+    fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+    cursor = _history_id(mongo)
+
+    gmail.add(message("m2"))
+    gmail.add(message("m3"))
+    gmail.failures["m3"] = float("inf")
+    result = fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+
+    assert [d["msg_id"] for d in result["inserted"]] == ["m2"]
+    assert result["failed"] == ["m3"]
+    assert _history_id(mongo) == cursor
+
+    gmail.failures["m3"] = 0
+    retry = fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+
+    assert [d["msg_id"] for d in retry["inserted"]] == ["m3"]
+    assert _history_id(mongo) == str(gmail.history_id)
+
+
+def test_deleted_messages_do_not_block_the_cursor(fetch, mongo):
+    gmail = StubGmail([message("m1")])
+    fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+
+    gmail.add(message("m2"))
+    del gmail.store["m2"]                  # listed as added, then deleted: permanent 404
+    result = fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+
+    assert result["failed"] == []
+    assert _history_id(mongo) == str(gmail.history_id)
+
+
+def test_failed_listing_does_not_advance_the_cursor(fetch, mongo):
+    gmail = StubGmail([message("m1"), message("m2")])
+    gmail.list_failures = 1
+
+    first = fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+
+    assert first["error"]
+    assert "history_id" not in mongo.tokens_collection.find_one({"user_id": USER})
+
+    retry = fetch.sync_mailbox(None, USER, verbose=False, service=gmail)
+
+    assert retry["sync"] == "full"
+    assert sorted(d["msg_id"] for d in retry["inserted"]) == ["m1", "m2"]
+    assert _history_id(mongo) == str(gmail.history_id)
+
+
+def test_full_sync_reads_every_unread_page_before_setting_the_cursor(fetch, mongo):
+    gmail = StubGmail([message(f"m{i}") for i in range(5)])
+
+    result = fetch.sync_mailbox(None, USER, limit=2, verbose=False, service=gmail)
+
+    assert sorted(d["msg_id"] for d in result["inserted"]) == [f"m{i}" for i in range(5)]
+    assert result["next_page_token"] is None
+    assert _history_id(mongo) == str(gmail.history_id)
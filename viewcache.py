@@ -0,0 +1,92 @@
+# viewcache.py
+# In-process materialized dashboard views, one set per user.
+# Writers (storage inserts/updates, enrichment, retention) call invalidate(user_id); a read after
+# that rebuilds once and every later read until the next write is a single dict lookup.
+# VIEW_CACHE_TTL bounds staleness for writes made by other processes (e.g. another gunicorn worker).
+import os
+import time
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = int(os.getenv("VIEW_CACHE_MAX_ENTRIES", "5000"))
+TTL_SECONDS = float(os.getenv("VIEW_CACHE_TTL", "300"))
+
+_lock = threading.Lock()
+_entries = OrderedDict()     # (user_id, key) -> {"value", "version", "built_at"}
+_versions = {}               # user_id -> write generation
+_last_write = {}             # user_id -> time of last invalidation
+stats = {
+    "hits": 0,
+    "misses": 0,
+    "invalidations": 0,
+    "expired": 0,
+    "served_age_total": 0.0,   # sum of entry ages at hit time
+    "served_age_max": 0.0,
+    "rebuild_lag_total": 0.0,  # write -> next rebuild delay
+    "rebuilds_after_write": 0,
+}
+
+
+def invalidate(user_id):
+    """Mark every cached view of user_id stale; called after any write to the user's mail."""
+    with _lock:
+        _versions[user_id] = _versions.get(user_id, 0) + 1
+        _last_write[user_id] = time.time()
+        for k in [k for k in _entries if k[0] == user_id]:
+            del _entries[k]
+        stats["invalidations"] += 1
+
+
+def invalidate_all():
+    with _lock:
+        now = time.time()
+        for user_id in {k[0] for k in _entries} | set(_versions):
+            _versions[user_id] = _versions.get(user_id, 0) + 1
+            _last_write[user_id] = now
+        _entries.clear()
+        stats["invalidations"] += 1
+
+
+def get_or_build(user_id, key, build):
+    """Return the cached view for (user_id, key), calling build() on a miss."""
+    now = time.time()
+    with _lock:
+        version = _versions.get(user_id, 0)
+        entry = _entries.get((user_id, key))
+        if entry and entry["version"] == version:
+            age = now - entry["built_at"]
+            if age <= TTL_SECONDS:
+                _entries.move_to_end((user_id, key))
+                stats["hits"] += 1
+                stats["served_age_total"] += age
+                stats["served_age_max"] = max(stats["served_age_max"], age)
+                return entry["value"]
+            stats["expired"] += 1
+        stats["misses"] += 1
+
+    value = build()
+
+    with _lock:
+        # a write that landed while building makes this result stale; don't store it
+        if _versions.get(user_id, 0) == version:
+            _entries[(user_id, key)] = {"value": value, "version": version, "built_at": time.time()}
+            _entries.move_to_end((user_id, key))
+            while len(_entries) > MAX_ENTRIES:
+                _entries.popitem(last=False)
+        last_write = _last_write.pop(user_id, None)
+        if last_write is not None:
+            stats["rebuilds_after_write"] += 1
+            stats["rebuild_lag_total"] += now - last_write
+    return value
+
+
+def get_stats():
+    with _lock:
+        snapshot = dict(stats)
+        snapshot["entries"] = len(_entries)
+    lookups = snapshot["hits"] + snapshot["misses"]
+    snapshot["hit_rate"] = round(snapshot["hits"] / lookups, 3) if lookups else None
+    snapshot["served_age_avg"] = round(snapshot["served_age_total"] / snapshot["hits"], 3) if snapshot["hits"] else None
+    snapshot["rebuild_lag_avg"] = (round(snapshot["rebuild_lag_total"] / snapshot["rebuilds_after_write"], 3)
+                                   if snapshot["rebuilds_after_write"] else None)
+    return snapshot